@@ -1,7 +1,10 @@
 """
 Web Application Entry Point
 
-This script initializes and configures the Flask web application.
+`create_app` builds and configures the Flask web application; `app` is
+the instance gunicorn and `flask --app app` serve. Building it opens no
+database connection and starts no thread, so gunicorn can import it once
+in the master and fork the workers from there (preload_app).
 It sets up:
 - Flask app initialization
 - Secret key configuration for session management
@@ -17,24 +20,26 @@ Modules and Packages:
 
 Routes:
 - (Commented out) Main route for the homepage
+- /ready: readiness check reporting this worker's database pool
+- /metrics: Prometheus metrics, see metrics.py
 
 Blueprints:
 - User blueprint: Handles user-related routes under the `/user` prefix
 """
 
-from flask import Flask, render_template, request, redirect, url_for, flash
-from flask_login import current_user, login_required,logout_user
-from database import db
-from user.user import user, login_manager
+from dotenv import load_dotenv
 
-app = Flask(__name__)
-app.secret_key = "secret_key"  # needed for flask login sessions
+# before the imports below, which read their settings from the environment
+load_dotenv()
 
-login_manager.init_app(app)
-app.register_blueprint(user, url_prefix="/user")
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask_login import current_user, login_required,logout_user
+from pymongo.errors import PyMongoError
+from database import db, pool_status
+import metrics
+from user.user import user, login_manager
 
 " Route on Launch "
-@app.route("/")
 def index():
     """Redirect to right page if logged in or not"""
     if current_user.is_authenticated:
@@ -43,40 +48,34 @@ def index():
     return redirect(url_for("user.login"))
 
 " Route for signup page "
-@app.route("/signup")
 def signup():
     """Render Signup page"""
     return render_template("Signup.html")
 
 " Route for login page "
 @login_required
-@app.route("/menu")
 def menu():
     """Render menu page"""
     return render_template("Menu.html")
 
 " Route for successful login"
 @login_required
-@app.route("/calendar")
 def calendar():
     """Render calendar page"""
     return render_template("Calendar.html")
 
 " Route for analytics section "
-@app.route("/analytics")
 @login_required
 def analytics():
     """Render Analytics page"""
     return render_template("Analytics.html")
 
 " Route for search section "
-@app.route("/search")
 @login_required
 def search():
     """Render Search page"""
     return render_template("Search.html")
 
-@app.route("/ai")
 @login_required
 def ai():
     """Render Analyze with AI page"""
@@ -84,7 +83,6 @@ def ai():
 
 " Route for user info page "
 " Contains First Name, Last Name, and Email"
-@app.route("/user-info", methods=["GET", "POST"])
 @login_required
 def user_info():
     """Handle displaying and updating user information"""
@@ -99,7 +97,10 @@ def user_info():
 
         return redirect(url_for("user_info"))
 
-    user_data = db.users.find_one({"email": current_user.email})
+    user_data = db.users.find_one(
+        {"email": current_user.email},
+        {"_id": 0, "email": 1, "firstname": 1, "lastname": 1},
+    )
 
     user_info = {
         "email": user_data["email"],
@@ -110,20 +111,54 @@ def user_info():
     return render_template("edit-user-info.html", user_info=user_info)
 
 " Delete account route"
-@app.route("/delete-acct")
 @login_required 
 def delete_acct():
     return render_template("delete-acct.html")
 
+" Readiness check for the load balancer and for sizing workers"
+def ready():
+    """Ping the database and report this worker's connection pool"""
+    try:
+        db.command("ping")
+        database = "ok"
+    except PyMongoError as e:
+        database = f"unavailable: {e}"
+    status = 200 if database == "ok" else 503
+    return jsonify({"database": database, "pool": pool_status()}), status
+
 " Logout route redirecting to sign in page"
-@app.route('/logout')
 def logout():
     """Log out the user and redirect to the login page"""
     logout_user()  # This function logs out the current user
     return redirect(url_for('user.login'))  # Redirect to the login page
 
 
-
+def create_app(config=None):
+    """Build the app, applying the optional `config` mapping over the defaults"""
+    app = Flask(__name__)
+    app.secret_key = "secret_key"  # needed for flask login sessions
+    if config:
+        app.config.update(config)
+
+    login_manager.init_app(app)
+    metrics.init_app(app)
+    app.register_blueprint(user, url_prefix="/user")
+
+    app.add_url_rule("/", view_func=index)
+    app.add_url_rule("/signup", view_func=signup)
+    app.add_url_rule("/menu", view_func=menu)
+    app.add_url_rule("/calendar", view_func=calendar)
+    app.add_url_rule("/analytics", view_func=analytics)
+    app.add_url_rule("/search", view_func=search)
+    app.add_url_rule("/ai", view_func=ai)
+    app.add_url_rule("/user-info", view_func=user_info, methods=["GET", "POST"])
+    app.add_url_rule("/delete-acct", view_func=delete_acct)
+    app.add_url_rule("/ready", view_func=ready)
+    app.add_url_rule("/logout", view_func=logout)
+    return app
+
+
+app = create_app()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
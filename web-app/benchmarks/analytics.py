@@ -0,0 +1,196 @@
+"""
+Analytics benchmark: NumPy against per-event Python loops
+
+Times the vectorized statistics of user/analytics.py on synthetic event
+histories against plain Python loops computing the same results, including
+the month x category loop /user/analytics-data used to run. Only the
+computation is timed, reading events from MongoDB costs the same for both.
+Each result is checked against the loop's before it is reported.
+
+    cd web-app
+    python -m benchmarks.analytics --sizes 1000 10000 100000
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import math
+import random
+import statistics
+import sys
+import time
+
+from benchmarks.load import synthetic_events
+from user import analytics
+
+SIZES = (1000, 10000, 100000)
+
+
+def loop_month_category(events):
+    """Spending per month and category, the loop analytics-data used."""
+    grouped = {}
+    for event in events:
+        month = event["Date"][:7]
+        categories = grouped.setdefault(month, {})
+        categories[event["Category"]] = categories.get(event["Category"], 0) + event["Amount"]
+    return grouped
+
+
+def loop_rolling(events, windows=analytics.ROLLING_WINDOWS):
+    """Daily totals and trailing averages, one day at a time."""
+    daily = collections.defaultdict(float)
+    for event in events:
+        daily[event["Date"]] += event["Amount"]
+    first = datetime.date.fromisoformat(min(daily))
+    last = datetime.date.fromisoformat(max(daily))
+    totals = [
+        daily.get((first + datetime.timedelta(days=i)).isoformat(), 0.0)
+        for i in range((last - first).days + 1)
+    ]
+    averages = {}
+    for window in windows:
+        running, values = 0.0, []
+        for i, total in enumerate(totals):
+            running += total
+            if i >= window:
+                running -= totals[i - window]
+            values.append(running / min(i + 1, window))
+        averages[str(window)] = values
+    return totals, averages
+
+
+def _percentile(ordered, q):
+    position = (len(ordered) - 1) * q / 100
+    lower = math.floor(position)
+    upper = math.ceil(position)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def loop_percentiles(events, q=analytics.PERCENTILES):
+    """Amount percentiles per category, sorting each category's list."""
+    groups = collections.defaultdict(list)
+    for event in events:
+        groups[event["Category"]].append(event["Amount"])
+    return {
+        category: [_percentile(sorted(amounts), p) for p in q]
+        for category, amounts in groups.items()
+    }
+
+
+def loop_outliers(events, threshold=analytics.OUTLIER_THRESHOLD):
+    """Ids of the events analytics.outliers flags, scored one by one."""
+    groups = collections.defaultdict(list)
+    for event in events:
+        groups[event["Category"]].append(event["Amount"])
+    medians, scales = {}, {}
+    for category, amounts in groups.items():
+        median = statistics.median(amounts)
+        deviations = [abs(a - median) for a in amounts]
+        mad = statistics.median(deviations)
+        medians[category] = median
+        scales[category] = (
+            analytics.MAD_SCALE * mad
+            if mad
+            else analytics.MEAN_AD_SCALE * statistics.fmean(deviations)
+        )
+    return {
+        event["_id"]
+        for event in events
+        if len(groups[event["Category"]]) >= analytics.OUTLIER_MIN_COUNT
+        and scales[event["Category"]]
+        and (event["Amount"] - medians[event["Category"]]) / scales[event["Category"]]
+        > threshold
+    }
+
+
+def best_of(repeat, function, *args):
+    """Fastest of `repeat` runs in milliseconds, and the last result."""
+    best = math.inf
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function(*args)
+        best = min(best, time.perf_counter() - started)
+    return round(best * 1000, 3), result
+
+
+def _close(a, b):
+    return all(math.isclose(x, y, rel_tol=1e-9, abs_tol=0.01) for x, y in zip(a, b))
+
+
+def run(size, repeat=5, seed=0):
+    """Loop and NumPy timings for one history size, checking they agree."""
+    rng = random.Random(seed)
+    events = list(synthetic_events(size, rng))
+    # a few expenses far above the rest, so outliers has something to find
+    for event in rng.sample(events, max(1, size // 1000)):
+        event["Amount"] = round(event["Amount"] * 50, 2)
+
+    array_ms, expenses = best_of(repeat, analytics.Expenses.from_events, events)
+    timings = {"to arrays": (None, array_ms)}
+
+    loop_ms, grouped = best_of(repeat, loop_month_category, events)
+    numpy_ms, rows = best_of(repeat, analytics.month_over_month, expenses)
+    for row in rows:
+        expected = grouped.get(row["month"], {})
+        assert _close([row["total"]], [sum(expected.values())])
+    timings["month x category"] = (loop_ms, numpy_ms)
+
+    loop_ms, (totals, averages) = best_of(repeat, loop_rolling, events)
+    numpy_ms, rolling = best_of(repeat, analytics.rolling_averages, expenses)
+    assert _close(rolling["totals"], totals)
+    for window, values in averages.items():
+        assert _close(rolling["averages"][window], values)
+    timings["rolling averages"] = (loop_ms, numpy_ms)
+
+    loop_ms, expected = best_of(repeat, loop_percentiles, events)
+    numpy_ms, percentiles = best_of(repeat, analytics.category_percentiles, expenses)
+    for category, values in expected.items():
+        stats = percentiles[category]
+        assert _close([stats[f"p{p}"] for p in analytics.PERCENTILES], values)
+    timings["percentiles"] = (loop_ms, numpy_ms)
+
+    loop_ms, expected = best_of(repeat, loop_outliers, events)
+    numpy_ms, flagged = best_of(repeat, analytics.outliers, expenses)
+    assert {row["_id"] for row in flagged} == expected
+    timings["outliers"] = (loop_ms, numpy_ms)
+
+    return [
+        {
+            "size": size,
+            "statistic": name,
+            "loop_ms": loop_ms,
+            "numpy_ms": numpy_ms,
+            "speedup": round(loop_ms / numpy_ms, 1) if loop_ms and numpy_ms else None,
+        }
+        for name, (loop_ms, numpy_ms) in timings.items()
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument("--repeat", type=int, default=5, help="best of this many runs")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for size in args.sizes:
+        for result in run(size, args.repeat, args.seed):
+            results.append(result)
+            loop = "" if result["loop_ms"] is None else f"{result['loop_ms']:>10} ms"
+            speedup = f"  x{result['speedup']}" if result["speedup"] else ""
+            print(
+                f"{size:>7} {result['statistic']:<18} loop {loop:>13}  "
+                f"numpy {result['numpy_ms']:>9} ms{speedup}"
+            )
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"wrote {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
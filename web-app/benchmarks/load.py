@@ -0,0 +1,334 @@
+"""
+Load benchmark for the /user routes
+
+Seeds one synthetic user per data size, then drives each scenario through
+the Flask app from CONCURRENCY threads and records every request's
+latency. Results (throughput and p50/p95/p99 per size and scenario) are
+printed and written as JSON, so runs on two commits can be compared with
+--baseline.
+
+The database is an in-memory mongomock stand-in unless --mongo-uri points
+at a real (scratch) MongoDB. mongomock is not thread-safe (concurrent
+deletes can raise KeyError inside it), so on mongomock every scenario
+runs on one thread whatever --concurrency says, and the report notes it.
+Gemini is stubbed, runs need no network.
+
+    cd web-app
+    python -m benchmarks.load --sizes 10 1000 10000 100000 --concurrency 8
+    python -m benchmarks.load --output new.json --baseline old.json
+"""
+
+import argparse
+import calendar
+import contextlib
+import datetime
+import json
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+from unittest import mock
+
+import mongomock
+from pymongo import MongoClient
+
+import app as app_module
+from benchmarks import git_commit
+from user import ai_jobs
+from user import events as event_store
+from user import rollups
+from user import user as user_module
+
+SIZES = (10, 1000, 10000, 100000)
+PASSWORD = "benchmark-password"
+MEMO_WORDS = (
+    "coffee lunch groceries rent uber metro textbook concert netflix pizza "
+    "gas phone pharmacy gym bakery tuition museum taxi dinner snacks"
+).split()
+SEED_BATCH = 5000
+
+SCENARIOS = {
+    "get-events page": lambda c, r: c.get("/user/get-events?limit=100&order=desc"),
+    "get-events month": lambda c, r: c.get(
+        "/user/get-events?from=%s&to=%s" % r.month_window()
+    ),
+    "search-events": lambda c, r: c.get(f"/user/search-events/{r.choice(MEMO_WORDS)}"),
+    "analytics-data month": lambda c, r: c.get("/user/analytics-data"),
+    "analytics-data week": lambda c, r: c.get("/user/analytics-data?granularity=week"),
+    "month-summary": lambda c, r: c.get(
+        "/user/month-summary?year=%s&month=%s" % tuple(map(int, r.month().split("-")))
+    ),
+    "add-event": lambda c, r: c.post("/user/add-event", json=r.event()),
+    "edit-event": lambda c, r: c.put(f"/user/edit-event/{r.own_event()}", json=r.event()),
+    "delete-event": lambda c, r: c.delete(f"/user/delete-event/{r.own_event()}"),
+    "login": lambda c, r: c.post(
+        "/user/login", data={"email": r.email, "password": PASSWORD}
+    ),
+}
+
+
+class Requests(random.Random):
+    """Random request parameters for one worker thread."""
+
+    def __init__(self, seed, email):
+        super().__init__(seed)
+        self.email = email
+        self.own = []
+
+    def month(self):
+        return f"{self.randint(2022, 2024)}-{self.randint(1, 12):02d}"
+
+    def month_window(self):
+        """First and last day of a random month, both real dates."""
+        year, month = map(int, self.month().split("-"))
+        last = calendar.monthrange(year, month)[1]
+        return f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last:02d}"
+
+    def event(self):
+        return {
+            "amount": round(self.uniform(1, 200), 2),
+            "category": self.choice(user_module.DEFAULT_CATEGORIES),
+            "date": f"{self.month()}-{self.randint(1, 28):02d}",
+            "memo": " ".join(self.sample(MEMO_WORDS, 2)),
+        }
+
+    def event_doc(self, event_id):
+        """A stored event, as the event store keeps it."""
+        event = self.event()
+        return {
+            "_id": event_id,
+            "Amount": event["amount"],
+            "Category": event["category"],
+            "Date": event["date"],
+            "Memo": event["memo"],
+        }
+
+    def own_event(self):
+        """An event id the seed gave this thread to edit and delete."""
+        return self.own.pop() if self.own else "missing"
+
+
+def synthetic_events(count, rng):
+    """`count` events spread over three years, oldest first."""
+    start = datetime.date(2022, 1, 1)
+    for i in range(count):
+        day = start + datetime.timedelta(days=rng.randrange(3 * 365))
+        event = {
+            "_id": f"bench-{i:07d}",
+            "Amount": round(rng.uniform(1, 200), 2),
+            "Category": rng.choice(user_module.DEFAULT_CATEGORIES),
+            "Date": day.isoformat(),
+            "Memo": " ".join(rng.sample(MEMO_WORDS, 2)),
+        }
+        yield event
+
+
+def seed_user(db, size, seed):
+    """Create the benchmark user holding `size` events, returning its email."""
+    email = f"bench-{size}@example.com"
+    db.users.delete_many({"email": email})
+    event_store.delete_user_events(db, email)
+    user_module.User.create_user(db, email, PASSWORD, "Bench", str(size))
+
+    rng = random.Random(seed)
+    batch = []
+    for event in synthetic_events(size, rng):
+        doc = dict(event, user=email)
+        doc["search_grams"] = event_store.search_grams(doc["Category"], doc["Memo"])
+        batch.append(doc)
+        if len(batch) >= SEED_BATCH:
+            db.events.insert_many(batch)
+            batch = []
+    if batch:
+        db.events.insert_many(batch)
+    # the raw inserts bypass the change listeners, materialize totals once
+    rollups.rebuild(db, email)
+    return email
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    index = max(0, min(len(ordered) - 1, round(fraction * len(ordered)) - 1))
+    return ordered[index]
+
+
+def run_scenario(flask_app, db, email, scenario, requests, concurrency, seed):
+    """Send `requests` requests from `concurrency` threads, returning the stats."""
+    per_thread = [requests // concurrency] * concurrency
+    for i in range(requests % concurrency):
+        per_thread[i] += 1
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    ready = threading.Barrier(concurrency + 1)
+
+    # per-thread parameters, and events to edit or delete, are prepared
+    # before any thread starts so setup is neither timed nor racing
+    params = [Requests(seed * 1000 + index, email) for index in range(concurrency)]
+    if scenario in ("edit-event", "delete-event"):
+        prefix = scenario.split("-")[0]
+        for index, (thread_params, count) in enumerate(zip(params, per_thread)):
+            thread_params.own = [
+                event_store.insert_event(
+                    db, email, thread_params.event_doc(f"{prefix}-{index}-{n}")
+                )["_id"]
+                for n in range(count)
+            ]
+
+    def worker(thread_params, count):
+        client = flask_app.test_client()
+        client.post("/user/login", data={"email": email, "password": PASSWORD})
+        timings = []
+        failed = 0
+        ready.wait()
+        for _ in range(count):
+            started = time.perf_counter()
+            try:
+                status = SCENARIOS[scenario](client, thread_params).status_code
+            except Exception:
+                status = 500
+            timings.append(time.perf_counter() - started)
+            if status >= 400:
+                failed += 1
+        with lock:
+            latencies.extend(timings)
+            errors.append(failed)
+
+    threads = [
+        threading.Thread(target=worker, args=(thread_params, count))
+        for thread_params, count in zip(params, per_thread)
+    ]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": len(latencies),
+        "errors": sum(errors),
+        "seconds": round(elapsed, 4),
+        "throughput": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+@contextlib.contextmanager
+def stubbed_app(db):
+    """The app on `db`, with model calls answered locally so runs stay offline."""
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(mock.patch.object(app_module, "db", db))
+        stack.enter_context(mock.patch.object(user_module, "db", db))
+        stack.enter_context(
+            mock.patch.object(
+                ai_jobs, "generate", lambda prompt: "Spend less on the largest category."
+            )
+        )
+        stack.enter_context(
+            mock.patch.object(
+                ai_jobs, "stream", lambda prompt: iter(["Spend less ", "on rent."])
+            )
+        )
+        app_module.app.config["TESTING"] = True
+        yield app_module.app
+
+
+def benchmark(db, sizes, scenarios, requests, concurrency, seed=0, log=print):
+    """Seed and run every scenario at every size, returning the report dict."""
+    database = type(db.client).__module__.split(".")[0]
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "database": database,
+        "requests": requests,
+        "concurrency": concurrency,
+        "seed": seed,
+        "results": [],
+    }
+    if database == "mongomock" and concurrency > 1:
+        # its internal errors would be counted against the routes
+        report["note"] = f"mongomock is not thread-safe, ran on 1 thread instead of {concurrency}"
+        report["concurrency"] = concurrency = 1
+        log(report["note"])
+    with stubbed_app(db) as flask_app:
+        for size in sizes:
+            started = time.perf_counter()
+            email = seed_user(db, size, seed)
+            log(f"seeded {size} events in {time.perf_counter() - started:.1f}s")
+            for scenario in scenarios:
+                stats = run_scenario(
+                    flask_app, db, email, scenario, requests, concurrency, seed
+                )
+                report["results"].append(dict(size=size, scenario=scenario, **stats))
+                log(
+                    f"{size:>7} {scenario:<22} {stats['throughput']:>9} req/s  "
+                    f"p50 {stats['p50_ms']:>9} ms  p95 {stats['p95_ms']:>9} ms  "
+                    f"p99 {stats['p99_ms']:>9} ms  errors {stats['errors']}"
+                )
+            event_store.delete_user_events(db, email)
+            db.users.delete_many({"email": email})
+    return report
+
+
+def compare(report, baseline, log=print):
+    """Print the p50/p95 change of every result also present in `baseline`."""
+    previous = {(r["size"], r["scenario"]): r for r in baseline["results"]}
+    log(f"compared with {baseline.get('commit') or 'baseline'}:")
+    for result in report["results"]:
+        old = previous.get((result["size"], result["scenario"]))
+        if not old:
+            continue
+        changes = "  ".join(
+            f"{key.removesuffix('_ms')} {(result[key] - old[key]) / old[key]:+.0%}"
+            for key in ("p50_ms", "p95_ms", "throughput")
+            if old[key]
+        )
+        log(f"{result['size']:>7} {result['scenario']:<22} {changes}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=list(SIZES))
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=sorted(SCENARIOS), default=list(SCENARIOS)
+    )
+    parser.add_argument("--requests", type=int, default=200, help="per scenario and size")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--mongo-uri", help="run against this MongoDB instead of mongomock")
+    parser.add_argument("--mongo-db", default="theonepiece_benchmark")
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--baseline", help="earlier --output file to compare with")
+    args = parser.parse_args(argv)
+
+    if args.mongo_uri:
+        db = MongoClient(args.mongo_uri)[args.mongo_db]
+    else:
+        db = mongomock.MongoClient()[args.mongo_db]
+    event_store.ensure_indexes(db)
+    rollups.ensure_indexes(db)
+
+    report = benchmark(
+        db, args.sizes, args.scenarios, args.requests, args.concurrency, args.seed
+    )
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
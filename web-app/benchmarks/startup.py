@@ -0,0 +1,238 @@
+"""
+Startup benchmark: app import time and worker memory
+
+Imports the app in fresh interpreters and reports the import time, the
+resident memory it leaves and whether the Gemini SDK got loaded. With
+--workers it also boots gunicorn with that many workers, with and without
+preload_app, and reads each process's RSS and PSS (resident memory with
+pages shared between processes split among them) from /proc once every
+worker answers. PSS shows what preloading saves, RSS counts shared pages
+in full for every process. Worker memory needs Linux and gunicorn.
+
+Results are printed and written as JSON; --baseline compares with an
+earlier run, e.g. one taken on the previous commit.
+
+    cd web-app
+    python -m benchmarks.startup --repeat 10 --workers 4 --output after.json
+    python -m benchmarks.startup --output after.json --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from benchmarks import git_commit
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import app
+seconds = time.perf_counter() - started
+rss_kb = None
+with open("/proc/self/status") as f:
+    for line in f:
+        if line.startswith("VmRSS:"):
+            rss_kb = int(line.split()[1])
+print(json.dumps({
+    "seconds": seconds,
+    "rss_kb": rss_kb,
+    "modules": len(sys.modules),
+    "gemini_sdk_loaded": "google.generativeai" in sys.modules,
+}))
+"""
+
+
+def measure_import(repeat):
+    """Median import time and memory of `import app` over fresh interpreters."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", IMPORT_PROBE],
+            cwd=APP_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    rss = [run["rss_kb"] for run in runs if run["rss_kb"] is not None]
+    return {
+        "import_ms": round(statistics.median(r["seconds"] for r in runs) * 1000, 1),
+        "import_ms_min": round(min(r["seconds"] for r in runs) * 1000, 1),
+        "rss_mb": round(statistics.median(rss) / 1024, 1) if rss else None,
+        "modules": runs[-1]["modules"],
+        "gemini_sdk_loaded": runs[-1]["gemini_sdk_loaded"],
+    }
+
+
+def _memory_kb(pid):
+    """(RSS, PSS) of a process in kB, PSS None where the kernel lacks it."""
+    rss = pss = None
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                rss = int(line.split()[1])
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            pss = sum(int(line.split()[1]) for line in f if line.startswith("Pss:"))
+    except OSError:
+        pass
+    return rss, pss
+
+
+def _children(pid):
+    children = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # the command name may hold spaces, the fields after it do not
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def measure_workers(workers, preload, timeout=60):
+    """Boot gunicorn and report boot time and per-process memory."""
+    port = _free_port()
+    url = f"http://127.0.0.1:{port}/user/login"
+    metrics_dir = tempfile.mkdtemp(prefix="startup-benchmark-")
+    env = dict(
+        os.environ,
+        GUNICORN_PRELOAD="1" if preload else "0",
+        PROMETHEUS_MULTIPROC_DIR=metrics_dir,
+    )
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "gunicorn",
+            "--config", "gunicorn.conf.py",
+            "--workers", str(workers),
+            "--bind", f"127.0.0.1:{port}",
+            *(["--preload"] if preload else []),
+            "app:app",
+        ],
+        cwd=APP_DIR,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        # every worker has booted once there are that many, and one answers
+        while True:
+            if server.poll() is not None:
+                raise RuntimeError("gunicorn exited during startup")
+            if time.perf_counter() - started > timeout:
+                raise RuntimeError("gunicorn did not start in time")
+            try:
+                with urllib.request.urlopen(url, timeout=1):
+                    pass
+            except (OSError, urllib.error.URLError):
+                time.sleep(0.05)
+                continue
+            if len(_children(server.pid)) >= workers:
+                break
+            time.sleep(0.05)
+        boot_seconds = time.perf_counter() - started
+        # let the remaining workers finish importing before reading memory
+        for _ in range(workers * 4):
+            with urllib.request.urlopen(url, timeout=5):
+                pass
+        time.sleep(1)
+
+        master = _memory_kb(server.pid)
+        memory = [_memory_kb(pid) for pid in _children(server.pid)]
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    def mb(values):
+        values = [v for v in values if v is not None]
+        return round(statistics.fmean(values) / 1024, 1) if values else None
+
+    return {
+        "preload": preload,
+        "workers": len(memory),
+        "boot_ms": round(boot_seconds * 1000),
+        "master_rss_mb": mb([master[0]]),
+        "worker_rss_mb": mb([rss for rss, _ in memory]),
+        "worker_pss_mb": mb([pss for _, pss in memory]),
+        "total_pss_mb": mb([sum(p for _, p in memory if p is not None) + (master[1] or 0)]),
+    }
+
+
+def compare(report, baseline, log=print):
+    """Print the change of every number also present in `baseline`."""
+    log(f"compared with {baseline.get('commit') or 'baseline'}:")
+
+    def changes(new, old):
+        return "  ".join(
+            f"{key} {old[key]} -> {new[key]}"
+            for key, value in new.items()
+            if isinstance(value, (int, float))
+            and not isinstance(value, bool)
+            and isinstance(old.get(key), (int, float))
+        )
+
+    log(f"  import   {changes(report['import'], baseline['import'])}")
+    previous = {run["preload"]: run for run in baseline.get("gunicorn", [])}
+    for run in report.get("gunicorn", []):
+        if run["preload"] in previous:
+            label = "preload" if run["preload"] else "no preload"
+            log(f"  {label:<10} {changes(run, previous[run['preload']])}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--repeat", type=int, default=10, help="fresh imports to time")
+    parser.add_argument("--workers", type=int, default=0, help="also boot gunicorn")
+    parser.add_argument("--output", default="startup-results.json")
+    parser.add_argument("--baseline", help="earlier --output file to compare with")
+    args = parser.parse_args(argv)
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "import": measure_import(args.repeat),
+    }
+    print("import   " + "  ".join(f"{k} {v}" for k, v in report["import"].items()))
+    if args.workers:
+        report["gunicorn"] = []
+        for preload in (False, True):
+            run = measure_workers(args.workers, preload)
+            report["gunicorn"].append(run)
+            print("gunicorn " + "  ".join(f"{k} {v}" for k, v in run.items()))
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {args.output}")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,186 @@
+"""
+MongoDB connection
+
+One MongoClient per process, created on first use. Gunicorn forks its
+workers after importing the app, and a client must not be shared across a
+fork, so a process that finds a client made by its parent builds its own.
+`db` stands in for the application database and can be imported at module
+level as before; nothing connects until it is first used.
+
+Settings, read from the environment:
+- MONGO_URI, MONGO_DB: where to connect (database "theonepiece")
+- MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE: connections per process
+- MONGO_MAX_IDLE_TIME_MS: close pooled connections idle this long
+- MONGO_WAIT_QUEUE_TIMEOUT_MS: give up waiting for a free connection
+- MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS,
+  MONGO_SOCKET_TIMEOUT_MS: network timeouts
+- MONGO_READ_CONCERN: read concern level, e.g. "majority"
+- MONGO_WRITE_CONCERN: "majority" or a number of nodes
+- MONGO_WRITE_TIMEOUT_MS: limit on waiting for the write concern
+"""
+
 import os
-from pymongo import MongoClient
+import threading
+
+from pymongo import MongoClient, monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.write_concern import WriteConcern
+
+DB_NAME = os.getenv("MONGO_DB", "theonepiece")
+
+# MongoClient keyword, environment variable, default (None leaves pymongo's)
+CLIENT_SETTINGS = (
+    ("maxPoolSize", "MONGO_MAX_POOL_SIZE", 50),
+    ("minPoolSize", "MONGO_MIN_POOL_SIZE", 0),
+    ("maxIdleTimeMS", "MONGO_MAX_IDLE_TIME_MS", 60000),
+    ("waitQueueTimeoutMS", "MONGO_WAIT_QUEUE_TIMEOUT_MS", 5000),
+    ("serverSelectionTimeoutMS", "MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000),
+    ("connectTimeoutMS", "MONGO_CONNECT_TIMEOUT_MS", 5000),
+    ("socketTimeoutMS", "MONGO_SOCKET_TIMEOUT_MS", None),
+)
+
+_client = None
+_client_pid = None
+_database = None
+_lock = threading.Lock()
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """Connection pool counters of this process, across all servers."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.open = 0
+            self.in_use = 0
+            self.waiting = 0
+            self.checkouts = 0
+            self.checkout_failures = 0
+            self.pools_cleared = 0
+
+    def _add(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                setattr(self, name, getattr(self, name) + delta)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "open": self.open,
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "checkouts": self.checkouts,
+                "checkout_failures": self.checkout_failures,
+                "pools_cleared": self.pools_cleared,
+            }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._add(pools_cleared=1)
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add(open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add(open=-1)
+
+    def connection_check_out_started(self, event):
+        self._add(waiting=1)
+
+    def connection_check_out_failed(self, event):
+        self._add(waiting=-1, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._add(waiting=-1, in_use=1, checkouts=1)
+
+    def connection_checked_in(self, event):
+        self._add(in_use=-1)
+
+
+pool_stats = PoolStats()
+
+
+def client_options():
+    """MongoClient keyword arguments from the environment."""
+    options = {}
+    for keyword, variable, default in CLIENT_SETTINGS:
+        value = os.getenv(variable)
+        value = int(value) if value else default
+        if value is not None:
+            options[keyword] = value
+    return options
+
+
+def _concerns():
+    concerns = {}
+    level = os.getenv("MONGO_READ_CONCERN")
+    if level:
+        concerns["read_concern"] = ReadConcern(level)
+    w = os.getenv("MONGO_WRITE_CONCERN")
+    if w:
+        timeout = os.getenv("MONGO_WRITE_TIMEOUT_MS")
+        concerns["write_concern"] = WriteConcern(
+            w=int(w) if w.isdigit() else w, wtimeout=int(timeout) if timeout else None
+        )
+    return concerns
+
+
+def get_client():
+    """This process's MongoClient, created on first use and after a fork."""
+    global _client, _client_pid, _database
+    with _lock:
+        if _client is None or _client_pid != os.getpid():
+            # a client inherited from the parent is left alone, closing it
+            # here would tear down sockets the parent still uses
+            pool_stats.reset()
+            _client = MongoClient(
+                os.getenv("MONGO_URI"), event_listeners=[pool_stats], **client_options()
+            )
+            _client_pid = os.getpid()
+            _database = _client.get_database(DB_NAME, **_concerns())
+        return _client
+
+
+def get_db():
+    """The application database with the configured read and write concerns."""
+    if _client_pid != os.getpid():
+        get_client()
+    return _database
+
+
+def pool_status():
+    """Pool settings and counters of this process, for the readiness check."""
+    status = {"pid": os.getpid(), "connected": _client_pid == os.getpid()}
+    status.update(client_options())
+    status.update(pool_stats.snapshot())
+    return status
+
+
+class _LazyDatabase:
+    """Forwards to `get_db()` so the client is only made once it is needed."""
+
+    def __getattr__(self, name):
+        return getattr(get_db(), name)
+
+    def __getitem__(self, name):
+        return get_db()[name]
+
+    def __repr__(self):
+        return f"<lazy database {DB_NAME!r}>"
+
 
-# MongoDB connection
-mongo_uri = os.getenv("MONGO_URI")
-client = MongoClient(mongo_uri)
-db = client['theonepiece']
\ No newline at end of file
+db = _LazyDatabase()
@@ -0,0 +1,56 @@
+"""
+Gunicorn settings, picked up automatically from the working directory.
+
+The app is imported once in the master and the workers are forked from
+it (preload_app), so they share its memory and boot without importing
+anything themselves. Importing the app opens no MongoDB connection and
+starts no thread or gRPC channel: clients and pools are made per process
+on first use (database.py, user/passwords.py, user/ai_jobs.py) and the
+Gemini SDK is only imported by the first AI request of a worker. Set
+GUNICORN_PRELOAD=0 to import the app in every worker instead.
+
+Each worker serves up to GUNICORN_THREADS requests at once on gthread
+workers. The per-process limits on password hashing (PASSWORD_QUEUE_SIZE)
+and AI analysis (AI_QUEUE_SIZE) are set below that, so a burst fills
+them and gets a quick 503 while other requests still find a thread; with
+one request per process they could never fill.
+
+Workers share their Prometheus metrics through files in
+PROMETHEUS_MULTIPROC_DIR, which is emptied when gunicorn starts; a dead
+worker's files are folded into the totals by `child_exit`.
+"""
+
+import os
+import shutil
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/prometheus_multiproc")
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", "4"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+
+
+def on_starting(server):
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+def post_fork(server, worker):
+    import database
+
+    # catch a regression early: a client made before the fork is shared
+    # with every worker and must not be used by them
+    if database._client is not None:
+        server.log.warning(
+            "MongoClient created before fork in pid %s, each worker makes its own",
+            database._client_pid,
+        )
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,167 @@
+"""
+Prometheus metrics
+
+Times every request by route and counts responses by status, times each
+MongoDB command through pymongo's command monitoring, and times Gemini
+calls. `init_app` hooks the request timing into the app and serves the
+metrics at /metrics in the Prometheus text format.
+
+Under gunicorn every worker keeps its own counters. When
+PROMETHEUS_MULTIPROC_DIR is set (gunicorn.conf.py sets it) the workers
+write them to files in that directory and /metrics adds up all workers,
+whichever one answers the scrape.
+
+Setting SLOW_REQUEST_MS logs each request slower than that many
+milliseconds, with the database commands it ran, to the "slow_requests"
+logger.
+"""
+
+import contextlib
+import logging
+import os
+import time
+
+from flask import Response, g, has_request_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from pymongo import monitoring
+
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "0")) or None
+
+slow_log = logging.getLogger("slow_requests")
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent handling a request, by route",
+    ["method", "route"],
+)
+REQUESTS = Counter(
+    "http_requests_total",
+    "Requests answered, by route and status",
+    ["method", "route", "status"],
+)
+MONGO_LATENCY = Histogram(
+    "mongodb_command_duration_seconds",
+    "MongoDB command round trip time, by command and collection",
+    ["command", "collection"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+MONGO_FAILURES = Counter(
+    "mongodb_command_failures_total",
+    "MongoDB commands that failed, by command and collection",
+    ["command", "collection"],
+)
+GEMINI_LATENCY = Histogram(
+    "gemini_request_duration_seconds",
+    "Gemini call duration, by call and outcome",
+    ["call", "outcome"],
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120),
+)
+
+
+class CommandTimer(monitoring.CommandListener):
+    """Record the duration of every MongoDB command the process sends."""
+
+    def __init__(self):
+        self._pending = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore names its collection separately, admin commands have none
+            collection = event.command.get("collection", "")
+        self._pending[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, failed):
+        collection = self._pending.pop((event.connection_id, event.request_id), "")
+        seconds = event.duration_micros / 1e6
+        MONGO_LATENCY.labels(event.command_name, collection).observe(seconds)
+        if failed:
+            MONGO_FAILURES.labels(event.command_name, collection).inc()
+        if has_request_context() and "db_calls" in g:
+            g.db_calls.append((event.command_name, collection, seconds, failed))
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+command_timer = CommandTimer()
+# applies to every client created from now on, database.py makes its lazily
+monitoring.register(command_timer)
+
+
+@contextlib.contextmanager
+def time_gemini(call):
+    """Time a Gemini call, labelled ok, error or cancelled (client went away)."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    except GeneratorExit:
+        outcome = "cancelled"
+        raise
+    finally:
+        GEMINI_LATENCY.labels(call, outcome).observe(time.perf_counter() - start)
+
+
+def _route():
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+
+def _before_request():
+    g.request_started = time.perf_counter()
+    if SLOW_REQUEST_MS:
+        g.db_calls = []
+
+
+def _after_request(response):
+    started = g.pop("request_started", None)
+    if started is None:
+        return response
+    seconds = time.perf_counter() - started
+    route = _route()
+    REQUEST_LATENCY.labels(request.method, route).observe(seconds)
+    REQUESTS.labels(request.method, route, str(response.status_code)).inc()
+    if SLOW_REQUEST_MS and seconds * 1000 >= SLOW_REQUEST_MS:
+        calls = g.get("db_calls", [])
+        slow_log.warning(
+            "%s %s %s took %.0f ms, %d database calls:%s",
+            request.method,
+            request.full_path.rstrip("?"),
+            response.status_code,
+            seconds * 1000,
+            len(calls),
+            "".join(
+                f"\n  {command} {collection} {duration * 1000:.1f} ms"
+                + (" (failed)" if failed else "")
+                for command, collection, duration, failed in calls
+            ),
+        )
+    return response
+
+
+def metrics_view():
+    """All metrics in the Prometheus text format, summed over workers."""
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Time the app's requests and serve /metrics."""
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", metrics_view)
@@ -1,9 +1,37 @@
+import datetime
+import io
+import json
+import random
+import runpy
+import sys
+import threading
+import time
 import pytest
+import mongomock
+import numpy as np
 from unittest.mock import MagicMock, patch
 from flask_login import AnonymousUserMixin
 from flask import url_for
+from pymongo.errors import ServerSelectionTimeoutError
+import database
+import metrics
+import prometheus_client
 from app import app as flask_app
-from user.user import User
+from user.user import User, load_user
+from user import events as event_store
+from user import rollups
+from user import ai_jobs
+from user import ai_cache
+from user import prompt as prompt_builder
+from user import versions
+from user import passwords
+from user import analytics
+from user import recurring
+from user import suggestions
+from benchmarks import load as load_benchmark
+from benchmarks import analytics as analytics_benchmark
+from benchmarks import startup as startup_benchmark
+from app import create_app
 
 
 @pytest.fixture
@@ -37,6 +65,21 @@ def client(mock_db, monkeypatch):
         yield client
 
 
+@pytest.fixture
+def mongo_db(monkeypatch):
+    """Return an in-memory mongomock database patched into the app."""
+    mongo_db = mongomock.MongoClient().db
+    monkeypatch.setattr("app.db", mongo_db)
+    monkeypatch.setattr("user.user.db", mongo_db)
+    flask_app.config["TESTING"] = True
+    return mongo_db
+
+
+def real_user_logged_in():
+    """Return a real User so routes talk to the mongomock database."""
+    return User(email="testuser@example.com", firstname="Test", lastname="User")
+
+
 def mock_user_logged_in():
     """Return a mock logged-in user object."""
     user = MagicMock(spec=User)
@@ -48,6 +91,7 @@ def mock_user_logged_in():
         {"_id": "1", "Amount": 50, "Category": "Food", "Date": "2024-12-06", "Memo": "Dinner"},
         {"_id": "2", "Amount": 20, "Category": "Rent", "Date": "2024-12-07", "Memo": "Monthly"}
     ]
+    user.search_events.return_value = ([], 0, False)
     return user
 
 
@@ -208,17 +252,1410 @@ class TestUserBlueprintCoverage:
         data = response.get_json()
         assert len(data) == 2
 
-    @patch("flask_login.utils._get_user")
-    def test_user_analytics_data(self, mock_get_user, client):
-        mock_user = mock_user_logged_in()
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_user_analytics_data(self, _, mongo_db):
         # Ensure events have a common month "2024-12"
-        mock_user.get_events.return_value = [
-            {"_id": "1", "Amount": 50, "Category": "Food", "Date": "2024-12-06", "Memo": "Dinner"},
-            {"_id": "2", "Amount": 20, "Category": "Food", "Date": "2024-12-07", "Memo": "Monthly"}
-        ]
-        mock_get_user.return_value = mock_user
-        response = client.get("/user/analytics-data")
+        mongo_db.events.insert_many([
+            {"_id": "1", "user": "testuser@example.com", "Amount": 50, "Category": "Food", "Date": "2024-12-06", "Memo": "Dinner"},
+            {"_id": "2", "user": "testuser@example.com", "Amount": 20, "Category": "Food", "Date": "2024-12-07", "Memo": "Monthly"},
+        ])
+        rollups.rebuild(mongo_db)
+        response = flask_app.test_client().get("/user/analytics-data")
         assert response.status_code == 200
         data = response.get_json()
         # Data should contain "2024-12" key
         assert "2024-12" in data
+        assert data["2024-12"] == {"Food": 70}
+
+class TestEventCollection:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_add_and_filter_events(self, _, mongo_db):
+        with flask_app.test_client() as client:
+            client.post("/user/add-event", json={
+                "amount": 12.5, "category": "Food", "date": "2024-12-06", "memo": "Lunch"
+            })
+            client.post("/user/add-event", json={
+                "amount": 30, "category": "Phone", "date": "2024-12-07", "memo": "Bill"
+            })
+            response = client.get("/user/get-events?date=2024-12-06")
+        data = response.get_json()
+        assert [e["Memo"] for e in data] == ["Lunch"]
+        assert "user" not in data[0]
+        assert mongo_db.events.count_documents({"user": "testuser@example.com"}) == 2
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_edit_and_delete_only_touch_own_events(self, _, mongo_db):
+        mongo_db.events.insert_many([
+            {"_id": "a", "user": "testuser@example.com", "Amount": 5, "Category": "Food", "Date": "2024-12-06", "Memo": "Tea"},
+            {"_id": "b", "user": "other@example.com", "Amount": 7, "Category": "Food", "Date": "2024-12-06", "Memo": "Tea"},
+        ])
+        with flask_app.test_client() as client:
+            client.put("/user/edit-event/a", json={
+                "amount": 6, "category": "Food", "date": "2024-12-06", "memo": "Coffee"
+            })
+            client.delete("/user/delete-event/b")
+        assert mongo_db.events.find_one({"_id": "a"})["Memo"] == "Coffee"
+        assert mongo_db.events.find_one({"_id": "b"}) is not None
+
+    def test_search_events_escapes_regex(self, mongo_db):
+        event_store.insert_event(mongo_db, "u", {"_id": "a", "Amount": 5, "Category": "Food", "Date": "2024-12-06", "Memo": "Tea (large)"})
+        event_store.insert_event(mongo_db, "u", {"_id": "b", "Amount": 7, "Category": "Rent", "Date": "2024-12-07", "Memo": "Monthly"})
+        assert [e["_id"] for e in event_store.search_events(mongo_db, "u", "(LARGE")] == ["a"]
+        assert [e["_id"] for e in event_store.search_events(mongo_db, "u", "rent")] == ["b"]
+
+    def test_migrate_embedded_events(self, mongo_db):
+        mongo_db.users.insert_one({
+            "email": "testuser@example.com",
+            "events": [
+                {"_id": str(i), "Amount": i, "Category": "Food", "Date": "2024-12-06", "Memo": ""}
+                for i in range(5)
+            ],
+        })
+        assert event_store.migrate_embedded_events(mongo_db, batch_size=2) == (1, 5)
+        assert mongo_db.events.count_documents({"user": "testuser@example.com"}) == 5
+        assert "events" not in mongo_db.users.find_one({"email": "testuser@example.com"})
+        # a second run finds nothing left to move
+        assert event_store.migrate_embedded_events(mongo_db) == (0, 0)
+
+    def test_migrate_embedded_events_without_ids(self, mongo_db):
+        event = {"Amount": 5, "Category": "Food", "Date": "2024-12-06", "Memo": ""}
+        user = {"email": "testuser@example.com", "events": [event, dict(event)]}
+        mongo_db.users.insert_one(dict(user))
+        event_store.migrate_embedded_events(mongo_db)
+        # a run interrupted before the array was removed is started again
+        mongo_db.users.update_one({"email": user["email"]}, {"$set": {"events": user["events"]}})
+        assert event_store.migrate_embedded_events(mongo_db) == (1, 2)
+        assert mongo_db.events.count_documents({"user": user["email"]}) == 2
+
+    def test_migrate_embedded_events_updates_derived_data(self, mongo_db):
+        mongo_db.users.insert_one({
+            "email": "testuser@example.com",
+            "events": [{"_id": "a", "Amount": 5, "Category": "Food", "Date": "2024-12-06", "Memo": "Coffee"}],
+        })
+        event_store.migrate_embedded_events(mongo_db)
+        assert rollups.rebuild(mongo_db, fix=False) == []
+        assert [s["text"] for s in suggestions.suggest(mongo_db, "testuser@example.com", "cof")] == ["Coffee"]
+        assert versions.current(mongo_db, "testuser@example.com") == 1
+
+
+class TestLeanUserLoader:
+    def test_load_user_skips_events(self, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com", "password": "x", "firstname": "Test"})
+        mongo_db.events.insert_one(
+            {"_id": "a", "user": "testuser@example.com", "Amount": 5, "Category": "Food", "Date": "2024-12-06", "Memo": ""}
+        )
+        with patch.object(event_store, "find_events", wraps=event_store.find_events) as find_events:
+            loaded = load_user("testuser@example.com")
+            assert loaded.firstname == "Test"
+            assert loaded.password is None
+            find_events.assert_not_called()
+            # events are fetched once, on first access
+            assert [e["_id"] for e in loaded.events] == ["a"]
+            assert [e["_id"] for e in loaded.events] == ["a"]
+            assert find_events.call_count == 1
+
+    def test_load_user_unknown_email(self, mongo_db):
+        assert load_user("nobody@example.com") is None
+
+    @patch("flask_login.utils._get_user", side_effect=mock_user_logged_out)
+    def test_signup_duplicate_email_race(self, _, mongo_db):
+        mongo_db.users.create_index("email", unique=True)
+        with patch.object(User, "find_by_email", return_value=None):
+            with flask_app.test_client() as client:
+                form = {"email": "a@example.com", "password": "pw", "firstname": "A", "lastname": "B"}
+                assert client.post("/user/signup", data=form).status_code == 302
+                assert client.post("/user/signup", data=form).status_code == 200
+        assert mongo_db.users.count_documents({"email": "a@example.com"}) == 1
+
+
+def seed_events(mongo_db, dates, email="testuser@example.com"):
+    """Add one Food event per date through the event store, ids in insertion order."""
+    for i, d in enumerate(dates):
+        event_store.insert_event(mongo_db, email, {
+            "_id": f"{i:03d}", "Amount": i + 1, "Category": "Food", "Date": d, "Memo": f"m{i}"
+        })
+
+
+class TestGetEventsQuery:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_date_range_and_fields(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-11-30", "2024-12-01", "2024-12-15", "2024-12-31", "2025-01-01"])
+        with flask_app.test_client() as client:
+            response = client.get("/user/get-events?from=2024-12-01&to=2024-12-31&fields=Amount")
+        data = response.get_json()
+        assert [e["Date"] for e in data] == ["2024-12-01", "2024-12-15", "2024-12-31"]
+        assert set(data[0]) == {"_id", "Amount", "Date"}
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_cursor_pagination_descending(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-12-01", "2024-12-02", "2024-12-02", "2024-12-03", "2024-12-04"])
+        seen = []
+        url = "/user/get-events?order=desc&limit=2"
+        with flask_app.test_client() as client:
+            while url:
+                response = client.get(url)
+                seen += [e["_id"] for e in response.get_json()]
+                cursor = response.headers.get("X-Next-Cursor")
+                url = f"/user/get-events?order=desc&limit=2&cursor={cursor}" if cursor else None
+        assert seen == ["004", "003", "002", "001", "000"]
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_order_without_limit(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-01-03", "2024-01-01", "2024-01-02"])
+        with flask_app.test_client() as client:
+            ascending = client.get("/user/get-events").get_json()
+            descending = client.get("/user/get-events?order=desc").get_json()
+        assert [e["Date"] for e in ascending] == ["2024-01-01", "2024-01-02", "2024-01-03"]
+        assert [e["Date"] for e in descending] == ["2024-01-03", "2024-01-02", "2024-01-01"]
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_bad_parameters(self, _, mongo_db):
+        with flask_app.test_client() as client:
+            assert client.get("/user/get-events?cursor=nope").status_code == 400
+            # [1, 2] decodes, but cannot be compared with dates and ids
+            assert client.get("/user/get-events?cursor=WzEsMl0=").status_code == 400
+            assert client.get("/user/get-events?limit=0").status_code == 400
+            assert client.get("/user/get-events?fields=user").status_code == 400
+
+
+class TestMonthSummary:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_groups_by_day_and_category(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-2-5", "2024-02-05", "2024-02-20", "2024-12-05", "2024-1-31"])
+        event_store.update_event(mongo_db, "testuser@example.com", "002", {"Category": "Rent"})
+        with flask_app.test_client() as client:
+            response = client.get("/user/month-summary?year=2024&month=2")
+        data = response.get_json()
+        assert response.status_code == 200
+        assert sorted(data["days"]) == ["2024-02-05", "2024-02-20"]
+        assert data["days"]["2024-02-05"]["total"] == 3
+        assert [e["_id"] for e in data["days"]["2024-02-05"]["events"]] == ["000", "001"]
+        assert data["categories"] == {"Food": 3, "Rent": 3}
+        assert data["total"] == 6
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_requires_valid_month(self, _, mongo_db):
+        with flask_app.test_client() as client:
+            assert client.get("/user/month-summary?year=2024").status_code == 400
+            assert client.get("/user/month-summary?year=2024&month=13").status_code == 400
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_requires_year_with_dates(self, _, mongo_db):
+        recurring.create_rule(mongo_db, "testuser@example.com", recurring.parse_rule({"amount": 900, "start": "2024-01-01"}))
+        with flask_app.test_client() as client:
+            assert client.get("/user/month-summary?year=10000&month=1").status_code == 400
+            assert client.get("/user/month-summary?year=-3&month=1").status_code == 400
+
+
+class TestAnalyticsGranularity:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_granularities(self, _, mongo_db):
+        # amounts are 1, 2, 3, 4, 5
+        seed_events(mongo_db, ["2024-12-1", "2024-12-02", "2024-12-09", "2025-01-01", "2025-01-01"])
+        with flask_app.test_client() as client:
+            by_day = client.get("/user/analytics-data?granularity=day").get_json()
+            by_week = client.get("/user/analytics-data?granularity=week").get_json()
+            by_year = client.get("/user/analytics-data?granularity=year").get_json()
+        assert by_day["2024-12-01"] == {"Food": 1}
+        assert by_day["2025-01-01"] == {"Food": 9}
+        assert by_week == {"2024-W48": {"Food": 1}, "2024-W49": {"Food": 2}, "2024-W50": {"Food": 3}, "2025-W01": {"Food": 9}}
+        assert by_year == {"2024": {"Food": 6}, "2025": {"Food": 9}}
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_date_window(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-11-30", "2024-12-02", "2024-12-31", "2025-01-01"])
+        with flask_app.test_client() as client:
+            data = client.get("/user/analytics-data?from=2024-12-01&to=2024-12-31").get_json()
+            assert client.get("/user/analytics-data?granularity=hour").status_code == 400
+        assert data == {"2024-12": {"Food": 5}}
+
+
+class TestRollups:
+    def test_mutations_keep_rollups_in_step(self, mongo_db):
+        email = "testuser@example.com"
+        seed_events(mongo_db, ["2024-12-06", "2024-12-06", "2024-12-20"])  # amounts 1, 2, 3
+        event_store.update_event(mongo_db, email, "001", {"Amount": 10.0, "Category": "Rent"})
+        event_store.update_event(mongo_db, email, "002", {"Date": "2025-01-02"})
+        event_store.delete_event(mongo_db, email, "000")
+        totals = rollups.month_totals(mongo_db, email, 2024, 12)
+        assert totals == {"total": 10, "days": {"2024-12-06": 10}, "categories": {"Rent": 10}}
+        assert rollups.month_totals(mongo_db, email, 2025, 1)["total"] == 3
+        assert rollups.rebuild(mongo_db, fix=False) == []
+
+    def test_rebuild_reports_and_repairs_drift(self, mongo_db):
+        email = "testuser@example.com"
+        seed_events(mongo_db, ["2024-12-06", "2024-12-07"])
+        mongo_db.rollups.update_one({"_id": f"{email}|month|2024-12"}, {"$inc": {"total": 5}})
+        mongo_db.events.delete_one({"_id": "001"})  # bypasses the listeners
+        drift = rollups.rebuild(mongo_db, fix=False)
+        assert (f"{email}|month|2024-12", 1, 8) in drift
+        assert len(rollups.rebuild(mongo_db)) == len(drift)
+        assert rollups.rebuild(mongo_db, fix=False) == []
+        assert rollups.month_totals(mongo_db, email, 2024, 12)["days"] == {"2024-12-06": 1}
+
+    def test_account_deletion_clears_rollups(self, mongo_db):
+        seed_events(mongo_db, ["2024-12-06"])
+        event_store.delete_user_events(mongo_db, "testuser@example.com")
+        assert mongo_db.rollups.count_documents({}) == 0
+
+
+class TestSearchIndex:
+    def seed(self, mongo_db):
+        for event in [
+            {"_id": "a", "Amount": 5, "Category": "Food", "Date": "2024-12-06", "Memo": "green tea"},
+            {"_id": "b", "Amount": 50, "Category": "Entertainment", "Date": "2024-12-07", "Memo": "food festival"},
+            {"_id": "c", "Amount": 9, "Category": "Food", "Date": "2024-12-08", "Memo": "seafood"},
+            {"_id": "d", "Amount": 20, "Category": "Rent", "Date": "2024-12-09", "Memo": "green door"},
+        ]:
+            event_store.insert_event(mongo_db, "u", event)
+
+    def test_ranking_and_multiword(self, mongo_db):
+        self.seed(mongo_db)
+        assert [e["_id"] for e in event_store.search_events(mongo_db, "u", "food")] == ["c", "a", "b"]
+        assert [e["_id"] for e in event_store.search_events(mongo_db, "u", "GREEN tea")] == ["a"]
+        assert event_store.search_events(mongo_db, "u", "te")[0]["_id"] == "b"
+        assert "search_grams" not in event_store.search_events(mongo_db, "u", "door")[0]
+
+    def test_amount_and_date_filters(self, mongo_db):
+        self.seed(mongo_db)
+        found = event_store.search_events(mongo_db, "u", "food", min_amount=6, end="2024-12-07")
+        assert [e["_id"] for e in found] == ["b"]
+
+    def test_edit_reindexes_and_backfill(self, mongo_db):
+        self.seed(mongo_db)
+        event_store.update_event(mongo_db, "u", "d", {"Memo": "groceries"})
+        assert [e["_id"] for e in event_store.search_events(mongo_db, "u", "grocer")] == ["d"]
+        mongo_db.events.update_many({}, {"$unset": {"search_grams": ""}})
+        assert event_store.backfill_search_grams(mongo_db, batch_size=3) == 4
+        assert [e["_id"] for e in event_store.search_events(mongo_db, "u", "festival")] == ["b"]
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_search_page_is_paginated(self, _, mongo_db, monkeypatch):
+        monkeypatch.setattr("user.user.SEARCH_PAGE_SIZE", 2)
+        seed_events(mongo_db, ["2024-12-01", "2024-12-02", "2024-12-03"])
+        with flask_app.test_client() as client:
+            first = client.get("/user/search-events/food").get_data(as_text=True)
+            second = client.get("/user/search-events/food?page=2").get_data(as_text=True)
+        assert "3 results, page 1" in first and "Next" in first
+        assert "2024-12-01" in second and "Next" not in second
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_search_ranks_a_capped_projection(self, _, mongo_db, monkeypatch):
+        monkeypatch.setattr(event_store, "MAX_SEARCH_CANDIDATES", 3)
+        seed_events(mongo_db, ["2024-12-01", "2024-12-02", "2024-12-03", "2024-12-04"])
+        found = event_store.search_events(
+            mongo_db, "testuser@example.com", "m", fields=event_store.RANK_FIELDS, limit=3
+        )
+        assert [e["_id"] for e in found] == ["003", "002", "001"]
+        assert set(found[0]) == {"_id", "Category", "Date", "Memo"}
+
+        page, total, capped = real_user_logged_in().search_events(mongo_db, "m", offset=1, limit=1)
+        assert (total, capped) == (3, True)
+        assert page == [{"_id": "002", "Amount": 3, "Category": "Food", "Date": "2024-12-03", "Memo": "m2"}]
+        with flask_app.test_client() as client:
+            assert "3+ results" in client.get("/user/search-events/m").get_data(as_text=True)
+
+
+def wait_for_job(client, job_id, timeout=5):
+    """Poll an AI job until it leaves the queued/running states."""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        data = client.get(f"/user/ai-analysis/{job_id}").get_json()
+        if data["status"] not in ("queued", "running"):
+            return data
+        time.sleep(0.01)
+    raise AssertionError("job did not finish")
+
+
+class TestAiJobs:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_submit_and_poll(self, _, mongo_db, monkeypatch):
+        monkeypatch.setattr(ai_jobs, "generate", lambda prompt: f"tips for {prompt.count('on 2024-12-')} meals")
+        seed_events(mongo_db, ["2024-12-06", "2024-12-07"])
+        with flask_app.test_client() as client:
+            response = client.post("/user/ai-analysis")
+            assert response.status_code == 202
+            assert response.headers["Location"].endswith(response.get_json()["job_id"])
+            data = wait_for_job(client, response.get_json()["job_id"])
+        assert data == {"job_id": response.get_json()["job_id"], "status": "done", "analysis": "tips for 2 meals"}
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_dedups_in_flight_job_per_user(self, _, mongo_db, monkeypatch):
+        release = threading.Event()
+        monkeypatch.setattr(ai_jobs, "generate", lambda prompt: release.wait(5) and "ok")
+        seed_events(mongo_db, ["2024-12-06"])
+        with flask_app.test_client() as client:
+            first = client.post("/user/ai-analysis").get_json()
+            second = client.post("/user/ai-analysis").get_json()
+            release.set()
+            assert first["job_id"] == second["job_id"]
+            assert wait_for_job(client, first["job_id"])["analysis"] == "ok"
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_model_error_and_full_queue(self, _, mongo_db, monkeypatch):
+        def fail(prompt):
+            raise RuntimeError("quota exceeded")
+        monkeypatch.setattr(ai_jobs, "generate", fail)
+        seed_events(mongo_db, ["2024-12-06"])
+        with flask_app.test_client() as client:
+            job_id = client.post("/user/ai-analysis").get_json()["job_id"]
+            assert wait_for_job(client, job_id)["details"] == "quota exceeded"
+            monkeypatch.setattr(ai_jobs, "_slots", threading.BoundedSemaphore(1))
+            ai_jobs._slots.acquire()
+            response = client.post("/user/ai-analysis")
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+
+    def test_lost_job_times_out(self, mongo_db):
+        mongo_db.ai_jobs.insert_one({
+            "_id": "j", "user": "u", "status": "running", "active": True,
+            "created_at": time.time() - ai_jobs.AI_TIMEOUT - ai_jobs.GRACE - 1,
+        })
+        assert ai_jobs.get_job(mongo_db, "u", "j")["status"] == "error"
+        assert ai_jobs.get_job(mongo_db, "other", "j") is None
+
+
+class TestAiCache:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_repeat_analysis_is_served_from_cache(self, _, mongo_db, monkeypatch):
+        calls = []
+        monkeypatch.setattr(ai_jobs, "generate", lambda prompt: calls.append(prompt) or "save more")
+        seed_events(mongo_db, ["2024-12-06", "2024-12-07"])
+        with flask_app.test_client() as client:
+            job_id = client.post("/user/ai-analysis").get_json()["job_id"]
+            wait_for_job(client, job_id)
+            response = client.post("/user/ai-analysis")
+            assert response.status_code == 200
+            assert response.get_json() == {"status": "done", "analysis": "save more", "cached": True}
+            # new data means a new content address and a fresh model call
+            client.post("/user/add-event", json={"amount": 3, "category": "Food", "date": "2024-12-08", "memo": ""})
+            assert mongo_db.ai_cache.count_documents({}) == 0
+            response = client.post("/user/ai-analysis")
+            assert response.status_code == 202
+            wait_for_job(client, response.get_json()["job_id"])
+        assert len(calls) == 2
+        assert ai_cache.stats(mongo_db)["hits"] == 1
+        assert ai_cache.stats(mongo_db)["misses"] == 2
+
+    def test_size_bound_evicts_least_recently_used(self, mongo_db, monkeypatch):
+        monkeypatch.setattr(ai_cache, "AI_CACHE_MAX_ENTRIES", 2)
+        # timestamps are stored with millisecond precision
+        ai_cache.put(mongo_db, "u", "a", "A")
+        time.sleep(0.002)
+        ai_cache.put(mongo_db, "u", "b", "B")
+        time.sleep(0.002)
+        assert ai_cache.get(mongo_db, "a") == "A"  # b is now least recently used
+        time.sleep(0.002)
+        ai_cache.put(mongo_db, "u", "c", "C")
+        assert ai_cache.get(mongo_db, "b") is None
+        assert ai_cache.get(mongo_db, "a") == "A"
+
+    def test_key_depends_on_prompt_version(self):
+        assert ai_cache.cache_key(1, "x") == ai_cache.cache_key(1, "x")
+        assert ai_cache.cache_key(1, "x") != ai_cache.cache_key(2, "x")
+
+
+class TestPromptBuilder:
+    monthly = {
+        "2024-11": {"Food": 100.0, "Rent": 900.0},
+        "2024-12": {"Food": 150.5, "Phone": 40.0},
+    }
+    top_events = [
+        {"Category": "Rent", "Amount": 900.0, "Date": "2024-11-01", "Memo": "November"},
+        {"Category": "Food", "Amount": 80.0, "Date": "2024-12-24", "Memo": ""},
+    ]
+
+    def test_sections(self):
+        prompt, summary = prompt_builder.build_prompt(self.monthly, self.top_events)
+        assert prompt.endswith(summary)
+        assert summary.splitlines() == [
+            "Spending by category:",
+            "- Rent: $900.00",
+            "- Food: $250.50",
+            "- Phone: $40.00",
+            "Recent months:",
+            "- 2024-12: $190.50 (most on Food: $150.50)",
+            "- 2024-11: $1,000.00 (most on Rent: $900.00)",
+            "Most expensive items:",
+            "- Rent: $900.00 on 2024-11-01 (November)",
+            "- Food: $80.00 on 2024-12-24",
+        ]
+
+    def test_budget_truncates_deterministically(self):
+        monthly = {f"20{y:02d}-{m:02d}": {f"cat{m}": float(m * y)} for y in range(10, 24) for m in range(1, 13)}
+        first = prompt_builder.summarize(monthly, self.top_events * 50, max_chars=500)
+        second = prompt_builder.summarize(dict(reversed(list(monthly.items()))), self.top_events * 50, max_chars=500)
+        assert first == second
+        assert len(first) <= 500
+        assert "more not shown" in first
+        small = prompt_builder.summarize(self.monthly, self.top_events, max_chars=120)
+        assert small.splitlines()[-2:] == ["Recent months:", "- ... 2 more not shown"]
+
+    def test_recent_months_are_capped(self):
+        monthly = {f"2024-{m:02d}": {"Food": 1.0} for m in range(1, 13)}
+        monthly.update({f"2023-{m:02d}": {"Food": 1.0} for m in range(1, 13)})
+        assert len(prompt_builder.month_lines(monthly)) == prompt_builder.MAX_MONTHS
+        assert prompt_builder.month_lines(monthly)[0].startswith("- 2024-12")
+
+
+def parse_sse(body):
+    """Split a text/event-stream body into (event, data) pairs."""
+    messages = []
+    for block in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        messages.append((fields.get("event", "message"), json.loads(fields["data"])))
+    return messages
+
+
+class TestAiStreaming:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_streams_chunks_then_caches(self, _, mongo_db, monkeypatch):
+        def fake_stream(prompt):
+            yield "Spend "
+            yield "less on\nfood."
+        monkeypatch.setattr(ai_jobs, "stream", fake_stream)
+        seed_events(mongo_db, ["2024-12-06"])
+        with flask_app.test_client() as client:
+            response = client.get("/user/ai-analysis/stream")
+            assert response.mimetype == "text/event-stream"
+            messages = parse_sse(response.get_data(as_text=True))
+            assert messages == [
+                ("message", {"text": "Spend "}),
+                ("message", {"text": "less on\nfood."}),
+                ("done", {"cached": False}),
+            ]
+            again = parse_sse(client.get("/user/ai-analysis/stream").get_data(as_text=True))
+        assert again == [("message", {"text": "Spend less on\nfood."}), ("done", {"cached": True})]
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_disconnect_cancels_upstream(self, _, mongo_db, monkeypatch):
+        state = {"sent": 0, "closed": False}
+        def endless_stream(prompt):
+            try:
+                while True:
+                    state["sent"] += 1
+                    yield "tip "
+            finally:
+                state["closed"] = True
+        monkeypatch.setattr(ai_jobs, "stream", endless_stream)
+        seed_events(mongo_db, ["2024-12-06"])
+        with flask_app.test_client() as client:
+            response = client.get("/user/ai-analysis/stream", buffered=False)
+            chunks = response.response
+            next(iter(chunks))
+            response.close()
+        assert state["closed"]
+        assert state["sent"] < 5
+        assert mongo_db.ai_cache.count_documents({}) == 0
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_streams_share_the_job_admission(self, _, mongo_db, monkeypatch):
+        def endless_stream(prompt):
+            while True:
+                yield "tip "
+        monkeypatch.setattr(ai_jobs, "stream", endless_stream)
+        monkeypatch.setattr(ai_jobs, "_slots", threading.BoundedSemaphore(1))
+        seed_events(mongo_db, ["2024-12-06"])
+        with flask_app.test_client() as client:
+            first = client.get("/user/ai-analysis/stream", buffered=False)
+            next(iter(first.response))
+            # the same user's second stream is pointed at the one in flight
+            second = parse_sse(client.get("/user/ai-analysis/stream").get_data(as_text=True))
+            job = mongo_db.ai_jobs.find_one({"active": True})
+            assert second == [("job", {
+                "job_id": job["_id"], "status": "running", "location": f"/user/ai-analysis/{job['_id']}"
+            })]
+            # another user finds no slot left
+            with patch("flask_login.utils._get_user", return_value=User(email="other@example.com")):
+                event_store.insert_event(mongo_db, "other@example.com", {
+                    "_id": "other", "Amount": 1, "Category": "Food", "Date": "2024-12-06", "Memo": ""
+                })
+                busy = client.get("/user/ai-analysis/stream")
+            assert busy.status_code == 503 and busy.headers["Retry-After"] == "5"
+            first.close()
+        assert mongo_db.ai_jobs.find_one({"_id": job["_id"]})["status"] == "error"
+        assert ai_jobs._slots.acquire(blocking=False)
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_model_error_becomes_error_event(self, _, mongo_db, monkeypatch):
+        def failing_stream(prompt):
+            yield "Half"
+            raise RuntimeError("connection reset")
+        monkeypatch.setattr(ai_jobs, "stream", failing_stream)
+        seed_events(mongo_db, ["2024-12-06"])
+        with flask_app.test_client() as client:
+            messages = parse_sse(client.get("/user/ai-analysis/stream").get_data(as_text=True))
+        assert messages[-1] == ("error", {"error": "Unable to analyze data", "details": "connection reset"})
+
+
+class TestImportEvents:
+    csv_body = (
+        "Date,Amount,Category,Memo\n"
+        "2024-12-06,4.50,Food,Coffee\n"
+        "2024-12-06,4.50,Food,Coffee\n"
+        '2024-12-7,"$1,200.00",Rent,December\n'
+        "2024-12-32,3,Food,Bad day\n"
+        "2024-12-08,lots,Food,Bad amount\n"
+        "2024-12-09,2,,No category\n"
+    )
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_csv_upload_is_validated_and_idempotent(self, _, mongo_db, monkeypatch):
+        monkeypatch.setattr("user.transfer.IMPORT_BATCH_SIZE", 2)
+        with flask_app.test_client() as client:
+            def upload():
+                return client.post("/user/import-events", data={
+                    "file": (io.BytesIO(self.csv_body.encode()), "bank.csv"),
+                }, content_type="multipart/form-data").get_json()
+            first = upload()
+            second = upload()
+        assert first["imported"] == 3 and first["duplicates"] == 0
+        assert [e["row"] for e in first["errors"]] == [5, 6, 7]
+        assert second["imported"] == 0 and second["duplicates"] == 3
+        assert mongo_db.events.count_documents({"user": "testuser@example.com"}) == 3
+        assert mongo_db.events.find_one({"Memo": "December"})["Date"] == "2024-12-07"
+        assert rollups.month_totals(mongo_db, "testuser@example.com", 2024, 12)["total"] == 1209
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_jsonl_raw_body(self, _, mongo_db):
+        body = (
+            '{"date": "2024-12-06", "amount": 3, "category": "Food", "memo": "Tea"}\n'
+            "\n"
+            "not json\n"
+            '{"date": "2024-12-07", "amount": 9.5, "category": "Phone"}\n'
+        )
+        with flask_app.test_client() as client:
+            report = client.post("/user/import-events", data=body, content_type="application/x-ndjson").get_json()
+            assert client.post("/user/import-events", data="x", content_type="text/plain").status_code == 400
+        assert report == {"imported": 2, "duplicates": 0, "error_count": 1, "errors": [{"row": 3, "error": "invalid JSON"}]}
+        assert [e["Memo"] for e in event_store.search_events(mongo_db, "testuser@example.com", "tea")] == ["Tea"]
+
+
+class TestExportEvents:
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_csv_export_streams_and_round_trips(self, _, mongo_db, monkeypatch):
+        monkeypatch.setattr("user.transfer.EXPORT_BATCH_SIZE", 2)
+        seed_events(mongo_db, ["2024-12-03", "2024-12-01", "2024-12-02", "2025-01-01"])
+        with flask_app.test_client() as client:
+            response = client.get("/user/export-events?to=2024-12-31")
+            assert response.is_streamed
+            assert response.headers["Content-Disposition"] == "attachment; filename=expenses.csv"
+            body = response.get_data(as_text=True)
+            assert body.splitlines() == [
+                "date,amount,category,memo",
+                "2024-12-01,2,Food,m1",
+                "2024-12-02,3,Food,m2",
+                "2024-12-03,1,Food,m0",
+            ]
+            report = client.post("/user/import-events", data=body, content_type="text/csv").get_json()
+        assert report["imported"] == 3 and report["error_count"] == 0
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_jsonl_export(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-12-01", "2024-12-02"])
+        with flask_app.test_client() as client:
+            response = client.get("/user/export-events?format=jsonl&from=2024-12-02")
+            assert client.get("/user/export-events?format=xml").status_code == 400
+        assert response.mimetype == "application/x-ndjson"
+        assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == [
+            {"date": "2024-12-02", "amount": 2, "category": "Food", "memo": "m1"}
+        ]
+
+
+class TestBatchEvents:
+    def post(self, client, operations, ordered=True):
+        response = client.post("/user/batch-events", json={"ordered": ordered, "operations": operations})
+        return [(r["id"], r["status"]) for r in response.get_json()["results"]]
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_mixed_operations_in_one_bulk_write(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-12-01", "2024-12-02"])
+        event_store.insert_event(mongo_db, "other@example.com", {"_id": "theirs", "Amount": 1, "Category": "Food", "Date": "2024-12-01", "Memo": ""})
+        with flask_app.test_client() as client, patch.object(
+            mongo_db.events, "bulk_write", wraps=mongo_db.events.bulk_write
+        ) as bulk_write:
+            results = self.post(client, [
+                {"op": "add", "id": "new", "amount": 10, "category": "Rent", "date": "2024-12-05", "memo": "x"},
+                {"op": "edit", "id": "000", "amount": 7, "category": "Food", "date": "2024-12-01", "memo": "edited"},
+                {"op": "delete", "id": "001"},
+                {"op": "edit", "id": "new", "amount": 11, "category": "Rent", "date": "2024-12-05", "memo": "x"},
+                {"op": "delete", "id": "theirs"},
+            ], ordered=False)
+            assert bulk_write.call_count == 1
+        assert results == [("new", "ok"), ("000", "ok"), ("001", "ok"), ("new", "ok"), ("theirs", "not_found")]
+        assert mongo_db.events.find_one({"_id": "new"})["Amount"] == 11
+        assert mongo_db.events.find_one({"_id": "theirs"}) is not None
+        assert rollups.month_totals(mongo_db, "testuser@example.com", 2024, 12)["total"] == 18
+        assert rollups.rebuild(mongo_db, fix=False) == []
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_ordered_batch_stops_at_first_failure(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-12-01"])
+        with flask_app.test_client() as client:
+            results = self.post(client, [
+                {"op": "delete", "id": "000"},
+                {"op": "add", "id": "000", "amount": 1, "category": "Food", "date": "2024-12-01"},
+                {"op": "add", "id": "000", "amount": 1, "category": "Food", "date": "2024-12-01"},
+                {"op": "add", "amount": 2, "category": "Food", "date": "2024-12-02"},
+            ])
+            invalid = self.post(client, [
+                {"op": "add", "amount": "ten", "category": "Food", "date": "2024-12-02"},
+                {"op": "delete", "id": "000"},
+            ])
+        assert [status for _, status in results] == ["ok", "ok", "error", "skipped"]
+        assert [status for _, status in invalid] == ["invalid", "skipped"]
+        assert mongo_db.events.count_documents({}) == 1
+
+    @pytest.mark.parametrize("then_occurrence", [False, True])
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_ordered_batch_stops_at_not_found(self, _, mongo_db, then_occurrence):
+        rule = recurring.create_rule(mongo_db, "testuser@example.com", recurring.parse_rule(
+            {"amount": 30, "category": "Phone", "start": "2024-01-15", "end": "2024-02-15"}
+        ))
+        operations = [
+            {"op": "delete", "id": "missing"},
+            {"op": "add", "id": "new", "amount": 1, "category": "Food", "date": "2024-12-01"},
+        ]
+        if then_occurrence:
+            operations.append({"op": "delete", "id": f"{rule['_id']}:2024-02-15"})
+        with flask_app.test_client() as client:
+            results = self.post(client, operations)
+            unordered = self.post(client, operations[:2], ordered=False)
+        assert results == [("missing", "not_found"), ("new", "skipped")] + (
+            [(f"{rule['_id']}:2024-02-15", "skipped")] if then_occurrence else []
+        )
+        assert unordered == [("missing", "not_found"), ("new", "ok")]
+        assert mongo_db.recurring.find_one()["exceptions"] == []
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_rejects_malformed_payload(self, _, mongo_db):
+        with flask_app.test_client() as client:
+            assert client.post("/user/batch-events", json={"operations": []}).status_code == 400
+            assert client.post("/user/batch-events", data="nope").status_code == 400
+
+
+def loaded_user():
+    """The test user as the login manager loads it, data version included."""
+    return load_user("testuser@example.com")
+
+
+class TestConditionalGet:
+    @pytest.fixture
+    def user_doc(self, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com", "firstname": "Test"})
+
+    def test_version_bumps_after_derived_data(self, mongo_db, user_doc, monkeypatch):
+        calls = []
+
+        def spy(listener):
+            def wrapper(db, email, changes):
+                calls.append(listener)
+                return listener(db, email, changes)
+            return wrapper
+
+        monkeypatch.setattr(event_store, "_listeners", [spy(l) for l in event_store._listeners])
+        monkeypatch.setattr(event_store, "_publishers", [spy(l) for l in event_store._publishers])
+        seed_events(mongo_db, ["2024-01-01"])
+        assert calls[-1] is versions.record
+        assert {rollups.apply_changes, suggestions.apply_changes, recurring.forget_user} <= set(calls[:-1])
+
+    def test_version_bumps_once_per_change(self, mongo_db, user_doc):
+        seed_events(mongo_db, ["2024-01-01", "2024-01-02"])
+        assert versions.current(mongo_db, "testuser@example.com") == 2
+        event_store.apply_batch(mongo_db, "testuser@example.com", [
+            {"op": "delete", "id": "000"}, {"op": "delete", "id": "001"},
+        ], ordered=True)
+        assert versions.current(mongo_db, "testuser@example.com") == 3
+
+    @pytest.mark.parametrize("url", [
+        "/user/get-events?from=2024-01-01",
+        "/user/month-summary?year=2024&month=1",
+        "/user/analytics-data",
+    ])
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_not_modified_until_events_change(self, _, mongo_db, user_doc, url):
+        seed_events(mongo_db, ["2024-01-01"])
+        with flask_app.test_client() as client:
+            first = client.get(url)
+            assert first.status_code == 200
+            etag = first.headers["ETag"]
+            with patch.object(event_store, "iter_events", side_effect=AssertionError):
+                cached = client.get(url, headers={"If-None-Match": etag})
+            assert cached.status_code == 304
+            assert cached.data == b""
+
+            event_store.insert_event(mongo_db, "testuser@example.com", {
+                "_id": "new", "Amount": 5, "Category": "Rent", "Date": "2024-01-05", "Memo": ""
+            })
+            changed = client.get(url, headers={"If-None-Match": etag})
+        assert changed.status_code == 200
+        assert changed.headers["ETag"] != etag
+
+    def test_etag_differs_between_users(self):
+        assert versions.etag("a@example.com", 1) != versions.etag("b@example.com", 1)
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_errors_carry_no_etag(self, _, mongo_db, user_doc):
+        with flask_app.test_client() as client:
+            response = client.get("/user/analytics-data?granularity=decade")
+        assert response.status_code == 400
+        assert "ETag" not in response.headers
+
+
+class TestEventChanges:
+    @pytest.fixture
+    def user_doc(self, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com", "firstname": "Test"})
+
+    def changes(self, client, since):
+        return client.get(f"/user/events/changes?since={since}").get_json()
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_returns_only_changes_since_version(self, _, mongo_db, user_doc):
+        seed_events(mongo_db, ["2024-01-01", "2024-01-02", "2024-01-03"])
+        with flask_app.test_client() as client:
+            version = int(client.get("/user/month-summary?year=2024&month=1").headers["X-Data-Version"])
+            event_store.update_event(mongo_db, "testuser@example.com", "000", {"Memo": "lunch"})
+            event_store.delete_event(mongo_db, "testuser@example.com", "001")
+            data = self.changes(client, version)
+            caught_up = self.changes(client, data["version"])
+        assert version == 3
+        assert data["reset"] is False
+        assert data["version"] == 5
+        assert [(e["_id"], e["Memo"]) for e in data["events"]] == [("000", "lunch")]
+        assert data["deleted"] == ["001"]
+        assert caught_up == {"version": 5, "reset": False, "events": [], "deleted": []}
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_log_keeps_latest_change_per_event(self, _, mongo_db, user_doc):
+        seed_events(mongo_db, ["2024-01-01"])
+        for memo in ("a", "b", "c"):
+            event_store.update_event(mongo_db, "testuser@example.com", "000", {"Memo": memo})
+        assert mongo_db.event_changes.count_documents({}) == 1
+        with flask_app.test_client() as client:
+            data = self.changes(client, 1)
+        assert [e["Memo"] for e in data["events"]] == ["c"]
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_reset_when_log_cannot_answer(self, _, mongo_db, user_doc):
+        seed_events(mongo_db, ["2024-01-01", "2024-01-02"])
+        with flask_app.test_client() as client:
+            assert self.changes(client, 0)["reset"] is False
+            assert self.changes(client, 9)["reset"] is True
+            assert client.get("/user/events/changes").status_code == 400
+
+            assert versions.compact(mongo_db, datetime.timedelta(0)) == 2
+            assert self.changes(client, 1)["reset"] is True
+            assert self.changes(client, 2)["reset"] is False
+
+            event_store.delete_user_events(mongo_db, "testuser@example.com")
+            assert self.changes(client, 2)["reset"] is True
+        assert mongo_db.event_changes.count_documents({}) == 0
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_deleted_account_leaves_no_log(self, _, mongo_db, monkeypatch):
+        monkeypatch.setattr(passwords, "BCRYPT_ROUNDS", 4)
+        User.create_user(mongo_db, "testuser@example.com", "secret", "Test", "User")
+        seed_events(mongo_db, ["2024-01-01", "2024-01-02"])
+        with flask_app.test_client() as client:
+            client.post("/user/delete-acct", data={"email": "testuser@example.com", "password": "secret"})
+        assert mongo_db.users.count_documents({}) == 0
+        assert mongo_db.event_changes.count_documents({}) == 0
+
+        # a log left by events removed after their user is dropped as well
+        seed_events(mongo_db, ["2024-01-01"], email="gone@example.com")
+        mongo_db.event_changes.insert_one({"_id": "gone@example.com|000", "user": "gone@example.com"})
+        event_store.delete_user_events(mongo_db, "gone@example.com")
+        assert mongo_db.event_changes.count_documents({}) == 0
+
+    def test_changes_before_logging_are_not_replayed(self, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com", "data_version": 7})
+        seed_events(mongo_db, ["2024-01-01"])
+        result = versions.changes_since(mongo_db, "testuser@example.com", 5, 8)
+        assert result["reset"] is True
+        result = versions.changes_since(mongo_db, "testuser@example.com", 7, 8)
+        assert [e["_id"] for e in result["events"]] == ["000"]
+
+
+class TestDatabaseClient:
+    @pytest.fixture
+    def fresh_client(self, monkeypatch):
+        """Reset the process client and count MongoClient constructions."""
+        monkeypatch.setattr(database, "_client", None)
+        monkeypatch.setattr(database, "_client_pid", None)
+        monkeypatch.setattr(database, "_database", None)
+        factory = MagicMock(side_effect=lambda *args, **kwargs: mongomock.MongoClient())
+        monkeypatch.setattr(database, "MongoClient", factory)
+        return factory
+
+    def test_client_is_lazy_and_made_once_per_process(self, fresh_client, monkeypatch):
+        assert fresh_client.call_count == 0
+        database.db.users.insert_one({"email": "a@example.com"})
+        assert database.db.users.count_documents({}) == 1
+        assert fresh_client.call_count == 1
+
+        # a forked worker builds its own client instead of reusing the parent's
+        monkeypatch.setattr(database.os, "getpid", lambda: -1)
+        assert database.db.users.count_documents({}) == 0
+        assert fresh_client.call_count == 2
+
+    def test_settings_from_environment(self, fresh_client, monkeypatch):
+        monkeypatch.setenv("MONGO_MAX_POOL_SIZE", "7")
+        monkeypatch.setenv("MONGO_SOCKET_TIMEOUT_MS", "2500")
+        monkeypatch.setenv("MONGO_WRITE_CONCERN", "majority")
+        monkeypatch.setenv("MONGO_READ_CONCERN", "majority")
+        fresh_client.side_effect = None
+        database.get_client()
+        kwargs = fresh_client.call_args.kwargs
+        assert kwargs["maxPoolSize"] == 7
+        assert kwargs["socketTimeoutMS"] == 2500
+        assert kwargs["serverSelectionTimeoutMS"] == 5000
+        concerns = fresh_client.return_value.get_database.call_args.kwargs
+        assert concerns["write_concern"].document == {"w": "majority"}
+        assert concerns["read_concern"].level == "majority"
+
+    def test_pool_stats_track_checkouts(self):
+        stats = database.PoolStats()
+        stats.connection_created(None)
+        stats.connection_check_out_started(None)
+        stats.connection_checked_out(None)
+        stats.connection_check_out_started(None)
+        snapshot = stats.snapshot()
+        assert (snapshot["open"], snapshot["in_use"], snapshot["waiting"]) == (1, 1, 1)
+        stats.connection_check_out_failed(None)
+        stats.connection_checked_in(None)
+        snapshot = stats.snapshot()
+        assert (snapshot["in_use"], snapshot["waiting"], snapshot["checkout_failures"]) == (0, 0, 1)
+
+    def test_ready_reports_pool(self, mongo_db):
+        with flask_app.test_client() as client:
+            response = client.get("/ready")
+        assert response.status_code == 200
+        data = response.get_json()
+        assert data["database"] == "ok"
+        assert {"open", "in_use", "waiting", "maxPoolSize"} <= set(data["pool"])
+
+    def test_ready_fails_without_database(self, monkeypatch):
+        unreachable = MagicMock()
+        unreachable.command.side_effect = ServerSelectionTimeoutError("no servers")
+        monkeypatch.setattr("app.db", unreachable)
+        with flask_app.test_client() as client:
+            response = client.get("/ready")
+        assert response.status_code == 503
+        assert response.get_json()["database"].startswith("unavailable")
+
+
+class TestMetrics:
+    def sample(self, name, **labels):
+        return prometheus_client.REGISTRY.get_sample_value(name, labels) or 0
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_requests_counted_by_route_and_status(self, _, mongo_db):
+        labels = {"method": "GET", "route": "/user/analytics-data"}
+        ok = self.sample("http_requests_total", status="200", **labels)
+        bad = self.sample("http_requests_total", status="400", **labels)
+        timed = self.sample("http_request_duration_seconds_count", **labels)
+        with flask_app.test_client() as client:
+            client.get("/user/analytics-data")
+            client.get("/user/analytics-data?granularity=decade")
+            body = client.get("/metrics").get_data(as_text=True)
+        assert self.sample("http_requests_total", status="200", **labels) == ok + 1
+        assert self.sample("http_requests_total", status="400", **labels) == bad + 1
+        assert self.sample("http_request_duration_seconds_count", **labels) == timed + 2
+        assert "http_request_duration_seconds_bucket" in body
+
+    def command_event(self, kind, name, command=None, duration=0.002):
+        event = MagicMock(spec=["command_name", "command", "connection_id", "request_id", "duration_micros"])
+        event.command_name, event.command = name, command
+        event.connection_id, event.request_id = ("localhost", 27017), 42
+        event.duration_micros = duration * 1e6
+        getattr(metrics.command_timer, kind)(event)
+
+    def test_mongo_commands_timed_and_logged_for_slow_requests(self, monkeypatch, caplog):
+        monkeypatch.setattr(metrics, "SLOW_REQUEST_MS", 0.001)
+        before = self.sample("mongodb_command_duration_seconds_count", command="find", collection="events")
+        failures = self.sample("mongodb_command_failures_total", command="getMore", collection="events")
+
+        with caplog.at_level("WARNING", logger="slow_requests"):
+            with flask_app.test_request_context("/user/get-events?limit=5"):
+                metrics._before_request()
+                self.command_event("started", "find", {"find": "events", "filter": {}})
+                self.command_event("succeeded", "find")
+                self.command_event("started", "getMore", {"getMore": 1, "collection": "events"})
+                self.command_event("failed", "getMore")
+                metrics._after_request(flask_app.response_class("[]"))
+        assert self.sample("mongodb_command_duration_seconds_count", command="find", collection="events") == before + 1
+        assert self.sample("mongodb_command_failures_total", command="getMore", collection="events") == failures + 1
+        log = caplog.text
+        assert "GET /user/get-events?limit=5 200" in log
+        assert "2 database calls" in log and "find events 2.0 ms" in log and "(failed)" in log
+
+    def test_gemini_calls_timed_by_outcome(self):
+        before = self.sample("gemini_request_duration_seconds_count", call="generate", outcome="error")
+        model = MagicMock()
+        model.generate_content.side_effect = RuntimeError("quota")
+        with patch("user.ai_jobs._model", return_value=model):
+            with pytest.raises(RuntimeError):
+                ai_jobs.generate("prompt")
+        assert self.sample("gemini_request_duration_seconds_count", call="generate", outcome="error") == before + 1
+
+    def test_multiprocess_metrics_add_up_workers(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+        (tmp_path / "counter_1.db").touch()
+        with patch("metrics.multiprocess.MultiProcessCollector") as collector:
+            with flask_app.test_client() as client:
+                assert client.get("/metrics").status_code == 200
+        collector.assert_called_once()
+
+
+class TestLoadBenchmark:
+    def test_reports_every_size_and_scenario(self, mongo_db):
+        lines = []
+        scenarios = [
+            "get-events page", "get-events month", "search-events", "analytics-data week", "edit-event", "delete-event"
+        ]
+        # mongomock is not thread-safe, the benchmark falls back to one thread
+        report = load_benchmark.benchmark(mongo_db, [10, 50], scenarios, requests=6, concurrency=4, log=lines.append)
+        assert report["concurrency"] == 1 and lines[0] == report["note"]
+        assert [(r["size"], r["scenario"]) for r in report["results"]] == [
+            (size, scenario) for size in (10, 50) for scenario in scenarios
+        ]
+        for result in report["results"]:
+            assert result["requests"] == 6 and result["errors"] == 0
+            assert result["p50_ms"] <= result["p95_ms"] <= result["p99_ms"]
+        assert report["database"] == "mongomock"
+        # seeded users are removed and the app is back on its own database
+        assert mongo_db.users.count_documents({}) == 0
+        assert mongo_db.events.count_documents({}) == 0
+        assert ai_jobs.generate is not None and "benchmarks" not in ai_jobs.generate.__module__
+
+    def test_month_window_is_one_real_month(self):
+        windows = {load_benchmark.Requests(seed, "u").month_window() for seed in range(200)}
+        for start, end in windows:
+            assert start[:7] == end[:7] and start.endswith("-01")
+            event_store.day_key(end)
+        assert ("2024-02-01", "2024-02-29") in windows and ("2023-02-01", "2023-02-28") in windows
+
+    def test_compare_reports_relative_change(self):
+        result = {"size": 10, "scenario": "login", "p50_ms": 2.0, "p95_ms": 3.0, "throughput": 50.0}
+        old = dict(result, p50_ms=1.0, p95_ms=3.0, throughput=100.0)
+        lines = []
+        load_benchmark.compare({"results": [result]}, {"results": [old]}, log=lines.append)
+        assert lines[1].split() == ["10", "login", "p50", "+100%", "p95", "+0%", "throughput", "-50%"]
+
+
+class TestPasswordHashing:
+    @pytest.fixture
+    def cheap_rounds(self, monkeypatch):
+        monkeypatch.setattr(passwords, "BCRYPT_ROUNDS", 4)
+
+    def stored_hash(self, mongo_db):
+        return mongo_db.users.find_one({"email": "testuser@example.com"})["password"]
+
+    def test_hashes_at_configured_cost(self, mongo_db, cheap_rounds):
+        User.create_user(mongo_db, "testuser@example.com", "secret", "Test", "User")
+        assert passwords.rounds(self.stored_hash(mongo_db)) == 4
+        assert passwords.verify(self.stored_hash(mongo_db), "secret") == (True, None)
+
+    def test_login_rehashes_at_new_cost(self, mongo_db, cheap_rounds, monkeypatch):
+        User.create_user(mongo_db, "testuser@example.com", "secret", "Test", "User")
+        old_hash = self.stored_hash(mongo_db)
+        monkeypatch.setattr(passwords, "BCRYPT_ROUNDS", 5)
+
+        assert User.validate_login(mongo_db, "testuser@example.com", "wrong") is None
+        assert self.stored_hash(mongo_db) == old_hash
+
+        assert User.validate_login(mongo_db, "testuser@example.com", "secret") is not None
+        assert passwords.rounds(self.stored_hash(mongo_db)) == 5
+        assert User.validate_login(mongo_db, "testuser@example.com", "secret") is not None
+
+    @patch("flask_login.utils._get_user", side_effect=mock_user_logged_out)
+    def test_login_sheds_load_when_hashing_is_full(self, _, mongo_db, cheap_rounds, monkeypatch):
+        User.create_user(mongo_db, "testuser@example.com", "secret", "Test", "User")
+        full = threading.BoundedSemaphore(1)
+        full.acquire()
+        monkeypatch.setattr(passwords, "_slots", full)
+        with flask_app.test_client() as client:
+            response = client.post("/user/login", data={"email": "testuser@example.com", "password": "secret"})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "5"
+
+    def test_gunicorn_threads_can_fill_the_hashing_slots(self, monkeypatch, tmp_path):
+        # concurrent requests of one process are what fills the slots
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+        config = runpy.run_path("gunicorn.conf.py")
+        assert config["worker_class"] == "gthread"
+        assert config["threads"] > passwords.PASSWORD_QUEUE_SIZE
+
+    def test_slot_held_until_hash_finishes(self, monkeypatch):
+        slots = threading.BoundedSemaphore(1)
+        monkeypatch.setattr(passwords, "_slots", slots)
+        monkeypatch.setattr(passwords, "PASSWORD_TIMEOUT", 0.01)
+        release = threading.Event()
+        with pytest.raises(passwords.Busy):
+            passwords._run(release.wait)
+        # the abandoned hash still occupies the only slot
+        with pytest.raises(passwords.Busy):
+            passwords._run(lambda: None)
+        release.set()
+        for _ in range(100):
+            if slots.acquire(blocking=False):
+                slots.release()
+                break
+            time.sleep(0.01)
+        assert passwords._run(lambda: "done") == "done"
+
+
+class TestDateNormalization:
+    def test_day_key_formats(self):
+        for date in ("2024-02-05", "2024-2-5", "2024/02/05", "2024.2.5", "02/05/2024",
+                     "20240205", "2024-02-05T13:45:00Z", "2024-02-05 09:00",
+                     datetime.date(2024, 2, 5), datetime.datetime(2024, 2, 5, 23, 59)):
+            assert event_store.day_key(date) == "2024-02-05"
+        for date in ("", "soon", "2024-13-01", "2024-02-30", None):
+            with pytest.raises(ValueError):
+                event_store.day_key(date)
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_writes_store_canonical_dates(self, _, mongo_db):
+        with flask_app.test_client() as client:
+            added = client.post("/user/add-event", json={"amount": 5, "category": "Food", "date": "2024/3/7", "memo": "x"})
+            event_id = mongo_db.events.find_one({})["_id"]
+            assert client.put(f"/user/edit-event/{event_id}", json={"amount": 5, "category": "Food", "date": "03/09/2024", "memo": "x"}).status_code == 200
+            assert client.post("/user/add-event", json={"amount": 5, "category": "Food", "date": "soon", "memo": "x"}).status_code == 400
+            assert client.get("/user/get-events?from=2024/3/1").status_code == 200
+            assert client.get("/user/get-events?from=someday").status_code == 400
+            assert client.get("/user/analytics-data?to=never").status_code == 400
+        assert added.status_code in (200, 201)
+        assert [e["Date"] for e in mongo_db.events.find({})] == ["2024-03-09"]
+
+    def test_month_query_is_a_range(self):
+        assert event_store.month_query(2024, 2) == {"Date": {"$gte": "2024-02-01", "$lte": "2024-02-31"}}
+
+    def test_migration_is_resumable(self, mongo_db):
+        email = "testuser@example.com"
+        mongo_db.users.insert_one({"email": email})
+        mongo_db.events.insert_many([
+            {"_id": "a", "user": email, "Amount": 1, "Category": "Food", "Date": "2024-2-5", "Memo": ""},
+            {"_id": "b", "user": email, "Amount": 2, "Category": "Food", "Date": "2024/02/06", "Memo": ""},
+            {"_id": "c", "user": email, "Amount": 3, "Category": "Food", "Date": "2024-02-07", "Memo": ""},
+            {"_id": "d", "user": email, "Amount": 4, "Category": "Food", "Date": "whenever", "Memo": ""},
+        ])
+        assert event_store.normalize_dates(mongo_db, batch_size=1) == (2, 1)
+        dates = {e["_id"]: e["Date"] for e in mongo_db.events.find({})}
+        assert dates == {"a": "2024-02-05", "b": "2024-02-06", "c": "2024-02-07", "d": "whenever"}
+        assert versions.current(mongo_db, email) == 2
+        # a second run only finds the date it cannot read
+        assert event_store.normalize_dates(mongo_db) == (0, 1)
+
+
+class TestAnalytics:
+    def expenses(self, rows):
+        return analytics.Expenses.from_events(
+            {"_id": f"{i:03d}", "Date": d, "Amount": a, "Category": c} for i, (d, a, c) in enumerate(rows)
+        )
+
+    def test_skips_malformed_events(self):
+        expenses = self.expenses([
+            ("2024-01-02", 5, "Food"), ("2024-1-3", 1, "Food"), ("2024-01-03", None, "Food"),
+            ("2024-02-30", 1, "Food"), ("2024-01-01", 2, "Rent"), (None, 1, "Food"),
+        ])
+        assert expenses.ids.tolist() == ["004", "000"]
+        assert expenses.categories == ["Food", "Rent"]
+        assert expenses.codes.tolist() == [1, 0]
+
+    def test_rolling_averages_fill_quiet_days(self):
+        expenses = self.expenses([("2024-01-01", 7, "Food"), ("2024-01-03", 14, "Food")])
+        result = analytics.rolling_averages(expenses, windows=(2, 7))
+        assert result["days"] == ["2024-01-01", "2024-01-02", "2024-01-03"]
+        assert result["totals"] == [7, 0, 14]
+        assert result["averages"] == {"2": [7, 3.5, 7], "7": [7, 3.5, 7]}
+        assert analytics.rolling_averages(expenses, (2,), since="2024-01-02")["averages"] == {"2": [3.5, 7]}
+
+    def test_percentiles_match_numpy(self):
+        rng = random.Random(1)
+        rows = [("2024-01-01", round(rng.uniform(1, 100), 2), rng.choice("ABC")) for _ in range(200)]
+        result = analytics.category_percentiles(self.expenses(rows))
+        for category in "ABC":
+            amounts = [a for _, a, c in rows if c == category]
+            expected = np.round(np.percentile(amounts, analytics.PERCENTILES), 2).tolist()
+            assert [result[category][f"p{p}"] for p in analytics.PERCENTILES] == expected
+            assert result[category]["count"] == len(amounts)
+
+    def test_month_over_month_includes_quiet_months(self):
+        expenses = self.expenses([("2024-01-05", 10, "Food"), ("2024-03-01", 5, "Rent")])
+        rows = analytics.month_over_month(expenses)
+        assert [(r["month"], r["total"], r["change"], r["change_pct"]) for r in rows] == [
+            ("2024-01", 10, None, None), ("2024-02", 0, -10, -100), ("2024-03", 5, 5, None)
+        ]
+        assert rows[1]["categories"] == {"Food": {"total": 0, "change": -10}}
+
+    def test_outliers_per_category(self):
+        rows = [("2024-01-%02d" % (i + 1), 10 + i % 3, "Food") for i in range(10)]
+        rows += [("2024-01-20", 60, "Food"), ("2024-01-21", 60, "Rent")]
+        flagged = analytics.outliers(self.expenses(rows))
+        # Rent has too few expenses to judge
+        assert [(e["_id"], e["Category"], e["median"]) for e in flagged] == [("010", "Food", 11)]
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_endpoints(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-01-01", "2024-01-02", "2024-02-01"])
+        with flask_app.test_client() as client:
+            rolling = client.get("/user/analytics-rolling?windows=2&from=2024-01-02&to=2024-01-31").get_json()
+            percentiles = client.get("/user/analytics-percentiles").get_json()
+            changes = client.get("/user/analytics-changes?from=2024-01-01").get_json()
+            assert client.get("/user/analytics-outliers").get_json() == []
+            assert client.get("/user/analytics-rolling?windows=0").status_code == 400
+            assert client.get("/user/analytics-rolling?from=0001-01-05").status_code == 200
+            assert client.get("/user/analytics-outliers?threshold=-1").status_code == 400
+            assert client.get("/user/analytics-percentiles?from=soon").status_code == 400
+        # the day before `from` still feeds the first average
+        assert rolling == {"days": ["2024-01-02"], "totals": [2], "averages": {"2": [1.5]}}
+        assert percentiles["Food"]["count"] == 3 and percentiles["Food"]["p50"] == 2
+        assert [r["total"] for r in changes] == [3, 3]
+
+    def test_benchmark_agrees_with_loops(self):
+        results = analytics_benchmark.run(2000, repeat=1)
+        assert {r["statistic"] for r in results} == {
+            "to arrays", "month x category", "rolling averages", "percentiles", "outliers"
+        }
+
+
+class TestAppFactory:
+    def test_apps_are_independent(self):
+        other = create_app({"TESTING": True, "SECRET_KEY": "other"})
+        assert other is not flask_app and other.secret_key == "other"
+        assert {r.rule for r in other.url_map.iter_rules()} == {r.rule for r in flask_app.url_map.iter_rules()}
+
+    @patch("flask_login.utils._get_user", side_effect=mock_user_logged_out)
+    def test_menu_and_calendar_require_login(self, _, client):
+        assert client.get("/menu").status_code == 302
+        assert client.get("/calendar").status_code == 302
+
+    def test_import_skips_gemini_sdk(self):
+        result = startup_benchmark.measure_import(repeat=1)
+        assert result["gemini_sdk_loaded"] is False
+
+    def test_sdk_configured_once_on_first_use(self, monkeypatch):
+        sdk = MagicMock()
+        monkeypatch.setattr(ai_jobs, "_genai", None)
+        monkeypatch.setenv("GOOGLE_API_KEY", "key")
+        with patch.dict(sys.modules, {"google.generativeai": sdk}):
+            ai_jobs._model()
+            ai_jobs._model()
+        sdk.configure.assert_called_once_with(api_key="key")
+        assert sdk.GenerativeModel.call_count == 2
+
+
+class TestRecurring:
+    def dates(self, rule, start, end):
+        return [d.isoformat() for d in recurring.occurrence_dates(
+            rule, datetime.date.fromisoformat(start), datetime.date.fromisoformat(end))]
+
+    def test_occurrence_dates(self):
+        monthly = {"start": "2024-01-31", "end": None, "unit": "month", "every": 1}
+        assert self.dates(monthly, "2023-01-01", "2024-04-30") == ["2024-01-31", "2024-02-29", "2024-03-31", "2024-04-30"]
+        # a window far from the start is computed, not stepped to
+        assert self.dates(monthly, "2030-06-01", "2030-06-30") == ["2030-06-30"]
+        fortnightly = {"start": "2024-01-01", "end": "2024-02-01", "unit": "week", "every": 2}
+        assert self.dates(fortnightly, "2024-01-10", "2024-12-31") == ["2024-01-15", "2024-01-29"]
+        yearly = {"start": "2020-02-29", "unit": "year", "every": 1}
+        assert self.dates(yearly, "2021-01-01", "2024-12-31") == ["2021-02-28", "2022-02-28", "2023-02-28", "2024-02-29"]
+
+    def test_exceptions_and_overrides(self):
+        rule = {"_id": "r", "Amount": 10, "Category": "Phone", "Memo": "plan", "start": "2024-01-05",
+                "unit": "month", "every": 1, "exceptions": ["2024-02-05"],
+                "overrides": {"2024-03-05": {"Amount": 12}, "2024-05-05": {"Date": "2024-04-30"}}}
+        found = list(recurring.expand(rule, "2024-01-01", "2024-04-30"))
+        assert [(e["_id"], e["Date"], e["Amount"]) for e in found] == [
+            ("r:2024-01-05", "2024-01-05", 10), ("r:2024-03-05", "2024-03-05", 12),
+            ("r:2024-04-05", "2024-04-05", 10), ("r:2024-05-05", "2024-04-30", 10),
+        ]
+
+    @patch("flask_login.utils._get_user", side_effect=real_user_logged_in)
+    def test_occurrences_read_everywhere(self, _, mongo_db):
+        seed_events(mongo_db, ["2024-02-10", "2024-03-01"])
+        rule = {"amount": 500, "category": "Rent", "memo": "flat", "start": "2024-01-31", "end": "2024-03-31"}
+        with flask_app.test_client() as client:
+            rule_id = client.post("/user/recurring", json=rule).get_json()["_id"]
+            events = client.get("/user/get-events?from=2024-02-01&to=2024-03-31").get_json()
+            pages, url = [], "/user/get-events?order=desc&limit=2"
+            while url:
+                response = client.get(url)
+                pages.append([e["_id"] for e in response.get_json()])
+                cursor = response.headers.get("X-Next-Cursor")
+                url = f"/user/get-events?order=desc&limit=2&cursor={cursor}" if cursor else None
+            month = client.get("/user/month-summary?year=2024&month=2").get_json()
+            spending = client.get("/user/analytics-data").get_json()
+            page = client.get("/user/search-events/flat").get_data(as_text=True)
+        assert [(e["Date"], e.get("recurring")) for e in events] == [
+            ("2024-02-10", None), ("2024-02-29", rule_id), ("2024-03-01", None), ("2024-03-31", rule_id)
+        ]
+        assert pages == [[f"{rule_id}:2024-03-31", "001"], [f"{rule_id}:2024-02-29", "000"], [f"{rule_id}:2024-01-31"]]
+        assert month["days"]["2024-02-29"]["total"] == 500
+        assert month["total"] == 501 and month["categories"] == {"Food": 1, "Rent": 500}
+        assert spending["2024-01"] == {"Rent": 500} and spending["2024-03"] == {"Food": 2, "Rent": 500}
+        assert "2024-02-29" in page
+        # nothing was stored per occurrence
+        assert mongo_db.events.count_documents({}) == 2 and mongo_db.recurring.count_documents({}) == 1
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_editing_an_occurrence_stores_an_override(self, _, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com"})
+        with flask_app.test_client() as client:
+            rule_id = client.post("/user/recurring", json={
+                "amount": 30, "category": "Phone", "memo": "plan", "start": "2024-01-15", "end": "2024-03-15",
+            }).get_json()["_id"]
+            first = client.get("/user/get-events?from=2024-01-01&to=2024-03-31")
+            client.put(f"/user/edit-event/{rule_id}:2024-02-15",
+                       json={"amount": 45, "category": "Phone", "date": "2024-02-16", "memo": "roaming"})
+            client.delete(f"/user/delete-event/{rule_id}:2024-03-15")
+            second = client.get("/user/get-events?from=2024-01-01&to=2024-03-31",
+                                headers={"If-None-Match": first.headers["ETag"]})
+            assert client.delete(f"/user/recurring/{rule_id}").status_code == 200
+            assert client.get("/user/get-events").get_json() == []
+            assert client.post("/user/recurring", json={"amount": 1, "start": "soon"}).status_code == 400
+        assert second.status_code == 200
+        assert [(e["Date"], e["Amount"], e["Memo"]) for e in second.get_json()] == [
+            ("2024-01-15", 30, "plan"), ("2024-02-16", 45, "roaming")
+        ]
+        assert mongo_db.events.count_documents({}) == 0
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_batch_edits_and_deletes_occurrences(self, _, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com"})
+        seed_events(mongo_db, ["2024-01-01"])
+        rule = recurring.create_rule(mongo_db, "testuser@example.com", recurring.parse_rule(
+            {"amount": 30, "category": "Phone", "memo": "plan", "start": "2024-01-15", "end": "2024-03-15"}
+        ))
+        fields = {"amount": 45, "category": "Phone", "date": "2024-02-15", "memo": "roaming"}
+        with flask_app.test_client() as client:
+            results = client.post("/user/batch-events", json={"operations": [
+                dict(fields, op="edit", id=f"{rule['_id']}:2024-02-15"),
+                {"op": "delete", "id": f"{rule['_id']}:2024-03-15"},
+                {"op": "delete", "id": "000"},
+                {"op": "delete", "id": f"{rule['_id']}:2024-03-16"},
+                {"op": "delete", "id": f"{rule['_id']}:2024-01-15"},
+            ]}).get_json()["results"]
+            events = client.get("/user/get-events?to=2024-12-31").get_json()
+        assert [r["status"] for r in results] == ["ok", "ok", "ok", "not_found", "skipped"]
+        assert [(e["Date"], e["Memo"]) for e in events] == [("2024-01-15", "plan"), ("2024-02-15", "roaming")]
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_update_keeps_skipped_dates(self, _, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com"})
+        with flask_app.test_client() as client:
+            rule_id = client.post("/user/recurring", json={
+                "amount": 900, "category": "Rent", "start": "2024-01-01", "end": "2024-03-01",
+            }).get_json()["_id"]
+            client.delete(f"/user/delete-event/{rule_id}:2024-02-01")
+            changed = client.put(f"/user/recurring/{rule_id}", json={
+                "amount": 950, "category": "Rent", "start": "2024-01-01", "end": "2024-03-01",
+            })
+            listed = client.get("/user/recurring").get_json()[0]
+            again = client.put(f"/user/recurring/{rule_id}", json=dict(listed, Amount=1000))
+            events = client.get("/user/get-events?to=2024-12-31").get_json()
+        assert changed.status_code == 200 and changed.get_json()["exceptions"] == ["2024-02-01"]
+        assert again.status_code == 200
+        assert [(e["Date"], e["Amount"]) for e in events] == [("2024-01-01", 1000), ("2024-03-01", 1000)]
+
+    def test_account_deletion_removes_rules(self, mongo_db):
+        email = "testuser@example.com"
+        recurring.create_rule(mongo_db, email, recurring.parse_rule({"amount": 900, "start": "2024-01-01"}))
+        event_store.delete_user_events(mongo_db, email)
+        assert mongo_db.recurring.count_documents({}) == 0
+        assert recurring.occurrences(mongo_db, email, "2024-01-01", "2024-12-31") == []
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_open_ended_reads_revalidate_the_next_day(self, _, mongo_db, monkeypatch):
+        mongo_db.users.insert_one({"email": "testuser@example.com"})
+        recurring.create_rule(mongo_db, "testuser@example.com", recurring.parse_rule(
+            {"amount": 100, "category": "Rent", "start": "2024-01-01", "unit": "day"}
+        ))
+        monkeypatch.setattr(recurring, "today", lambda: "2024-01-17")
+        with flask_app.test_client() as client:
+            first = client.get("/user/analytics-data")
+            bounded = client.get("/user/analytics-data?to=2024-01-31")
+            assert client.get("/user/analytics-data", headers={"If-None-Match": first.headers["ETag"]}).status_code == 304
+
+            monkeypatch.setattr(recurring, "today", lambda: "2024-01-25")
+            later = client.get("/user/analytics-data", headers={"If-None-Match": first.headers["ETag"]})
+            same = client.get("/user/analytics-data?to=2024-01-31", headers={"If-None-Match": bounded.headers["ETag"]})
+        assert first.get_json() == {"2024-01": {"Rent": 1700.0}}
+        assert later.status_code == 200 and later.get_json() == {"2024-01": {"Rent": 2500.0}}
+        assert same.status_code == 304
+
+    def test_rule_change_resets_delta_sync(self, mongo_db):
+        email = "testuser@example.com"
+        mongo_db.users.insert_one({"email": email})
+        seed_events(mongo_db, ["2024-01-01"])
+        version = versions.reset(mongo_db, email)
+        assert versions.changes_since(mongo_db, email, version - 1, version)["reset"] is True
+        assert versions.changes_since(mongo_db, email, version, version)["reset"] is False
+
+
+class TestSuggestions:
+    def add(self, mongo_db, event_id, date, category, memo):
+        event_store.insert_event(mongo_db, "u", {
+            "_id": event_id, "Amount": 1, "Category": category, "Date": date, "Memo": memo
+        })
+
+    def texts(self, mongo_db, prefix, **kwargs):
+        found = suggestions.suggest(mongo_db, "u", prefix, today=datetime.date(2024, 12, 31), **kwargs)
+        return [entry["text"] for entry in found]
+
+    def test_index_follows_adds_edits_and_deletes(self, mongo_db):
+        self.add(mongo_db, "a", "2024-12-01", "Food", "Starbucks  coffee")
+        self.add(mongo_db, "b", "2024-12-02", "Food", "coffee beans")
+        self.add(mongo_db, "c", "2024-12-03", "Fun", "cinema")
+        assert self.texts(mongo_db, "CO") == ["coffee beans", "Starbucks coffee"]
+        assert self.texts(mongo_db, "f") == ["Food", "Fun"]
+
+        event_store.update_event(mongo_db, "u", "b", {"Memo": "Cinema"})
+        event_store.delete_event(mongo_db, "u", "c")
+        event_store.apply_batch(mongo_db, "u", [{"op": "delete", "id": "a"}])
+        assert self.texts(mongo_db, "co") == []
+        entries = suggestions.suggest(mongo_db, "u", "c")
+        assert [(e["text"], e["field"], e["count"]) for e in entries] == [("Cinema", "Memo", 1)]
+        assert mongo_db.suggestions.count_documents({}) == 2
+
+        # `last` is not moved back by deletes, "Cinema" keeps the deleted event's date
+        stored = {doc.pop("_id"): doc for doc in mongo_db.suggestions.find()}
+        expected = suggestions.compute(mongo_db, "u")
+        assert stored["u|Memo|cinema"].pop("last") == "2024-12-03"
+        assert expected["u|Memo|cinema"].pop("last") == "2024-12-02"
+        assert expected == stored
+        event_store.delete_user_events(mongo_db, "u")
+        assert mongo_db.suggestions.count_documents({}) == 0
+
+    def test_ranking_weighs_frequency_and_recency(self, mongo_db):
+        for day in range(1, 5):
+            self.add(mongo_db, f"g{day}", f"2024-01-0{day}", "Groceries", "market")
+        self.add(mongo_db, "gym", "2024-12-30", "Gym", "")
+        self.add(mongo_db, "gift", "2024-12-20", "Gifts", "")
+        self.add(mongo_db, "gift2", "2024-12-21", "Gifts", "")
+        self.add(mongo_db, "big", "2024-12-21", "Fun", "big game")
+        # four uses a year ago weigh less than two last week, a later word ranks last
+        assert self.texts(mongo_db, "g") == ["Gifts", "Gym", "Groceries", "big game"]
+        assert self.texts(mongo_db, "g", limit=2, field="Category") == ["Gifts", "Gym"]
+        assert self.texts(mongo_db, "  ") == []
+
+    def test_rebuild_restores_the_index(self, mongo_db):
+        self.add(mongo_db, "a", "2024-12-01", "Food", "lunch")
+        mongo_db.suggestions.delete_many({})
+        mongo_db.events.insert_one({"_id": "x", "user": "u", "Category": "Food", "Date": "2024-12-09"})
+        assert suggestions.rebuild(mongo_db) == 2
+        food = mongo_db.suggestions.find_one({"text": "Food"})
+        assert (food["count"], food["last"]) == (2, "2024-12-09")
+
+    @patch("flask_login.utils._get_user", side_effect=loaded_user)
+    def test_suggest_route(self, _, mongo_db):
+        mongo_db.users.insert_one({"email": "testuser@example.com"})
+        seed_events(mongo_db, ["2024-12-06"])
+        with flask_app.test_client() as client:
+            found = client.get("/user/suggest?q=fo")
+            assert client.get("/user/suggest?q=fo&field=Amount").status_code == 400
+            assert client.get("/user/suggest?q=fo&limit=0").status_code == 400
+            cached = client.get("/user/suggest?q=fo", headers={"If-None-Match": found.headers["ETag"]})
+        assert found.status_code == 200 and cached.status_code == 304
+        assert [entry["text"] for entry in found.get_json()] == ["Food"]
@@ -0,0 +1,88 @@
+"""
+AI analysis cache
+
+Analyses are cached in the `ai_cache` collection under a hash of the
+prompt version and the normalized events summary the prompt is built
+from, so an unchanged history is only sent to Gemini once. Because the
+cache lives in the database it is shared by every gunicorn worker.
+
+- entries expire AI_CACHE_TTL seconds after they were written
+- at most AI_CACHE_MAX_ENTRIES are kept, least recently used go first
+- a user's entries are dropped whenever their events change
+- hits and misses are counted in the `ai_cache_stats` collection
+"""
+
+import datetime
+import hashlib
+import os
+
+from pymongo import ASCENDING
+
+from user import events as event_store
+
+AI_CACHE_TTL = int(os.getenv("AI_CACHE_TTL", str(7 * 24 * 3600)))
+AI_CACHE_MAX_ENTRIES = int(os.getenv("AI_CACHE_MAX_ENTRIES", "10000"))
+
+STATS_ID = "ai_cache"
+
+
+def ensure_indexes(db):
+    """Expire entries after the TTL and support LRU eviction and invalidation."""
+    db.ai_cache.create_index(
+        "created_at", name="expire_entries", expireAfterSeconds=AI_CACHE_TTL
+    )
+    db.ai_cache.create_index([("last_used", ASCENDING)], name="last_used")
+    db.ai_cache.create_index([("user", ASCENDING)], name="user")
+
+
+def cache_key(prompt_version, summary):
+    """Content address of an analysis."""
+    digest = hashlib.sha256(f"{prompt_version}\n{summary}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _now():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def _count(db, field):
+    db.ai_cache_stats.update_one({"_id": STATS_ID}, {"$inc": {field: 1}}, upsert=True)
+
+
+def get(db, key):
+    """The cached analysis for `key`, or None. Counts the hit or miss."""
+    entry = db.ai_cache.find_one_and_update(
+        {"_id": key}, {"$set": {"last_used": _now()}}, {"analysis": 1}
+    )
+    _count(db, "hits" if entry else "misses")
+    return entry["analysis"] if entry else None
+
+
+def put(db, email, key, analysis):
+    """Cache `analysis` under `key`, evicting the oldest entries past the limit."""
+    now = _now()
+    db.ai_cache.replace_one(
+        {"_id": key},
+        {"user": email, "analysis": analysis, "created_at": now, "last_used": now},
+        upsert=True,
+    )
+    excess = db.ai_cache.estimated_document_count() - AI_CACHE_MAX_ENTRIES
+    if excess > 0:
+        oldest = db.ai_cache.find({}, {"_id": 1}).sort("last_used", ASCENDING).limit(excess)
+        db.ai_cache.delete_many({"_id": {"$in": [entry["_id"] for entry in oldest]}})
+
+
+def stats(db):
+    """Hit and miss counters plus the number of cached entries."""
+    counters = db.ai_cache_stats.find_one({"_id": STATS_ID}) or {}
+    return {
+        "hits": counters.get("hits", 0),
+        "misses": counters.get("misses", 0),
+        "entries": db.ai_cache.estimated_document_count(),
+    }
+
+
+@event_store.on_change
+def invalidate(db, email, changes):
+    """Drop the user's cached analyses once their events change."""
+    db.ai_cache.delete_many({"user": email})
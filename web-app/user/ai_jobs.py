@@ -0,0 +1,289 @@
+"""
+AI analysis jobs
+
+Gemini calls are slow, so `/user/ai-analysis` no longer makes them inside
+the request. A request submits a job and returns at once; a small pool of
+background threads runs the model call and records the outcome in the
+`ai_jobs` collection, where any gunicorn worker can answer the client's
+poll.
+
+- the pool has AI_WORKERS threads and accepts at most AI_QUEUE_SIZE jobs
+  per process; past that, `submit` raises QueueFull
+- each user has at most one job in flight, a second submit returns it
+- a model call is cut off after AI_TIMEOUT seconds, and an in-flight job
+  older than that (its worker died) is reported as timed out
+
+`stream` is the streaming counterpart of `generate`. The Server-Sent
+Events endpoint runs it through `open_stream`, under the same admission
+control as jobs: a stream takes one of the AI_QUEUE_SIZE slots and is
+recorded as the user's in-flight job, so a second stream or job for the
+user gets that job back and its outcome can be polled like any other.
+
+The Gemini SDK is slow to import and starts gRPC threads, which must not
+be inherited across a fork, so it is imported and configured (from
+GOOGLE_API_KEY) by the first model call of each process.
+"""
+
+import datetime
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bson import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError
+
+import metrics
+
+MODEL_NAME = "gemini-1.5-pro"
+
+AI_WORKERS = int(os.getenv("AI_WORKERS", "2"))
+AI_QUEUE_SIZE = int(os.getenv("AI_QUEUE_SIZE", "8"))
+AI_TIMEOUT = float(os.getenv("AI_TIMEOUT", "60"))
+
+# finished jobs are removed by a TTL index after this long
+JOB_RETENTION = datetime.timedelta(days=1)
+
+# extra time a job may run past AI_TIMEOUT before it is considered lost
+GRACE = 10
+
+_genai = None
+_genai_lock = threading.Lock()
+
+_slots = threading.BoundedSemaphore(AI_QUEUE_SIZE)
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    """Raised when the job queue of this process is at capacity."""
+
+
+def ensure_indexes(db):
+    """One in-flight job per user, and expiry of old jobs."""
+    db.ai_jobs.create_index(
+        [("user", ASCENDING)],
+        name="one_active_job_per_user",
+        unique=True,
+        partialFilterExpression={"active": True},
+    )
+    db.ai_jobs.create_index("expires_at", name="expire_jobs", expireAfterSeconds=0)
+
+
+def _model():
+    """The Gemini model, importing and configuring the SDK on first use."""
+    global _genai
+    with _genai_lock:
+        if _genai is None:
+            import google.generativeai as genai
+
+            genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+            _genai = genai
+    return _genai.GenerativeModel(model_name=MODEL_NAME)
+
+
+def generate(prompt):
+    """Run `prompt` through Gemini and return the response text."""
+    model = _model()
+    with metrics.time_gemini("generate"):
+        response = model.generate_content(
+            prompt, request_options={"timeout": AI_TIMEOUT}
+        )
+        return response.text
+
+
+def stream(prompt):
+    """
+    Yield the model's response text chunk by chunk.
+
+    Closing the generator (the client disconnected) closes the upstream
+    response stream, so the model stops generating for nobody.
+    """
+    model = _model()
+    with metrics.time_gemini("stream"):
+        response = model.generate_content(
+            prompt, stream=True, request_options={"timeout": AI_TIMEOUT}
+        )
+        try:
+            for chunk in response:
+                yield chunk.text
+        finally:
+            upstream = getattr(response, "_iterator", None)
+            cancel = getattr(upstream, "cancel", None) or getattr(upstream, "close", None)
+            if cancel:
+                cancel()
+
+
+def _get_executor():
+    """The thread pool of this process, recreated after a fork."""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=AI_WORKERS, thread_name_prefix="ai-job"
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _finish(db, job_id, **fields):
+    fields.update(active=False, finished_at=time.time())
+    db.ai_jobs.update_one({"_id": job_id}, {"$set": fields})
+
+
+def _run(db, job_id, prompt, on_success):
+    try:
+        db.ai_jobs.update_one(
+            {"_id": job_id}, {"$set": {"status": "running", "started_at": time.time()}}
+        )
+        analysis = generate(prompt)
+        if on_success:
+            on_success(analysis)
+        _finish(db, job_id, status="done", analysis=analysis)
+    except Exception as e:
+        _finish(db, job_id, status="error", error=str(e))
+    finally:
+        _slots.release()
+
+
+def _expire_if_lost(db, job):
+    """Mark an in-flight job that outlived its timeout as failed."""
+    if job.get("active") and time.time() - job["created_at"] > AI_TIMEOUT + GRACE:
+        _finish(db, job["_id"], status="error", error="Analysis timed out")
+        job = db.ai_jobs.find_one({"_id": job["_id"]})
+    return job
+
+
+def _admit(db, email, status):
+    """
+    Record a new in-flight job for the user holding a queue slot.
+
+    Returns (job, created); when the user already has a job in flight
+    that job is returned with created False and no slot is taken. Raises
+    QueueFull when this process cannot take more.
+    """
+    existing = db.ai_jobs.find_one({"user": email, "active": True})
+    if existing and _expire_if_lost(db, existing).get("active"):
+        return existing, False
+
+    if not _slots.acquire(blocking=False):
+        raise QueueFull()
+    job = {
+        "_id": str(ObjectId()),
+        "user": email,
+        "status": status,
+        "active": True,
+        "created_at": time.time(),
+        "expires_at": datetime.datetime.now(datetime.timezone.utc) + JOB_RETENTION,
+    }
+    try:
+        db.ai_jobs.insert_one(job)
+    except DuplicateKeyError:
+        # another worker queued a job for this user first
+        _slots.release()
+        return db.ai_jobs.find_one({"user": email, "active": True}), False
+    return job, True
+
+
+def submit(db, email, prompt, on_success=None):
+    """
+    Queue `prompt` for the user, returning (job, created).
+
+    When the user already has a job in flight that job is returned with
+    created False. Raises QueueFull when this process cannot take more.
+    `on_success(analysis)` is called from the worker thread with the model
+    output before the job is marked done.
+    """
+    job, created = _admit(db, email, "queued")
+    if not created:
+        return job, False
+    try:
+        _get_executor().submit(_run, db, job["_id"], prompt, on_success)
+    except RuntimeError:
+        _slots.release()
+        _finish(db, job["_id"], status="error", error="Job queue is shutting down")
+        raise QueueFull()
+    return job, True
+
+
+class Stream:
+    """
+    A streaming job's model output, holding its queue slot until closed.
+
+    Iterating runs the model and yields its text chunks; a stream that
+    completes is stored as done, with its analysis, like a finished job.
+    `close` must be called in any case: it releases the slot and marks a
+    stream that did not complete as failed.
+    """
+
+    def __init__(self, db, job, prompt, on_success=None):
+        self.job = job
+        self._db = db
+        self._prompt = prompt
+        self._on_success = on_success
+        self._closed = False
+
+    def __iter__(self):
+        self._db.ai_jobs.update_one(
+            {"_id": self.job["_id"]}, {"$set": {"status": "running", "started_at": time.time()}}
+        )
+        chunks = []
+        upstream = stream(self._prompt)
+        try:
+            for chunk in upstream:
+                chunks.append(chunk)
+                yield chunk
+            analysis = "".join(chunks)
+            if self._on_success:
+                self._on_success(analysis)
+        except Exception as e:
+            self._release(status="error", error=str(e))
+            raise
+        finally:
+            upstream.close()
+        self._release(status="done", analysis=analysis)
+
+    def close(self):
+        self._release(status="error", error="Stream closed before it finished")
+
+    def _release(self, **fields):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            _finish(self._db, self.job["_id"], **fields)
+        finally:
+            _slots.release()
+
+
+def open_stream(db, email, prompt, on_success=None):
+    """
+    Admit a streamed run of `prompt` for the user, returning (job, stream).
+
+    `stream` is a Stream to iterate and close, or None when the user
+    already has a job in flight, which is returned instead. Raises
+    QueueFull when this process cannot take more.
+    """
+    job, created = _admit(db, email, "streaming")
+    if not created:
+        return job, None
+    return job, Stream(db, job, prompt, on_success)
+
+
+def get_job(db, email, job_id):
+    """The user's job with `job_id`, or None."""
+    job = db.ai_jobs.find_one({"_id": job_id, "user": email})
+    return _expire_if_lost(db, job) if job else None
+
+
+def public(job):
+    """The fields of a job returned to the client."""
+    result = {"job_id": job["_id"], "status": job["status"]}
+    if job["status"] == "done":
+        result["analysis"] = job.get("analysis")
+    elif job["status"] == "error":
+        result["error"] = "Unable to analyze data"
+        result["details"] = job.get("error")
+    return result
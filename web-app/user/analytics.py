@@ -0,0 +1,321 @@
+"""
+Spending analytics
+
+Loads a user's events once into parallel NumPy arrays (day, amount,
+category code) and computes every statistic with array operations rather
+than a Python loop per event:
+
+- rolling_averages:   daily spending and its trailing 7/30-day averages
+- category_percentiles: amount percentiles, count and mean per category
+- month_over_month:   monthly totals and their change, overall and per category
+- outliers:           unusually large expenses, by a robust z-score per category
+
+Grouping by category sorts the amounts once with the category as primary
+key, so every group is a contiguous slice whose quantiles are read off by
+index arithmetic. Only canonical YYYY-MM-DD dates (see events.day_key)
+and numeric amounts are analysed; anything else is skipped.
+"""
+
+import itertools
+
+import numpy as np
+
+from user import events as event_store
+from user import recurring
+
+ROLLING_WINDOWS = (7, 30)
+PERCENTILES = (25, 50, 75, 90, 99)
+
+# modified z-score above which an expense is flagged (Iglewicz and Hoaglin)
+OUTLIER_THRESHOLD = 3.5
+# categories with fewer expenses than this are too small to judge
+OUTLIER_MIN_COUNT = 8
+
+# scale a median / mean absolute deviation to a normal standard deviation
+MAD_SCALE = 1.4826
+MEAN_AD_SCALE = 1.2533
+
+ANALYSED_FIELDS = ("Date", "Amount", "Category")
+
+
+class Expenses:
+    """A user's expenses as parallel arrays, in date order."""
+
+    def __init__(self, ids, days, amounts, codes, categories):
+        self.ids = ids
+        self.days = days
+        self.amounts = amounts
+        self.codes = codes
+        self.categories = categories
+
+    def __len__(self):
+        return len(self.amounts)
+
+    @classmethod
+    def from_events(cls, events):
+        """Arrays of the events with a canonical date and a numeric amount."""
+        events = list(events)
+        columns = (
+            [event["_id"] for event in events],
+            [event.get("Date") for event in events],
+            [event.get("Amount") for event in events],
+            [event.get("Category") for event in events],
+        )
+        expenses = cls._from_columns(*columns)
+        if expenses is None:
+            # some legacy event is malformed, drop those one by one
+            valid = [_is_valid(date, amount) for date, amount in zip(*columns[1:3])]
+            columns = ([v for v, ok in zip(values, valid) if ok] for values in columns)
+            expenses = cls._from_columns(*columns)
+        return expenses
+
+    @classmethod
+    def _from_columns(cls, ids, dates, amounts, categories):
+        """The arrays, or None unless every date and amount is well formed."""
+        # numpy also reads "2024-02" as a day, only 10 character dates pass
+        if len(dates) and not (np.strings.str_len(np.array(dates, dtype=str)) == 10).all():
+            return None
+        try:
+            days = np.array(dates, dtype="datetime64[D]")
+        except (TypeError, ValueError):
+            return None
+        amounts = np.array(amounts)
+        if len(amounts) and amounts.dtype.kind not in "iuf":
+            return None
+
+        index = {}
+        codes = np.fromiter(
+            (index.setdefault(str(c), len(index)) for c in categories),
+            dtype=np.intp,
+            count=len(categories),
+        )
+        names = sorted(index)
+        rank = np.empty(len(names), dtype=np.intp)
+        rank[[index[name] for name in names]] = np.arange(len(names))
+
+        # everything below relies on date order, whatever order events came in
+        order = np.argsort(days, kind="stable")
+        return cls(
+            np.array(ids, dtype=object)[order],
+            days[order],
+            amounts.astype(np.float64)[order],
+            rank[codes][order] if len(codes) else codes,
+            names,
+        )
+
+
+def _is_valid(date, amount):
+    if not isinstance(date, str) or not event_store.CANONICAL_DATE.match(date):
+        return False
+    if not isinstance(amount, (int, float)) or isinstance(amount, bool):
+        return False
+    try:
+        np.datetime64(date, "D")
+    except ValueError:
+        return False
+    return True
+
+
+def load(db, email, start=None, end=None):
+    """The user's expenses and recurring occurrences in the optional window."""
+    events = event_store.iter_events(
+        db,
+        email,
+        event_store.date_query(start=start, end=end),
+        fields=ANALYSED_FIELDS,
+        sort=[("Date", 1), ("_id", 1)],
+    )
+    occurrences = recurring.occurrences(db, email, start, end)
+    return Expenses.from_events(itertools.chain(events, occurrences))
+
+
+def _rounded(values):
+    """Floats rounded to cents for JSON, NaN as None."""
+    values = np.round(values, 2)
+    return [None if np.isnan(v) else v for v in values.tolist()]
+
+
+def _groups(values, codes, size):
+    """
+    `values` sorted within each category, with each group's start and count.
+
+    Groups are contiguous in the result, group `c` being
+    sorted[starts[c] : starts[c] + counts[c]].
+    """
+    # by value, then stably by category: several times faster than np.lexsort
+    order = np.argsort(values)
+    order = order[np.argsort(codes[order], kind="stable")]
+    counts = np.bincount(codes, minlength=size)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    return values[order], starts, counts
+
+
+def _group_quantiles(ordered, starts, counts, q):
+    """
+    Linearly interpolated quantiles `q` (0-100) of every non-empty group.
+
+    Returns an array of shape (groups, len(q)), NaN for empty groups, the
+    same values np.percentile gives for each group on its own.
+    """
+    q = np.asarray(q, dtype=np.float64) / 100
+    present = counts > 0
+    position = (np.maximum(counts, 1)[:, None] - 1) * q[None, :]
+    lower = np.floor(position).astype(np.intp)
+    upper = np.ceil(position).astype(np.intp)
+    base = starts[:, None]
+    if len(ordered):
+        low = ordered[np.minimum(base + lower, len(ordered) - 1)]
+        high = ordered[np.minimum(base + upper, len(ordered) - 1)]
+    else:
+        low = high = np.zeros_like(position)
+    result = low + (high - low) * (position - lower)
+    result[~present] = np.nan
+    return result
+
+
+def rolling_averages(expenses, windows=ROLLING_WINDOWS, since=None):
+    """
+    Spending per calendar day and its trailing averages over `windows` days.
+
+    Days without spending count as zero. Near the start of the history an
+    average covers the days available. Only days from `since` (a
+    YYYY-MM-DD string) are returned, earlier ones still feed the averages.
+    """
+    result = {"days": [], "totals": [], "averages": {str(w): [] for w in windows}}
+    if not len(expenses):
+        return result
+
+    first = expenses.days[0]
+    offsets = (expenses.days - first).astype(np.int64)
+    size = int(offsets[-1]) + 1
+    daily = np.bincount(offsets, weights=expenses.amounts, minlength=size)
+    cumulative = np.concatenate(([0.0], np.cumsum(daily)))
+    index = np.arange(size)
+
+    keep = 0
+    if since:
+        keep = max(0, int((np.datetime64(since, "D") - first).astype(np.int64)))
+
+    result["days"] = (first + index[keep:]).astype(str).tolist()
+    result["totals"] = _rounded(daily[keep:])
+    for window in windows:
+        lower = np.maximum(index + 1 - window, 0)
+        averages = (cumulative[index + 1] - cumulative[lower]) / (index + 1 - lower)
+        result["averages"][str(window)] = _rounded(averages[keep:])
+    return result
+
+
+def category_percentiles(expenses, q=PERCENTILES):
+    """Count, total, mean and amount percentiles `q` of every category."""
+    if not len(expenses):
+        return {}
+    size = len(expenses.categories)
+    ordered, starts, counts = _groups(expenses.amounts, expenses.codes, size)
+    totals = np.bincount(expenses.codes, weights=expenses.amounts, minlength=size)
+    quantiles = _group_quantiles(ordered, starts, counts, q)
+
+    result = {}
+    for code, category in enumerate(expenses.categories):
+        stats = {
+            "count": int(counts[code]),
+            "total": round(float(totals[code]), 2),
+            "mean": round(float(totals[code] / counts[code]), 2),
+        }
+        stats.update(zip((f"p{p}" for p in q), _rounded(quantiles[code])))
+        result[category] = stats
+    return result
+
+
+def month_over_month(expenses):
+    """
+    Monthly totals, each with its change from the month before.
+
+    Returns one row per calendar month from the first to the last expense,
+    quiet months included: {"month", "total", "change", "change_pct",
+    "categories": {category: {"total", "change"}}}. The first month has no
+    change; change_pct is None when the previous month had no spending.
+    """
+    if not len(expenses):
+        return []
+    months = expenses.days.astype("datetime64[M]")
+    first = months[0]
+    offsets = (months - first).astype(np.int64)
+    size = int(offsets[-1]) + 1
+    width = len(expenses.categories)
+
+    grid = np.bincount(
+        offsets * width + expenses.codes, weights=expenses.amounts, minlength=size * width
+    ).reshape(size, width)
+    totals = grid.sum(axis=1)
+    change = np.diff(totals, prepend=np.nan)
+    previous = np.concatenate(([np.nan], totals[:-1]))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        change_pct = np.where(previous > 0, change / previous * 100, np.nan)
+    category_change = np.diff(grid, axis=0, prepend=np.full((1, width), np.nan))
+
+    # categories with no spending this month or the one before are left out
+    active = (grid != 0) | (np.nan_to_num(category_change) != 0)
+    labels = (first + np.arange(size)).astype(str).tolist()
+    totals, change, change_pct = _rounded(totals), _rounded(change), _rounded(change_pct)
+
+    rows = []
+    for month in range(size):
+        codes = np.flatnonzero(active[month])
+        rows.append(
+            {
+                "month": labels[month],
+                "total": totals[month],
+                "change": change[month],
+                "change_pct": change_pct[month],
+                "categories": {
+                    expenses.categories[code]: {"total": total, "change": delta}
+                    for code, total, delta in zip(
+                        codes.tolist(),
+                        _rounded(grid[month, codes]),
+                        _rounded(category_change[month, codes]),
+                    )
+                },
+            }
+        )
+    return rows
+
+
+def outliers(expenses, threshold=OUTLIER_THRESHOLD, min_count=OUTLIER_MIN_COUNT):
+    """
+    Expenses unusually large for their category, highest score first.
+
+    The score is a modified z-score: the distance above the category's
+    median amount in units of its median absolute deviation, scaled to
+    match a standard deviation (the mean absolute deviation stands in when
+    more than half the amounts are equal). Medians resist the very
+    outliers being looked for, unlike a mean and standard deviation.
+    """
+    if not len(expenses):
+        return []
+    size = len(expenses.categories)
+    codes, amounts = expenses.codes, expenses.amounts
+
+    ordered, starts, counts = _groups(amounts, codes, size)
+    median = _group_quantiles(ordered, starts, counts, [50])[:, 0]
+    deviation = np.abs(amounts - median[codes])
+    ordered, starts, counts = _groups(deviation, codes, size)
+    mad = _group_quantiles(ordered, starts, counts, [50])[:, 0]
+    mean_ad = np.bincount(codes, weights=deviation, minlength=size) / np.maximum(counts, 1)
+    scale = np.where(mad > 0, MAD_SCALE * mad, MEAN_AD_SCALE * mean_ad)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        score = np.where(scale[codes] > 0, (amounts - median[codes]) / scale[codes], 0.0)
+    flagged = np.flatnonzero((score > threshold) & (counts[codes] >= min_count))
+    flagged = flagged[np.argsort(-score[flagged], kind="stable")]
+
+    return [
+        {
+            "_id": expenses.ids[i],
+            "Date": str(expenses.days[i]),
+            "Amount": float(amounts[i]),
+            "Category": expenses.categories[codes[i]],
+            "median": round(float(median[codes[i]]), 2),
+            "score": round(float(score[i]), 2),
+        }
+        for i in flagged.tolist()
+    ]
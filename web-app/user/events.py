@@ -0,0 +1,625 @@
+"""
+Event storage
+
+Expense events are stored one document per event in the `events`
+collection instead of an array embedded in the user document. Each event
+keeps its string `_id` and the `Amount`, `Category`, `Date` and `Memo`
+fields the frontend already uses, plus a `user` field holding the owner's
+email. A compound index on (user, Date, _id) serves every per-user lookup
+and the keyset pagination of `/user/get-events`.
+
+For search, each event also stores `search_grams`, the trigrams of the
+words in its Category and Memo. A multikey index on (user, search_grams)
+narrows a search to the events containing every trigram of the query
+before the exact substring check runs.
+
+Every write goes through this module, which then calls the listeners
+registered with `on_change` so derived data (such as the spending rollups)
+is kept in step with the events.
+"""
+
+import base64
+import datetime
+import hashlib
+import itertools
+import json
+import re
+import time
+
+from bson import ObjectId
+from pymongo import (
+    ASCENDING,
+    DESCENDING,
+    DeleteOne,
+    InsertOne,
+    ReturnDocument,
+    UpdateOne,
+)
+from pymongo.errors import BulkWriteError
+
+EVENT_FIELDS = ("Amount", "Category", "Date", "Memo")
+
+GRANULARITIES = ("day", "week", "month", "year")
+
+# date spellings accepted by `day_key`, tried in order
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%m/%d/%Y", "%Y%m%d")
+
+# how every event Date is stored once normalized
+CANONICAL_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+# never send the owner or search fields back to the client
+PUBLIC_PROJECTION = {"user": 0, "search_grams": 0}
+
+SEARCHABLE_FIELDS = ("Category", "Memo")
+
+# what ranking a search match reads, the rest is fetched for its page only
+RANK_FIELDS = ("Category", "Date", "Memo")
+
+# search matches ranked per query, the newest ones when more match
+MAX_SEARCH_CANDIDATES = 1000
+
+_listeners = []
+_publishers = []
+
+
+def on_change(listener):
+    """
+    Register `listener(db, email, changes)` to run after events are written.
+
+    `changes` is a list of (before, after) event pairs, where `before` is
+    None for an insert and `after` is None for a delete. It is None when
+    all of the user's events were removed at once.
+    """
+    _listeners.append(listener)
+    return listener
+
+
+def after_change(listener):
+    """
+    Register a listener like `on_change` that runs after all of those.
+
+    For publishing a change, such as the data version bump that makes
+    cached reads stale: it must not happen before the derived data the
+    reads use has been updated, whatever order modules were imported in.
+    """
+    _publishers.append(listener)
+    return listener
+
+
+def notify(db, email, changes):
+    """Pass a batch of event changes to every registered listener."""
+    for listener in _listeners + _publishers:
+        listener(db, email, changes)
+
+
+def ensure_indexes(db):
+    """Create the indexes the event queries rely on."""
+    db.events.create_index(
+        [("user", ASCENDING), ("Date", ASCENDING), ("_id", ASCENDING)],
+        name="user_date_id",
+    )
+    db.events.create_index(
+        [("user", ASCENDING), ("search_grams", ASCENDING)],
+        name="user_search_grams",
+    )
+    db.events.create_index(
+        [("user", ASCENDING), ("Amount", DESCENDING)], name="user_amount"
+    )
+
+
+def search_grams(*texts):
+    """Sorted trigrams of every word in `texts`, lowercased."""
+    grams = set()
+    for text in texts:
+        for word in str(text or "").lower().split():
+            grams.update(word[i : i + 3] for i in range(len(word) - 2))
+    return sorted(grams)
+
+
+def _event_grams(event):
+    return search_grams(*(event.get(field) for field in SEARCHABLE_FIELDS))
+
+
+def insert_event(db, email, event):
+    """Insert a single event owned by `email`."""
+    doc = dict(canonical_date(event), user=email)
+    doc["search_grams"] = _event_grams(doc)
+    db.events.insert_one(doc)
+    notify(db, email, [(None, doc)])
+    return doc
+
+
+def insert_events_once(db, email, events):
+    """
+    Insert a batch of events with one bulk write, skipping ids already stored.
+
+    Each event must carry its `_id`; an event whose id exists is left as
+    is, so writing the same batch twice stores it once. Returns the list
+    of events that were newly inserted.
+    """
+    docs = []
+    for event in events:
+        doc = dict(canonical_date(event), user=email)
+        doc["search_grams"] = _event_grams(doc)
+        docs.append(doc)
+    if not docs:
+        return []
+    result = db.events.bulk_write(
+        [UpdateOne({"_id": d["_id"]}, {"$setOnInsert": d}, upsert=True) for d in docs],
+        ordered=False,
+    )
+    inserted = [docs[index] for index in sorted(result.upserted_ids)]
+    if inserted:
+        notify(db, email, [(None, doc) for doc in inserted])
+    return inserted
+
+
+def iter_events(db, email, query=None, fields=None, sort=None, limit=None):
+    """Cursor over the user's events matching `query`, optionally projected to `fields`."""
+    criteria = {"user": email}
+    if query:
+        criteria.update(query)
+    # a copy, the driver may not modify the shared constant under other requests
+    projection = {field: 1 for field in fields} if fields else dict(PUBLIC_PROJECTION)
+    cursor = db.events.find(criteria, projection)
+    if sort:
+        cursor = cursor.sort(sort)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def find_events(db, email, query=None, fields=None, sort=None, limit=None):
+    """Return the user's events matching `query`, optionally projected to `fields`."""
+    return list(iter_events(db, email, query, fields, sort, limit))
+
+
+def date_query(date=None, start=None, end=None, after=None, descending=False):
+    """
+    Build the filter for an exact `date` or an inclusive `start`/`end` range.
+
+    The dates may be in any form `day_key` accepts, a ValueError is raised
+    for one it does not. `after` is a decoded (Date, _id) cursor position;
+    only events sorting strictly after it in the requested order are
+    matched.
+    """
+    query = {}
+    if date:
+        query["Date"] = day_key(date)
+    else:
+        bounds = {}
+        if start:
+            bounds["$gte"] = day_key(start)
+        if end:
+            bounds["$lte"] = day_key(end)
+        if bounds:
+            query["Date"] = bounds
+    if after:
+        after_date, after_id = after
+        beyond = "$lt" if descending else "$gt"
+        query["$or"] = [
+            {"Date": {beyond: after_date}},
+            {"Date": after_date, "_id": {beyond: after_id}},
+        ]
+    return query
+
+
+def date_sort(descending=False):
+    """Sort order matching the (user, Date, _id) index."""
+    direction = DESCENDING if descending else ASCENDING
+    return [("Date", direction), ("_id", direction)]
+
+
+def encode_cursor(event):
+    """Opaque continuation token for the position of `event`."""
+    raw = json.dumps([event["Date"], event["_id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(token):
+    """Inverse of `encode_cursor`, raises ValueError on a malformed token."""
+    try:
+        after_date, after_id = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+    except (TypeError, ValueError, UnicodeError) as e:
+        raise ValueError("invalid cursor") from e
+    # compared with stored dates and ids, which are strings
+    if not (isinstance(after_date, str) and isinstance(after_id, str)):
+        raise ValueError("invalid cursor")
+    return after_date, after_id
+
+
+def month_query(year, month):
+    """Filter matching every event dated in `month` of `year`, an index range."""
+    return {"Date": {"$gte": f"{year:04d}-{month:02d}-01", "$lte": f"{year:04d}-{month:02d}-31"}}
+
+
+def day_key(date):
+    """
+    Canonical YYYY-MM-DD key of a date, the form every event Date is stored in.
+
+    Accepts date and datetime objects and strings with unpadded parts
+    ("2024-1-5"), slashes or dots ("2024/01/05"), US order ("01/05/2024"),
+    no separators ("20240105") or a time after the date (ISO timestamps).
+    Raises ValueError for anything else, including days that do not exist.
+    """
+    if isinstance(date, datetime.datetime):
+        date = date.date()
+    if isinstance(date, datetime.date):
+        return date.isoformat()
+    text = re.split(r"[T ]", str(date).strip(), maxsplit=1)[0]
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).date().isoformat()
+        except ValueError:
+            continue
+    raise ValueError(f"unrecognized date {date!r}, use YYYY-MM-DD")
+
+
+def canonical_date(event):
+    """`event` with its Date, if it has one, rewritten by `day_key`."""
+    if event.get("Date"):
+        event = dict(event, Date=day_key(event["Date"]))
+    return event
+
+
+def summarize_month(events, totals):
+    """
+    Group a month of events by day, alongside the month's rollup `totals`.
+
+    Returns the month total, per-category totals and, for every day with
+    spending, its total and event list keyed by zero-padded date.
+    """
+    days = {}
+    for event in sorted(events, key=lambda e: (e["Date"], e["_id"])):
+        key = event["Date"]
+        day = days.setdefault(key, {"total": totals["days"].get(key, 0), "events": []})
+        day["events"].append(event)
+    return {
+        "total": totals["total"],
+        "categories": totals["categories"],
+        "days": days,
+    }
+
+
+def period_key(date, granularity):
+    """Bucket a date into its day, ISO week ("2024-W49"), month or year."""
+    day = day_key(date)
+    if granularity == "week":
+        iso_year, iso_week, _ = datetime.date.fromisoformat(day).isocalendar()
+        return f"{iso_year}-W{iso_week:02d}"
+    return day[: {"day": 10, "month": 7, "year": 4}[granularity]]
+
+
+def spending_by_period(db, email, granularity="month", start=None, end=None):
+    """
+    Total spending per period and category as {period: {category: amount}}.
+
+    The database filters to the date window and sums the events down to
+    one row per (date, category); only those rows are bucketed into
+    periods here, so the work depends on the window asked for rather than
+    on the number of events in the user's history.
+    """
+    match = date_query(start=start, end=end)
+    match["user"] = email
+    pipeline = [
+        {"$match": match},
+        {
+            "$group": {
+                "_id": {"date": "$Date", "category": "$Category"},
+                "total": {"$sum": "$Amount"},
+            }
+        },
+    ]
+    grouped = {}
+    for row in db.events.aggregate(pipeline):
+        try:
+            period = period_key(row["_id"]["date"], granularity)
+        except (AttributeError, ValueError):
+            continue  # undated or malformed event
+        categories = grouped.setdefault(period, {})
+        category = row["_id"]["category"]
+        categories[category] = categories.get(category, 0) + row["total"]
+    return dict(sorted(grouped.items()))
+
+
+def update_event(db, email, event_id, fields):
+    """Set `fields` on one of the user's events, returning the updated event."""
+    fields = canonical_date(fields)
+    text_fields = [f for f in SEARCHABLE_FIELDS if f in fields]
+    if len(text_fields) == len(SEARCHABLE_FIELDS):
+        fields["search_grams"] = _event_grams(fields)
+    before = db.events.find_one_and_update(
+        {"_id": event_id, "user": email},
+        {"$set": fields},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if before is None:
+        return None
+    after = dict(before, **fields)
+    if text_fields and "search_grams" not in fields:
+        # the other text field came from the stored event
+        after["search_grams"] = _event_grams(after)
+        db.events.update_one(
+            {"_id": event_id}, {"$set": {"search_grams": after["search_grams"]}}
+        )
+    notify(db, email, [(before, after)])
+    return after
+
+
+def delete_event(db, email, event_id):
+    """Remove one of the user's events, returning it."""
+    before = db.events.find_one_and_delete({"_id": event_id, "user": email})
+    if before is not None:
+        notify(db, email, [(before, None)])
+    return before
+
+
+def apply_batch(db, email, operations, ordered=True):
+    """
+    Apply add, edit and delete operations with a single bulk write.
+
+    Each operation is a dict with "op" ("add", "edit" or "delete"), "id"
+    (optional for add) and, for add and edit, the event "fields". Returns
+    one result per operation: {"id", "status"} where status is "ok",
+    "not_found", "error" (with an "error" message) or, after the first
+    failure of an ordered batch, "skipped".
+    """
+    targets = [o["id"] for o in operations if o["op"] != "add"]
+    state = {
+        doc["_id"]: doc
+        for doc in db.events.find({"_id": {"$in": targets}, "user": email})
+    } if targets else {}
+
+    results = []
+    requests = []  # (operation index, request, (before, after))
+    for index, operation in enumerate(operations):
+        event_id = operation.get("id") or str(ObjectId())
+        results.append({"id": event_id, "status": "ok"})
+        before = state.get(event_id)
+        if operation["op"] == "add":
+            after = dict(canonical_date(operation["fields"]), _id=event_id, user=email)
+            after["search_grams"] = _event_grams(after)
+            request = InsertOne(after)
+        elif before is None:
+            results[index]["status"] = "not_found"
+            if ordered:
+                # a failure like any other, nothing after it is applied
+                results += [
+                    {"id": o.get("id"), "status": "skipped"} for o in operations[index + 1 :]
+                ]
+                break
+            continue
+        elif operation["op"] == "edit":
+            fields = canonical_date(operation["fields"])
+            after = dict(before, **fields)
+            fields["search_grams"] = after["search_grams"] = _event_grams(after)
+            request = UpdateOne({"_id": event_id, "user": email}, {"$set": fields})
+        else:
+            after = None
+            request = DeleteOne({"_id": event_id, "user": email})
+        state[event_id] = after
+        requests.append((index, request, (before, after)))
+
+    failed = {}
+    if requests:
+        try:
+            db.events.bulk_write([r for _, r, _ in requests], ordered=ordered)
+        except BulkWriteError as e:
+            failed = {err["index"]: err.get("errmsg", "write failed") for err in e.details["writeErrors"]}
+
+    changes = []
+    first_failure = min(failed) if failed else None
+    for position, (index, _, change) in enumerate(requests):
+        if position in failed:
+            results[index].update(status="error", error=failed[position])
+        elif ordered and first_failure is not None and position > first_failure:
+            results[index]["status"] = "skipped"
+        else:
+            changes.append(change)
+    if changes:
+        notify(db, email, changes)
+    return results
+
+
+def delete_user_events(db, email):
+    """Remove every event owned by `email`."""
+    result = db.events.delete_many({"user": email})
+    notify(db, email, None)
+    return result
+
+
+def search_events(
+    db,
+    email,
+    query,
+    min_amount=None,
+    max_amount=None,
+    start=None,
+    end=None,
+    fields=None,
+    limit=None,
+):
+    """
+    Events whose Category or Memo contains every word of `query`, best first.
+
+    Matching is case-insensitive substring matching per word. Words of
+    three or more letters are narrowed through the trigram index; the
+    amount and date filters are applied in the same query. Results are
+    ranked by how strongly each word matches (whole category, whole memo
+    word, then substring), newest first within a rank.
+
+    With `limit` only the newest `limit` matches are read and ranked, so
+    a common or very short word costs the same on any history; `fields`
+    projects them, RANK_FIELDS is enough to rank.
+    """
+    words = query.lower().split()
+    criteria = date_query(start=start, end=end)
+    amount = {}
+    if min_amount is not None:
+        amount["$gte"] = min_amount
+    if max_amount is not None:
+        amount["$lte"] = max_amount
+    if amount:
+        criteria["Amount"] = amount
+    grams = search_grams(*words)
+    if grams:
+        criteria["search_grams"] = {"$all": grams}
+    if words:
+        criteria["$and"] = [
+            {
+                "$or": [
+                    {field: {"$regex": re.escape(word), "$options": "i"}}
+                    for field in SEARCHABLE_FIELDS
+                ]
+            }
+            for word in words
+        ]
+
+    sort = date_sort(descending=True) if limit else None
+    return rank_matches(find_events(db, email, criteria, fields, sort, limit), words)
+
+
+def find_by_ids(db, email, ids):
+    """The user's events with `ids`, in that order, leaving out ids not found."""
+    found = {event["_id"]: event for event in find_events(db, email, {"_id": {"$in": list(ids)}})}
+    return [found[event_id] for event_id in ids if event_id in found]
+
+
+def rank_matches(matches, words):
+    """Sort search `matches` in place, best match for `words` first, and return them."""
+    matches.sort(key=lambda e: (_rank(e, words), e.get("Date") or ""), reverse=True)
+    return matches
+
+
+def _rank(event, words):
+    category = str(event.get("Category") or "").lower()
+    memo_words = str(event.get("Memo") or "").lower().split()
+    score = 0
+    for word in words:
+        if word == category:
+            score += 3
+        elif word in memo_words:
+            score += 2
+        else:
+            score += 1
+    return score
+
+
+def backfill_search_grams(db, batch_size=500):
+    """
+    Add `search_grams` to events written before search indexing existed.
+
+    Only events still missing the field are read, so the backfill can be
+    interrupted and resumed. Returns the number of events updated.
+    """
+    updated = 0
+    while True:
+        batch = list(
+            db.events.find(
+                {"search_grams": {"$exists": False}}, {f: 1 for f in SEARCHABLE_FIELDS}
+            ).limit(batch_size)
+        )
+        if not batch:
+            return updated
+        db.events.bulk_write(
+            [
+                UpdateOne({"_id": e["_id"]}, {"$set": {"search_grams": _event_grams(e)}})
+                for e in batch
+            ],
+            ordered=False,
+        )
+        updated += len(batch)
+
+
+def normalize_dates(db, batch_size=500, pause=0):
+    """
+    Rewrite event Dates not yet in canonical YYYY-MM-DD form.
+
+    Only such events are read, in batches of `batch_size`, so the
+    migration can be stopped and started again at any time. Each event is
+    updated on its own, and only if its Date is still the one that was
+    read, so a concurrent edit wins; `pause` seconds between batches leave
+    room for live traffic. Dates `day_key` cannot read are left as they
+    are. Returns an (updated, unreadable) tuple of event counts.
+    """
+    updated = unreadable = 0
+    cursor = (
+        db.events.find({"Date": {"$not": CANONICAL_DATE}}, {"search_grams": 0})
+        .sort("_id", ASCENDING)
+        .batch_size(batch_size)
+    )
+    try:
+        while True:
+            batch = list(itertools.islice(cursor, batch_size))
+            if not batch:
+                return updated, unreadable
+            requests = []
+            changes = {}
+            for event in batch:
+                try:
+                    date = day_key(event.get("Date"))
+                except ValueError:
+                    unreadable += 1
+                    continue
+                requests.append(
+                    UpdateOne(
+                        {"_id": event["_id"], "Date": event.get("Date")},
+                        {"$set": {"Date": date}},
+                    )
+                )
+                changes.setdefault(event["user"], []).append((event, dict(event, Date=date)))
+            if requests:
+                db.events.bulk_write(requests, ordered=False)
+                updated += len(requests)
+            for email, user_changes in changes.items():
+                notify(db, email, user_changes)
+            if pause:
+                time.sleep(pause)
+    finally:
+        cursor.close()
+
+
+def _embedded_id(email, position, doc):
+    content = json.dumps(
+        [email, position] + [doc[field] for field in EVENT_FIELDS], default=str
+    )
+    return "emb-" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:24]
+
+
+def migrate_embedded_events(db, batch_size=500):
+    """
+    Move events embedded in `users.events` into the events collection.
+
+    Events are upserted by `_id` in batches of `batch_size`, and a user's
+    array is only removed once all of its events have been written, so an
+    interrupted run can simply be started again. An event without an `_id`
+    gets one derived from its user, position and fields, the same on every
+    run. Newly stored events are passed to the change listeners like any
+    other insert. Returns a (users, events) tuple of how much was migrated.
+    """
+    users = moved = 0
+    cursor = db.users.find(
+        {"events.0": {"$exists": True}}, {"email": 1, "events": 1}
+    )
+    for user_doc in cursor:
+        email = user_doc["email"]
+        embedded = user_doc.get("events", [])
+        for start in range(0, len(embedded), batch_size):
+            docs = []
+            for position, event in enumerate(embedded[start : start + batch_size], start):
+                doc = {field: event.get(field) for field in EVENT_FIELDS}
+                doc["_id"] = event.get("_id") or _embedded_id(email, position, doc)
+                doc["user"] = email
+                doc["search_grams"] = _event_grams(doc)
+                docs.append(doc)
+            result = db.events.bulk_write(
+                [UpdateOne({"_id": d["_id"]}, {"$setOnInsert": d}, upsert=True) for d in docs],
+                ordered=False,
+            )
+            inserted = [docs[index] for index in sorted(result.upserted_ids)]
+            if inserted:
+                notify(db, email, [(None, doc) for doc in inserted])
+        db.users.update_one({"_id": user_doc["_id"]}, {"$unset": {"events": ""}})
+        users += 1
+        moved += len(embedded)
+    return users, moved
@@ -0,0 +1,105 @@
+"""
+Password hashing
+
+bcrypt is slow on purpose, so a burst of logins can keep every worker
+busy hashing. Hashes are computed on a small thread pool (bcrypt releases
+the GIL while it works) that accepts at most PASSWORD_QUEUE_SIZE hashes
+per process. Past that `Busy` is raised at once, and the routes answer
+503 rather than letting requests pile up behind the hashing. The limit
+only bites when a process serves several requests at once, as the
+gthread workers of gunicorn.conf.py do, so it is kept below their
+thread count.
+
+- BCRYPT_ROUNDS sets the cost of new hashes; a login whose stored hash
+  has another cost gets its password rehashed at the configured one
+- PASSWORD_WORKERS threads hash at a time
+- a request waits at most PASSWORD_TIMEOUT seconds for its hash
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from flask_bcrypt import Bcrypt
+
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", "2"))
+PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", "8"))
+PASSWORD_TIMEOUT = float(os.getenv("PASSWORD_TIMEOUT", "10"))
+
+bcrypt = Bcrypt()
+
+_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_SIZE)
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+class Busy(Exception):
+    """Raised when this process cannot take on more password hashing."""
+
+
+def _get_executor():
+    """The hashing pool of this process, recreated after a fork."""
+    global _executor, _executor_pid
+    with _lock:
+        if _executor is None or _executor_pid != os.getpid():
+            _executor = ThreadPoolExecutor(
+                max_workers=PASSWORD_WORKERS, thread_name_prefix="bcrypt"
+            )
+            _executor_pid = os.getpid()
+        return _executor
+
+
+def _run(function, *args):
+    """Run `function` on the pool and wait for it, raising Busy when full."""
+    if not _slots.acquire(blocking=False):
+        raise Busy()
+    try:
+        future = _get_executor().submit(function, *args)
+    except RuntimeError:
+        _slots.release()
+        raise Busy()
+    # the slot is held until the hash is done, even if the request gave up
+    future.add_done_callback(lambda _: _slots.release())
+    try:
+        return future.result(timeout=PASSWORD_TIMEOUT)
+    except TimeoutError:
+        raise Busy() from None
+
+
+def rounds(hashed):
+    """The cost factor of a bcrypt hash ("$2b$12$..."), None if unreadable."""
+    if not isinstance(hashed, str):
+        return None
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+def _hash(password):
+    return bcrypt.generate_password_hash(password, BCRYPT_ROUNDS).decode("utf-8")
+
+
+def _verify(hashed, password):
+    if not bcrypt.check_password_hash(hashed, password):
+        return False, None
+    cost = rounds(hashed)
+    rehashed = _hash(password) if cost is not None and cost != BCRYPT_ROUNDS else None
+    return True, rehashed
+
+
+def hash_password(password):
+    """A bcrypt hash of `password` at BCRYPT_ROUNDS."""
+    return _run(_hash, password)
+
+
+def verify(hashed, password):
+    """
+    Check `password` against `hashed`, returning (matches, new_hash).
+
+    `new_hash` is the password hashed at the configured cost when the
+    stored hash used another one, and None otherwise.
+    """
+    return _run(_verify, hashed, password)
@@ -0,0 +1,111 @@
+"""
+AI prompt builder
+
+Builds the budget-advice prompt from a summary of the user's spending
+rather than one line per event, so the prompt stays the same size however
+long the history is. The summary has three sections, in priority order:
+
+- spending per category over the whole history
+- monthly totals for the most recent MAX_MONTHS months
+- the TOP_N most expensive individual events
+
+The summary is cut to fit MAX_SUMMARY_CHARS. Lines are kept in a fixed
+order and a section that does not fit ends with a note of how many lines
+were left out, so the same data always produces the same prompt (and the
+same AI cache key).
+"""
+
+# bump whenever the prompt wording or summary format changes, so cached
+# analyses built from the old prompt are not reused
+PROMPT_VERSION = 2
+
+TOP_N = 10
+MAX_MONTHS = 12
+MAX_SUMMARY_CHARS = 4000
+
+INSTRUCTIONS = (
+    "Make sure to reference the specific event or event(s) by their memo or category when specifying tips.\n"
+    "Do not return any JSON or markdown. Only return plaintext plain-english responses.\n"
+    "When providing budget-saving tips, make sure to reference how much money they spent in that specific category or event.\n"
+    "Focus on giving suggestions to save costs on only the most expensive categories.\n"
+    "Provide budget-saving tips based on this summary of the user's spending. Be as concise as possible:\n\n"
+)
+
+
+def _money(amount):
+    return f"${amount:,.2f}"
+
+
+def category_lines(monthly):
+    """Whole-history total per category, largest first."""
+    totals = {}
+    for categories in monthly.values():
+        for category, amount in categories.items():
+            totals[category] = totals.get(category, 0) + amount
+    ranked = sorted(totals.items(), key=lambda item: (-item[1], str(item[0])))
+    return [f"- {category}: {_money(amount)}" for category, amount in ranked]
+
+
+def month_lines(monthly, max_months=MAX_MONTHS):
+    """Total and top category of each of the most recent months, newest first."""
+    lines = []
+    for month in sorted(monthly, reverse=True)[:max_months]:
+        categories = monthly[month]
+        top = min(categories.items(), key=lambda item: (-item[1], str(item[0])))
+        lines.append(
+            f"- {month}: {_money(sum(categories.values()))} (most on {top[0]}: {_money(top[1])})"
+        )
+    return lines
+
+
+def top_event_lines(top_events):
+    """One line per expensive event, in the order given."""
+    return [
+        f"- {event.get('Category')}: {_money(event.get('Amount') or 0)} on {event.get('Date')}"
+        + (f" ({event['Memo']})" if event.get("Memo") else "")
+        for event in top_events
+    ]
+
+
+def summarize(monthly, top_events, max_chars=MAX_SUMMARY_CHARS):
+    """
+    The spending summary text, at most `max_chars` long.
+
+    `monthly` is {"YYYY-MM": {category: amount}} and `top_events` the most
+    expensive events, largest first.
+    """
+    sections = [
+        ("Spending by category:", category_lines(monthly)),
+        ("Recent months:", month_lines(monthly)),
+        ("Most expensive items:", top_event_lines(top_events)),
+    ]
+    out = []
+    used = 0
+    for title, lines in sections:
+        if not lines or used + len(title) + 1 > max_chars:
+            continue
+        out.append(title)
+        used += len(title) + 1
+        for shown, line in enumerate(lines):
+            remaining = len(lines) - shown - 1
+            # keep room to say what was left out if a later line does not fit
+            reserve = len(_omitted(remaining)) + 1 if remaining else 0
+            if used + len(line) + 1 + reserve > max_chars:
+                note = _omitted(len(lines) - shown)
+                if used + len(note) + 1 <= max_chars:
+                    out.append(note)
+                    used += len(note) + 1
+                break
+            out.append(line)
+            used += len(line) + 1
+    return "\n".join(out)
+
+
+def _omitted(count):
+    return f"- ... {count} more not shown"
+
+
+def build_prompt(monthly, top_events, max_chars=MAX_SUMMARY_CHARS):
+    """Return (prompt, summary) for the model call and the cache key."""
+    summary = summarize(monthly, top_events, max_chars)
+    return INSTRUCTIONS + summary, summary
@@ -0,0 +1,382 @@
+"""
+Recurring expenses
+
+Rent, phone bills and other repeating expenses are stored once, as a rule
+in the `recurring` collection, instead of as one event per occurrence:
+
+    {"_id", "user", "Amount", "Category", "Memo",
+     "start": "YYYY-MM-DD", "end": "YYYY-MM-DD" or None,
+     "unit": "day" | "week" | "month" | "year", "every": 1,
+     "exceptions": [dates of skipped occurrences],
+     "overrides": {date: {fields changed for that occurrence}}}
+
+Occurrences are expanded on the fly, only within the date window a read
+asks for (up to today when it asks for no end), and are merged with the
+stored events by the User model. Each looks like an event with an `_id`
+of "<rule id>:<date>" and a `recurring` field naming its rule. Editing
+an occurrence stores an override and deleting it an exception; the rule
+itself is untouched.
+
+Monthly and yearly rules keep their day of the month, falling back to the
+last day of shorter months (a rule starting Jan 31 occurs Feb 29, Mar 31).
+
+Rules are not part of the spending rollups or the event change log: a
+rule change bumps the user's data version and tells delta-sync clients to
+reload (versions.reset). They are removed with the rest of the user's
+events when the account is deleted.
+"""
+
+import calendar
+import datetime
+import heapq
+
+from bson import ObjectId
+from pymongo import ASCENDING, ReturnDocument
+
+from user import events as event_store
+from user import versions
+
+UNITS = ("day", "week", "month", "year")
+
+# occurrence fields an override may change
+OVERRIDE_FIELDS = event_store.EVENT_FIELDS
+
+# separates the rule id from the occurrence date in an occurrence `_id`
+ID_SEPARATOR = ":"
+
+
+def ensure_indexes(db):
+    """Rules are always read per user."""
+    db.recurring.create_index([("user", ASCENDING)], name="user")
+
+
+def parse_rule(data):
+    """
+    A rule document from a JSON payload, raising ValueError if malformed.
+
+    Accepts amount, category, memo, start (required), end, every
+    (default 1), unit (default "month") and exceptions, the dates in any
+    form `events.day_key` reads. Amount, Category and Memo may also be
+    spelled as `list_rules` returns them. Exceptions are only part of the
+    result when the payload has them, so an update without them keeps
+    the dates already skipped.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("expected a JSON object")
+    for field in ("amount", "category", "memo"):
+        if field not in data and field.capitalize() in data:
+            data = dict(data, **{field: data[field.capitalize()]})
+    unit = data.get("unit") or "month"
+    if unit not in UNITS:
+        raise ValueError(f"unit must be one of {', '.join(UNITS)}")
+    every = int(data.get("every") or 1)
+    if every < 1:
+        raise ValueError("every must be a positive number")
+    start = event_store.day_key(data.get("start") or "")
+    end = event_store.day_key(data["end"]) if data.get("end") else None
+    if end is not None and end < start:
+        raise ValueError("end must not be before start")
+    rule = {
+        "Amount": float(data.get("amount")),
+        "Category": data.get("category"),
+        "Memo": data.get("memo"),
+        "start": start,
+        "end": end,
+        "unit": unit,
+        "every": every,
+    }
+    if "exceptions" in data:
+        rule["exceptions"] = sorted(
+            {event_store.day_key(d) for d in data["exceptions"] or ()}
+        )
+    return rule
+
+
+def occurrence_id(rule_id, date):
+    return f"{rule_id}{ID_SEPARATOR}{date}"
+
+
+def split_id(event_id):
+    """(rule id, date) of an occurrence id, None for a stored event's id."""
+    rule_id, separator, date = str(event_id).rpartition(ID_SEPARATOR)
+    if not separator or not rule_id:
+        return None
+    try:
+        return rule_id, event_store.day_key(date)
+    except ValueError:
+        return None
+
+
+def _add_months(date, months, day):
+    month_index = date.year * 12 + date.month - 1 + months
+    year, month = divmod(month_index, 12)
+    month += 1
+    return datetime.date(year, month, min(day, calendar.monthrange(year, month)[1]))
+
+
+def occurrence_dates(rule, start, end):
+    """
+    The rule's dates from `start` to `end` inclusive (datetime.date), in order.
+
+    The first date in the window is computed directly, not by stepping
+    from the rule's start, so expanding a short window of an old rule
+    costs only the occurrences inside it.
+    """
+    first = datetime.date.fromisoformat(rule["start"])
+    low = max(first, start)
+    high = min(datetime.date.fromisoformat(rule["end"]), end) if rule.get("end") else end
+    if low > high:
+        return
+    every = rule.get("every", 1)
+    unit = rule.get("unit", "month")
+
+    if unit in ("day", "week"):
+        step = every * (7 if unit == "week" else 1)
+        skip = -(-(low - first).days // step)  # steps up to the window, rounded up
+        date = first + datetime.timedelta(days=skip * step)
+        while date <= high:
+            yield date
+            date += datetime.timedelta(days=step)
+        return
+
+    step = every * (12 if unit == "year" else 1)
+    months = (low.year - first.year) * 12 + low.month - first.month
+    index = max(0, months // step)
+    date = _add_months(first, index * step, first.day)
+    while date <= high:
+        if date >= low:
+            yield date
+        index += 1
+        date = _add_months(first, index * step, first.day)
+
+
+def _occurs_on(rule, date):
+    day = datetime.date.fromisoformat(date)
+    return next(occurrence_dates(rule, day, day), None) is not None
+
+
+def _occurrence(rule, date):
+    occurrence = {
+        "_id": occurrence_id(rule["_id"], date),
+        "Amount": rule.get("Amount"),
+        "Category": rule.get("Category"),
+        "Date": date,
+        "Memo": rule.get("Memo"),
+        "recurring": rule["_id"],
+    }
+    occurrence.update(rule.get("overrides", {}).get(date, {}))
+    return occurrence
+
+
+def expand(rule, start, end):
+    """
+    Occurrences of `rule` dated from `start` to `end` (YYYY-MM-DD strings).
+
+    Skips exceptions and applies overrides, including one that moves an
+    occurrence into the window from a date outside it (or out of it).
+    """
+    exceptions = set(rule.get("exceptions", ()))
+    window = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+    for day in occurrence_dates(rule, *window):
+        date = day.isoformat()
+        if date in exceptions:
+            continue
+        occurrence = _occurrence(rule, date)
+        if start <= occurrence["Date"] <= end:
+            yield occurrence
+    for date, override in rule.get("overrides", {}).items():
+        moved_to = override.get("Date", date)
+        if (
+            start <= moved_to <= end
+            and not start <= date <= end
+            and date not in exceptions
+            and _occurs_on(rule, date)
+        ):
+            yield _occurrence(rule, date)
+
+
+def find_rules(db, email):
+    return list(db.recurring.find({"user": email}))
+
+
+def today():
+    """Where reads without an end date stop expanding, as YYYY-MM-DD."""
+    return datetime.date.today().isoformat()
+
+
+def window(start=None, end=None, date=None):
+    """The (start, end) window to expand for a read, open ends bounded."""
+    if date:
+        return date, date
+    # an open end stops at today, future occurrences are asked for explicitly
+    return start or "0001-01-01", end or today()
+
+
+def occurrences(db, email, start=None, end=None, date=None, rules=None):
+    """All the user's occurrences in the window, sorted by (Date, _id)."""
+    start, end = window(start, end, date)
+    if start > end:
+        return []
+    if rules is None:
+        rules = find_rules(db, email)
+    found = [o for rule in rules for o in expand(rule, start, end)]
+    found.sort(key=_sort_key)
+    return found
+
+
+def _sort_key(event):
+    return event["Date"], event["_id"]
+
+
+def _amount(event):
+    amount = event.get("Amount")
+    return amount if isinstance(amount, (int, float)) else 0
+
+
+def merge(events, extra, descending=False, after=None, fields=None, limit=None):
+    """
+    Stored `events` and occurrences `extra` as one page in (Date, _id) order.
+
+    `events` are assumed sorted already when `after` or `limit` is given,
+    as the event queries return them then. Occurrences up to the `after`
+    cursor position are dropped and the rest projected to `fields`.
+    """
+    if not extra:
+        return events
+    if after:
+        after = tuple(after)
+        beyond = (lambda e: _sort_key(e) < after) if descending else (
+            lambda e: _sort_key(e) > after
+        )
+        extra = [e for e in extra if beyond(e)]
+    if fields:
+        # the `recurring` marker is kept, clients need it to tell occurrences apart
+        extra = [{f: e[f] for f in (*fields, "recurring") if f in e} for e in extra]
+    if descending:
+        extra = extra[::-1]
+    if after or limit:
+        merged = list(heapq.merge(events, extra, key=_sort_key, reverse=descending))
+    else:
+        merged = sorted(events + extra, key=_sort_key, reverse=descending)
+    return merged[:limit] if limit else merged
+
+
+def add_to_totals(totals, extra):
+    """Fold occurrences into month_totals-shaped {"total", "days", "categories"}."""
+    for event in extra:
+        amount = _amount(event)
+        totals["total"] = round(totals["total"] + amount, 2)
+        totals["days"][event["Date"]] = round(totals["days"].get(event["Date"], 0) + amount, 2)
+        category = event.get("Category")
+        totals["categories"][category] = round(
+            totals["categories"].get(category, 0) + amount, 2
+        )
+    return totals
+
+
+def add_spending(grouped, extra, granularity="month"):
+    """Fold occurrences into {period: {category: amount}} spending totals."""
+    for event in extra:
+        period = event_store.period_key(event["Date"], granularity)
+        categories = grouped.setdefault(period, {})
+        category = event.get("Category")
+        categories[category] = round(categories.get(category, 0) + _amount(event), 2)
+    return dict(sorted(grouped.items()))
+
+
+def search(db, email, words, min_amount=None, max_amount=None, start=None, end=None):
+    """Occurrences whose Category or Memo contains every word, as search does."""
+    found = []
+    for event in occurrences(db, email, start, end):
+        amount = _amount(event)
+        if min_amount is not None and amount < min_amount:
+            continue
+        if max_amount is not None and amount > max_amount:
+            continue
+        text = [str(event.get(field) or "").lower() for field in event_store.SEARCHABLE_FIELDS]
+        if all(any(word in value for value in text) for word in words):
+            found.append(event)
+    return found
+
+
+@event_store.on_change
+def forget_user(db, email, changes):
+    """Drop the user's rules along with all of their events (account deletion)."""
+    if changes is None:
+        db.recurring.delete_many({"user": email})
+
+
+def public(rule):
+    return {key: value for key, value in rule.items() if key != "user"}
+
+
+def list_rules(db, email):
+    return [public(rule) for rule in db.recurring.find({"user": email}).sort("start", ASCENDING)]
+
+
+def create_rule(db, email, rule):
+    """Store a parsed rule for the user, returning it."""
+    rule = dict({"exceptions": []}, **rule, _id=str(ObjectId()), user=email, overrides={})
+    db.recurring.insert_one(rule)
+    versions.reset(db, email)
+    return public(rule)
+
+
+def update_rule(db, email, rule_id, rule):
+    """Replace a rule's schedule and fields, keeping its overrides (and exceptions unless given)."""
+    updated = db.recurring.find_one_and_update(
+        {"_id": rule_id, "user": email},
+        {"$set": rule},
+        return_document=ReturnDocument.AFTER,
+    )
+    if updated is None:
+        return None
+    versions.reset(db, email)
+    return public(updated)
+
+
+def delete_rule(db, email, rule_id):
+    """Remove a rule and every occurrence with it."""
+    deleted = db.recurring.find_one_and_delete({"_id": rule_id, "user": email})
+    if deleted is not None:
+        versions.reset(db, email)
+    return deleted
+
+
+def override(db, email, event_id, fields):
+    """
+    Store changed `fields` for one occurrence, returning the occurrence.
+
+    Returns None if `event_id` is not an occurrence of one of the user's
+    rules.
+    """
+    parsed = split_id(event_id)
+    if parsed is None:
+        return None
+    rule_id, date = parsed
+    rule = db.recurring.find_one({"_id": rule_id, "user": email})
+    if rule is None or date in rule.get("exceptions", ()) or not _occurs_on(rule, date):
+        return None
+    changes = {f: fields[f] for f in OVERRIDE_FIELDS if f in fields}
+    changes = event_store.canonical_date(changes)
+    db.recurring.update_one({"_id": rule_id}, {"$set": {f"overrides.{date}": changes}})
+    versions.reset(db, email)
+    rule.setdefault("overrides", {})[date] = changes
+    return _occurrence(rule, date)
+
+
+def skip(db, email, event_id):
+    """Delete one occurrence by recording an exception, True if it existed."""
+    parsed = split_id(event_id)
+    if parsed is None:
+        return False
+    rule_id, date = parsed
+    rule = db.recurring.find_one({"_id": rule_id, "user": email})
+    if rule is None or date in rule.get("exceptions", ()) or not _occurs_on(rule, date):
+        return False
+    db.recurring.update_one(
+        {"_id": rule_id},
+        {"$addToSet": {"exceptions": date}, "$unset": {f"overrides.{date}": ""}},
+    )
+    versions.reset(db, email)
+    return True
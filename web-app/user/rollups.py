@@ -0,0 +1,171 @@
+"""
+Spending rollups
+
+Per-user spending totals are materialized in the `rollups` collection so
+dashboards read a handful of small documents instead of summing raw
+events. Three kinds of rollup are kept, each with a running `total` and
+`count`:
+
+- day:      spending on one day, keyed by "YYYY-MM-DD"
+- month:    spending in one month, keyed by "YYYY-MM"
+- category: spending on one category within one month
+
+Every document also carries the `month` it belongs to, so the calendar
+reads all of a month's rollups with a single indexed query. The rollups
+are updated with `$inc` deltas whenever events change, and `rebuild`
+recomputes them from the raw events to repair any drift.
+"""
+
+from pymongo import ASCENDING, ReplaceOne, UpdateOne
+
+from user import events as event_store
+
+# totals closer than this are considered equal when verifying
+TOLERANCE = 0.005
+
+
+def ensure_indexes(db):
+    """Create the index rollup reads rely on."""
+    db.rollups.create_index(
+        [("user", ASCENDING), ("month", ASCENDING)], name="user_month"
+    )
+
+
+def _keys(email, event):
+    """The rollup documents an event contributes to, keyed by `_id`."""
+    try:
+        day = event_store.day_key(event["Date"])
+    except (AttributeError, KeyError, ValueError):
+        return {}  # undated or malformed event
+    month = day[:7]
+    category = event.get("Category")
+    base = {"user": email, "month": month}
+    return {
+        f"{email}|day|{day}": dict(base, period="day", key=day),
+        f"{email}|month|{month}": dict(base, period="month", key=month),
+        f"{email}|category|{month}|{category}": dict(
+            base, period="category", key=month, category=category
+        ),
+    }
+
+
+def _amount(event):
+    return float(event.get("Amount") or 0)
+
+
+@event_store.on_change
+def apply_changes(db, email, changes):
+    """Fold a batch of event changes into the user's rollups."""
+    if changes is None:
+        db.rollups.delete_many({"user": email})
+        return
+
+    deltas = {}
+    for before, after in changes:
+        for event, sign in ((before, -1), (after, 1)):
+            if event is None:
+                continue
+            for rollup_id, fields in _keys(email, event).items():
+                delta = deltas.setdefault(rollup_id, [fields, 0.0, 0])
+                delta[1] += sign * _amount(event)
+                delta[2] += sign
+    requests = [
+        UpdateOne(
+            {"_id": rollup_id},
+            {"$inc": {"total": total, "count": count}, "$setOnInsert": fields},
+            upsert=True,
+        )
+        for rollup_id, (fields, total, count) in deltas.items()
+        if count or total
+    ]
+    if not requests:
+        return
+    db.rollups.bulk_write(requests, ordered=False)
+    if any(count < 0 for _, _, count in deltas.values()):
+        # drop rollups whose last event went away
+        db.rollups.delete_many({"user": email, "count": {"$lte": 0}})
+
+
+def month_totals(db, email, year, month):
+    """Month total, per-day totals and per-category totals for one month."""
+    totals = {"total": 0, "days": {}, "categories": {}}
+    for rollup in db.rollups.find({"user": email, "month": f"{year}-{month:02d}"}):
+        total = round(rollup["total"], 2)
+        if rollup["period"] == "day":
+            totals["days"][rollup["key"]] = total
+        elif rollup["period"] == "category":
+            totals["categories"][rollup["category"]] = total
+        else:
+            totals["total"] = total
+    return totals
+
+
+def spending_by_period(db, email, granularity="month"):
+    """{period: {category: amount}} for month or year granularity."""
+    grouped = {}
+    for rollup in db.rollups.find({"user": email, "period": "category"}):
+        period = rollup["key"] if granularity == "month" else rollup["key"][:4]
+        categories = grouped.setdefault(period, {})
+        category = rollup["category"]
+        categories[category] = round(categories.get(category, 0) + rollup["total"], 2)
+    return dict(sorted(grouped.items()))
+
+
+def compute(db, email):
+    """Recompute the user's rollup documents from the raw events."""
+    pipeline = [
+        {"$match": {"user": email}},
+        {
+            "$group": {
+                "_id": {"date": "$Date", "category": "$Category"},
+                "total": {"$sum": "$Amount"},
+                "count": {"$sum": 1},
+            }
+        },
+    ]
+    expected = {}
+    for row in db.events.aggregate(pipeline):
+        event = {"Date": row["_id"]["date"], "Category": row["_id"]["category"]}
+        for rollup_id, fields in _keys(email, event).items():
+            doc = expected.setdefault(rollup_id, dict(fields, total=0.0, count=0))
+            doc["total"] += row["total"] or 0
+            doc["count"] += row["count"]
+    return expected
+
+
+def rebuild(db, email=None, fix=True):
+    """
+    Compare stored rollups against the raw events and report any drift.
+
+    Checks one user, or every user with events or rollups when `email` is
+    None. With `fix`, drifted rollups are rewritten and stale ones removed.
+    Returns a list of (rollup_id, expected_total, stored_total) tuples.
+    """
+    if email:
+        emails = [email]
+    else:
+        emails = sorted(set(db.events.distinct("user")) | set(db.rollups.distinct("user")))
+
+    drift = []
+    for user_email in emails:
+        expected = compute(db, user_email)
+        stored = {doc["_id"]: doc for doc in db.rollups.find({"user": user_email})}
+        requests = []
+        for rollup_id in sorted(set(expected) | set(stored)):
+            want = expected.get(rollup_id)
+            have = stored.get(rollup_id)
+            want_total = want["total"] if want else 0
+            have_total = have["total"] if have else 0
+            want_count = want["count"] if want else 0
+            have_count = have["count"] if have else 0
+            if abs(want_total - have_total) <= TOLERANCE and want_count == have_count:
+                continue
+            drift.append((rollup_id, round(want_total, 2), round(have_total, 2)))
+            if want:
+                requests.append(ReplaceOne({"_id": rollup_id}, want, upsert=True))
+        stale = [rollup_id for rollup_id in stored if rollup_id not in expected]
+        if fix and requests:
+            db.rollups.bulk_write(requests, ordered=False)
+        if fix and stale:
+            db.rollups.delete_many({"_id": {"$in": stale}})
+    return drift
@@ -0,0 +1,216 @@
+"""
+Typeahead suggestions
+
+The distinct categories and memos a user has written are kept in the
+`suggestions` collection, one document per (user, field, text) with the
+number of events using it and the latest event `Date`:
+
+    {"_id": "<email>|<field>|<text lowercased>", "user", "field", "text",
+     "keys": [text lowercased from the start of each word],
+     "count", "last": "YYYY-MM-DD"}
+
+`keys` is the prefix index: a multikey index on (user, keys) turns an
+anchored, case-sensitive regex on the lowercased prefix into a range scan
+of the sorted keys, so "cof" finds both "Coffee" and "Starbucks coffee"
+without reading any event. Matches are ranked by count decayed by the age
+of their latest use, halving every HALF_LIFE_DAYS.
+
+The documents are updated with `$inc` deltas whenever events change, as
+the spending rollups are. An entry shows the spelling last written, and
+its `last` only moves forward until `rebuild` recomputes everything from
+the raw events. Recurring rules are not indexed, their category and memo
+are usually typed once.
+"""
+
+import datetime
+import re
+
+from pymongo import ASCENDING, UpdateOne
+
+from user import events as event_store
+
+FIELDS = event_store.SEARCHABLE_FIELDS
+
+# a suggestion's weight halves for every this many days since its last use
+HALF_LIFE_DAYS = 90
+
+# longest text indexed, and longest key stored for it
+MAX_TEXT_LENGTH = 200
+MAX_KEY_LENGTH = 40
+
+# matches scored per request, the most a very short prefix reads
+MAX_CANDIDATES = 2000
+
+MAX_LIMIT = 50
+
+
+def ensure_indexes(db):
+    """Create the prefix index suggestion reads rely on."""
+    db.suggestions.create_index([("user", ASCENDING), ("keys", ASCENDING)], name="user_keys")
+
+
+def _normalize(text):
+    """`text` with whitespace collapsed, or None if it is not worth suggesting."""
+    if not isinstance(text, str):
+        return None
+    text = " ".join(text.split())
+    if not text or len(text) > MAX_TEXT_LENGTH:
+        return None
+    return text
+
+
+def prefix_keys(text):
+    """The lowercased `text` from the start of each of its words."""
+    lowered = text.lower()
+    starts = [match.start() for match in re.finditer(r"\S+", lowered)]
+    return sorted({lowered[start : start + MAX_KEY_LENGTH] for start in starts})
+
+
+def _entries(email, event):
+    """The suggestion documents an event contributes to, keyed by `_id`."""
+    entries = {}
+    for field in FIELDS:
+        text = _normalize(event.get(field))
+        if text is None:
+            continue
+        entries[f"{email}|{field}|{text.lower()}"] = {
+            "user": email,
+            "field": field,
+            "text": text,
+            "keys": prefix_keys(text),
+        }
+    return entries
+
+
+def _date(event):
+    try:
+        return event_store.day_key(event["Date"])
+    except (AttributeError, KeyError, ValueError):
+        return None
+
+
+@event_store.on_change
+def apply_changes(db, email, changes):
+    """Fold a batch of event changes into the user's suggestions."""
+    if changes is None:
+        db.suggestions.delete_many({"user": email})
+        return
+
+    deltas = {}
+    for before, after in changes:
+        for event, sign in ((before, -1), (after, 1)):
+            if event is None:
+                continue
+            date = _date(event) if sign > 0 else None
+            for entry_id, fields in _entries(email, event).items():
+                delta = deltas.setdefault(entry_id, [fields, 0, None, False])
+                delta[1] += sign
+                if sign > 0:
+                    # the spelling last written is the one suggested
+                    delta[0], delta[3] = fields, True
+                if date and (delta[2] is None or date > delta[2]):
+                    delta[2] = date
+
+    requests = []
+    for entry_id, (fields, count, last, written) in deltas.items():
+        if not count and last is None:
+            continue
+        update = {"$inc": {"count": count}, "$set" if written else "$setOnInsert": fields}
+        if last:
+            update["$max"] = {"last": last}
+        requests.append(UpdateOne({"_id": entry_id}, update, upsert=True))
+    if not requests:
+        return
+    db.suggestions.bulk_write(requests, ordered=False)
+    if any(delta[1] < 0 for delta in deltas.values()):
+        # drop suggestions no event uses any more
+        db.suggestions.delete_many({"user": email, "count": {"$lte": 0}})
+
+
+def score(entry, today):
+    """`count` decayed by the days since the entry was last used."""
+    try:
+        last = datetime.date.fromisoformat(entry.get("last") or "")
+        age = max((today - last).days, 0)
+    except ValueError:
+        age = HALF_LIFE_DAYS * 4  # undated, weigh it like an old entry
+    return entry["count"] * 0.5 ** (age / HALF_LIFE_DAYS)
+
+
+def suggest(db, email, prefix, limit=10, field=None, today=None):
+    """
+    The user's categories and memos with a word starting with `prefix`.
+
+    Returns up to `limit` of {"text", "field", "count", "last"}, best
+    first; texts starting with the prefix rank above those matching it
+    only at a later word. `field` restricts them to "Category" or "Memo".
+    """
+    prefix = " ".join(str(prefix or "").lower().split())[:MAX_KEY_LENGTH]
+    if not prefix:
+        return []
+    criteria = {"user": email, "keys": {"$regex": "^" + re.escape(prefix)}}
+    if field:
+        criteria["field"] = field
+    candidates = db.suggestions.find(
+        criteria, {"_id": 0, "text": 1, "field": 1, "count": 1, "last": 1}
+    ).limit(MAX_CANDIDATES)
+
+    today = today or datetime.date.today()
+    ranked = sorted(
+        candidates,
+        key=lambda entry: (
+            not entry["text"].lower().startswith(prefix),
+            -score(entry, today),
+            entry["text"].lower(),
+        ),
+    )
+    return [
+        {
+            "text": entry["text"],
+            "field": entry["field"],
+            "count": entry["count"],
+            "last": entry.get("last"),
+        }
+        for entry in ranked[:limit]
+    ]
+
+
+def compute(db, email):
+    """The user's suggestion documents recomputed from the raw events."""
+    expected = {}
+    for field in FIELDS:
+        pipeline = [
+            {"$match": {"user": email}},
+            # dates are stored as YYYY-MM-DD, so the latest is the largest
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}, "last": {"$max": "$Date"}}},
+        ]
+        for row in db.events.aggregate(pipeline):
+            last = _date({"Date": row["last"]})
+            for entry_id, fields in _entries(email, {field: row["_id"]}).items():
+                entry = expected.setdefault(entry_id, dict(fields, count=0, last=None))
+                entry["count"] += row["count"]
+                if last and (entry["last"] is None or last > entry["last"]):
+                    entry["last"] = last
+    return expected
+
+
+def rebuild(db, email=None):
+    """
+    Recompute the suggestions of one user, or of every user when `email`
+    is None, from the raw events. Returns the number of entries written.
+    """
+    if email:
+        emails = [email]
+    else:
+        emails = sorted(set(db.events.distinct("user")) | set(db.suggestions.distinct("user")))
+
+    written = 0
+    for user_email in emails:
+        expected = compute(db, user_email)
+        db.suggestions.delete_many({"user": user_email})
+        if expected:
+            db.suggestions.insert_many(
+                [dict(entry, _id=entry_id) for entry_id, entry in expected.items()]
+            )
+        written += len(expected)
+    return written
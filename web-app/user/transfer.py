@@ -0,0 +1,171 @@
+"""
+Bulk import and export of expense history
+
+Imports read CSV or JSON Lines uploads one row at a time, validate each
+row and write the valid ones in batches through the event store. Rows get
+an id derived from their content (and how many identical rows came before
+them in the file), so uploading the same export twice does not duplicate
+it.
+
+Exports stream rows from a database cursor straight into the response,
+so memory use does not grow with the size of the history.
+
+CSV files have a header row naming the date, amount, category and memo
+columns (any capitalization); JSON Lines rows are objects with the same
+keys. An export can be imported again as is.
+"""
+
+import csv
+import hashlib
+import io
+import json
+import math
+
+from user import events as event_store
+
+FORMATS = ("csv", "jsonl")
+
+IMPORT_BATCH_SIZE = 1000
+
+# at most this many row errors are listed in the import report
+MAX_REPORTED_ERRORS = 100
+
+# rows fetched per database round trip and written per response chunk
+EXPORT_BATCH_SIZE = 500
+
+EXPORT_COLUMNS = ("Date", "Amount", "Category", "Memo")
+
+MIMETYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+
+
+def detect_format(filename=None, mimetype=None):
+    """Guess the upload format from its file name or content type."""
+    name = (filename or "").lower()
+    if name.endswith(".csv") or mimetype == "text/csv":
+        return "csv"
+    if name.endswith((".jsonl", ".ndjson")) or mimetype in (
+        "application/x-ndjson",
+        "application/jsonl",
+    ):
+        return "jsonl"
+    return None
+
+
+def read_rows(stream, fmt):
+    """Yield (row_number, row) pairs from a binary stream, row may be an error string."""
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        for number, row in enumerate(reader, start=2):  # row 1 is the header
+            yield number, {str(k).strip().lower(): v for k, v in row.items() if k}
+        return
+    for number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, "invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield number, "expected a JSON object"
+            continue
+        yield number, {str(k).lower(): v for k, v in row.items()}
+
+
+def validate(row):
+    """Turn a raw row into event fields, raising ValueError on bad input."""
+    try:
+        amount = float(str(row.get("amount", "")).replace(",", "").lstrip("$"))
+    except ValueError:
+        raise ValueError("amount is not a number") from None
+    if not math.isfinite(amount) or amount < 0:
+        raise ValueError("amount must not be negative")
+
+    try:
+        date = event_store.day_key(row.get("date") or "")
+    except ValueError:
+        raise ValueError("date must be YYYY-MM-DD") from None
+
+    category = str(row.get("category") or "").strip()
+    if not category:
+        raise ValueError("category is required")
+    memo = str(row.get("memo") or "").strip()
+    return {"Amount": amount, "Category": category, "Date": date, "Memo": memo}
+
+
+def _import_id(email, event, occurrence):
+    content = json.dumps(
+        [email, event["Date"], event["Amount"], event["Category"], event["Memo"], occurrence]
+    )
+    return "imp-" + hashlib.sha256(content.encode("utf-8")).hexdigest()[:24]
+
+
+def import_events(db, email, stream, fmt, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Import every valid row of `stream`, returning a report dict.
+
+    The report counts imported rows, rows already present from an earlier
+    upload, and rows with errors (the first MAX_REPORTED_ERRORS of which
+    are listed with their row number).
+    """
+    report = {"imported": 0, "duplicates": 0, "error_count": 0, "errors": []}
+    seen = {}
+    batch = []
+
+    def flush():
+        inserted = event_store.insert_events_once(db, email, batch)
+        report["imported"] += len(inserted)
+        report["duplicates"] += len(batch) - len(inserted)
+        batch.clear()
+
+    for number, row in read_rows(stream, fmt):
+        try:
+            if isinstance(row, str):
+                raise ValueError(row)
+            event = validate(row)
+        except ValueError as e:
+            report["error_count"] += 1
+            if len(report["errors"]) < MAX_REPORTED_ERRORS:
+                report["errors"].append({"row": number, "error": str(e)})
+            continue
+        content = (event["Date"], event["Amount"], event["Category"], event["Memo"])
+        occurrence = seen[content] = seen.get(content, -1) + 1
+        event["_id"] = _import_id(email, event, occurrence)
+        batch.append(event)
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+    return report
+
+
+def export_events(db, email, fmt, start=None, end=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield the user's events, oldest first, as chunks of CSV or JSON Lines text."""
+    cursor = event_store.iter_events(
+        db,
+        email,
+        event_store.date_query(start=start, end=end),
+        fields=EXPORT_COLUMNS,
+        sort=event_store.date_sort(),
+    ).batch_size(batch_size)
+
+    keys = [column.lower() for column in EXPORT_COLUMNS]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == "csv":
+        writer.writerow(keys)
+
+    try:
+        for count, event in enumerate(cursor, start=1):
+            row = [event.get(column) for column in EXPORT_COLUMNS]
+            if fmt == "csv":
+                writer.writerow(row)
+            else:
+                buffer.write(json.dumps(dict(zip(keys, row))) + "\n")
+            if count % batch_size == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+    finally:
+        cursor.close()
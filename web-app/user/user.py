@@ -1,5 +1,6 @@
 from flask import (
     Blueprint,
+    Response,
     request,
     redirect,
     url_for,
@@ -7,6 +8,7 @@ from flask import (
     session,
     flash,
     jsonify,
+    make_response,
 )
 from flask_login import (
     LoginManager,
@@ -16,105 +18,290 @@ from flask_login import (
     current_user,
     UserMixin,
 )
-from flask_bcrypt import Bcrypt
 from database import db
 from bson import ObjectId
-from dotenv import load_dotenv
-import os
-import google.generativeai as genai
+from pymongo.errors import DuplicateKeyError
+import calendar
+import click
+import datetime
+import functools
+import io
+import json
+from user import events as event_store
+from user import analytics
+from user import recurring
+from user import rollups
+from user import suggestions
+from user import ai_jobs
+from user import ai_cache
+from user import prompt as prompt_builder
+from user import transfer
+from user import versions
+from user import passwords
 
 user = Blueprint("user", __name__)
-bcrypt = Bcrypt()
+bcrypt = passwords.bcrypt
 
 login_manager = LoginManager()
 login_manager.login_view = "user.login"
 
-load_dotenv()
-api_key = os.getenv("GOOGLE_API_KEY")
-genai.configure(api_key=api_key)
+# identity fields loaded for every authenticated request
+IDENTITY_PROJECTION = {
+    "_id": 0,
+    "email": 1,
+    "firstname": 1,
+    "lastname": 1,
+    "data_version": 1,
+}
+LOGIN_PROJECTION = dict(IDENTITY_PROJECTION, password=1)
+
 
 class User(UserMixin):
+    # bumped on every change to the user's events, see user/versions.py
+    data_version = 0
+
     def __init__(
-        self, email, password=None, firstname=None, lastname=None, events=None
+        self,
+        email,
+        password=None,
+        firstname=None,
+        lastname=None,
+        events=None,
+        data_version=0,
     ):
         self.email = email
         self.password = password
         self.firstname = firstname
         self.lastname = lastname
-        self.events = events if events else []
+        self._events = events
+        self.data_version = data_version
         self.id = email  # no username, just use email
 
+    @property
+    def events(self):
+        """event history, only loaded from the database on first access"""
+        if self._events is None:
+            self._events = self.get_events(db)
+        return self._events
+
     @staticmethod
-    def find_by_email(db, email):
-        return db.users.find_one({"email": email})
+    def find_by_email(db, email, projection=None):
+        # copied so the shared projection constants are never modified
+        projection = dict(projection) if projection else None
+        return db.users.find_one({"email": email}, projection)
 
     @staticmethod
     def create_user(db, email, password, firstname, lastname):
-        hashed_password = bcrypt.generate_password_hash(password).decode("utf-8")
+        hashed_password = passwords.hash_password(password)
         user_data = {
             "email": email,
             "password": hashed_password,
             "firstname": firstname,
             "lastname": lastname,
-            "events": [],
         }
         return db.users.insert_one(user_data)
 
     @staticmethod
     def validate_login(db, email, password):
-        user = db.users.find_one({"email": email})
-        if user and bcrypt.check_password_hash(user["password"], password):
+        """The user if the password matches, rehashing it at the configured cost"""
+        user = User.find_by_email(db, email, LOGIN_PROJECTION)
+        if not user:
+            return None
+        matches, rehashed = passwords.verify(user["password"], password)
+        if matches:
+            if rehashed:
+                # only replaces the hash just checked, a password change wins
+                db.users.update_one(
+                    {"email": email, "password": user["password"]},
+                    {"$set": {"password": rehashed}},
+                )
             return User(
                 email=user["email"],
-                password=user["password"],
+                password=rehashed or user["password"],
                 firstname=user.get("firstname"),
                 lastname=user.get("lastname"),
-                events=user.get("events", []),
+                data_version=user.get("data_version", 0),
             )
         return None
 
     def add_event(self, db, event):
         """user-side add an event"""
-        db.users.update_one({"email": self.email}, {"$push": {"events": event}})
+        event_store.insert_event(db, self.email, event)
 
-    def get_events(self, db):
-        user_data = db.users.find_one({"email": self.email})
-        return user_data.get("events", [])
+    def get_events(
+        self,
+        db,
+        date=None,
+        fields=None,
+        start=None,
+        end=None,
+        descending=False,
+        after=None,
+        limit=None,
+    ):
+        """user-side events and recurring occurrences, filtered, sorted and limited"""
+        query = event_store.date_query(date, start, end, after, descending)
+        # the (user, Date, _id) index serves the sort, asked for or not
+        sort = event_store.date_sort(descending)
+        events = event_store.find_events(db, self.email, query, fields, sort, limit)
+        occurrences = recurring.occurrences(db, self.email, start, end, date)
+        return recurring.merge(events, occurrences, descending, after, fields, limit)
 
-    def delete_event(self, db, event_id):
-        """user-side delete event"""
-        db.users.update_one(
-            {"email": self.email}, {"$pull": {"events": {"_id": event_id}}}
+    def get_month_events(self, db, year, month):
+        """user-side events and recurring expenses dated in the given month"""
+        events = event_store.find_events(
+            db, self.email, event_store.month_query(year, month)
         )
+        return events + recurring.occurrences(db, self.email, *_month_window(year, month))
 
-    def edit_event(self, db, event_id, updated_event):
-        """user-side in database edit event by ID"""
-        db.users.update_one(
-            {"email": self.email, "events._id": event_id},
-            {
-                "$set": {
-                    "events.$.Amount": updated_event.get("Amount"),
-                    "events.$.Category": updated_event.get("Category"),
-                    "events.$.Date": updated_event.get("Date"),
-                    "events.$.Memo": updated_event.get("Memo"),
-                }
-            },
+    def get_spending(self, db, granularity="month", start=None, end=None):
+        """user-side spending totals per period and category, recurring included"""
+        if granularity in ("month", "year") and not (start or end):
+            # whole-history month and year totals are kept materialized
+            spending = rollups.spending_by_period(db, self.email, granularity)
+        else:
+            spending = event_store.spending_by_period(
+                db, self.email, granularity, start, end
+            )
+        occurrences = recurring.occurrences(db, self.email, start, end)
+        return recurring.add_spending(spending, occurrences, granularity)
+
+    def get_top_events(self, db, limit):
+        """user-side most expensive events, largest first"""
+        return event_store.find_events(
+            db,
+            self.email,
+            fields=event_store.EVENT_FIELDS,
+            sort=[("Amount", -1), ("_id", 1)],
+            limit=limit,
+        )
+
+    def get_month_totals(self, db, year, month):
+        """user-side day, category and month spending totals for a month"""
+        totals = rollups.month_totals(db, self.email, year, month)
+        occurrences = recurring.occurrences(db, self.email, *_month_window(year, month))
+        return recurring.add_to_totals(totals, occurrences)
+
+    def search_events(self, db, query, offset=0, limit=None, **filters):
+        """
+        user-side page of the events matching every word of `query`, best first
+
+        Returns (page, total, capped): only the newest MAX_SEARCH_CANDIDATES
+        stored matches are ranked, `capped` says whether more matched. They
+        are ranked on RANK_FIELDS and only the page is read in full.
+        """
+        matches = event_store.search_events(
+            db,
+            self.email,
+            query,
+            fields=event_store.RANK_FIELDS,
+            limit=event_store.MAX_SEARCH_CANDIDATES,
+            **filters,
         )
+        capped = len(matches) >= event_store.MAX_SEARCH_CANDIDATES
+        words = query.lower().split()
+        matches += recurring.search(db, self.email, words, **filters)
+        ranked = event_store.rank_matches(matches, words)
+
+        page = ranked[offset : offset + limit] if limit else ranked[offset:]
+        stored = event_store.find_by_ids(
+            db, self.email, [e["_id"] for e in page if "recurring" not in e]
+        )
+        stored = {event["_id"]: event for event in stored}
+        # occurrences are expanded whole, stored events come from the page read
+        page = [
+            e if "recurring" in e else stored[e["_id"]]
+            for e in page
+            if "recurring" in e or e["_id"] in stored
+        ]
+        return page, len(ranked), capped
+
+    def delete_event(self, db, event_id):
+        """user-side delete event, or skip one recurring occurrence"""
+        if not recurring.skip(db, self.email, event_id):
+            event_store.delete_event(db, self.email, event_id)
+
+    def apply_batch(self, db, operations, ordered=True):
+        """
+        user-side batch of event operations, see events.apply_batch
+
+        Edits and deletes of recurring occurrences become overrides and
+        exceptions of their rule, applied in batch order between bulk
+        writes of the stored events' operations.
+        """
+        results = []
+        pending = []
+
+        def flush():
+            """Write the pending operations, True if an ordered batch must stop."""
+            if pending:
+                results.extend(event_store.apply_batch(db, self.email, pending, ordered))
+                pending.clear()
+            return ordered and any(r["status"] != "ok" for r in results)
+
+        for operation in operations:
+            if operation["op"] != "add" and recurring.split_id(operation["id"]):
+                if flush():
+                    break
+                if operation["op"] == "edit":
+                    done = recurring.override(
+                        db, self.email, operation["id"], operation["fields"]
+                    ) is not None
+                else:
+                    done = recurring.skip(db, self.email, operation["id"])
+                if done:
+                    results.append({"id": operation["id"], "status": "ok"})
+                    continue
+            pending.append(operation)
+        else:
+            flush()
+        results += [
+            {"id": operation.get("id"), "status": "skipped"}
+            for operation in operations[len(results) :]
+        ]
+        return results
+
+    def edit_event(self, db, event_id, updated_event):
+        """user-side in database edit event by ID, an override for an occurrence"""
+        fields = {field: updated_event.get(field) for field in event_store.EVENT_FIELDS}
+        if recurring.override(db, self.email, event_id, fields) is None:
+            event_store.update_event(db, self.email, event_id, fields)
+
+
+def _month_window(year, month):
+    """First and last day of a month as YYYY-MM-DD"""
+    last = calendar.monthrange(year, month)[1]
+    return f"{year:04d}-{month:02d}-01", f"{year:04d}-{month:02d}-{last:02d}"
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    user_data = User.find_by_email(db, user_id)
+    user_data = User.find_by_email(db, user_id, IDENTITY_PROJECTION)
     if user_data:
         return User(
             email=user_data["email"],
             firstname=user_data.get("firstname"),
             lastname=user_data.get("lastname"),
-            events=user_data.get("events", []),
+            data_version=user_data.get("data_version", 0),
         )
     return None
 
 
+# largest page /user/get-events will return
+MAX_PAGE_SIZE = 1000
+
+# most operations accepted by /user/batch-events
+MAX_BATCH_SIZE = 1000
+
+# longest trailing average /user/analytics-rolling computes, in days
+MAX_ROLLING_WINDOW = 365
+
+# seconds a client is asked to wait when password hashing or AI analysis is saturated
+BUSY_RETRY_AFTER = 5
+
+# search results shown per page
+SEARCH_PAGE_SIZE = 20
+
 # default event categories
 DEFAULT_CATEGORIES = [
     "Food",
@@ -125,6 +312,45 @@ DEFAULT_CATEGORIES = [
     "Entertainment",
 ]
 
+
+def conditional(view):
+    """
+    Answer a GET from the user's data version without running `view`.
+
+    The ETag changes whenever the user's events do, so a request whose
+    If-None-Match still matches gets a 304 and no event is read. The
+    version arrives with the user's identity, the check costs no query.
+
+    A read with no end date (`to`, `date` or a `month`) expands recurring
+    expenses up to today, so its ETag also carries today's date and such
+    responses are revalidated once a day.
+    """
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        bounded = any(request.args.get(name) for name in ("to", "date", "month"))
+        etag = versions.etag(
+            current_user.email,
+            current_user.data_version,
+            None if bounded else recurring.today(),
+        )
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+        else:
+            response = view(*args, **kwargs)
+            if isinstance(response, tuple):
+                response = make_response(*response)
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag, weak=True)
+        response.headers["Cache-Control"] = "private, no-cache"
+        # the version to pass to /user/events/changes to catch up later
+        response.headers["X-Data-Version"] = str(current_user.data_version)
+        return response
+
+    return wrapper
+
+
 # user routes
 
 
@@ -138,19 +364,139 @@ def add_event():
     date = data.get("date")
     memo = data.get("memo")
 
-    event = {
-        "_id": str(ObjectId()),
-        "Amount": float(amount),
-        "Category": category,
-        "Date": date,
-        "Memo": memo,
-    }
+    try:
+        event = {
+            "_id": str(ObjectId()),
+            "Amount": float(amount),
+            "Category": category,
+            "Date": event_store.day_key(date),
+            "Memo": memo,
+        }
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
 
     current_user.add_event(db, event)
     
     return jsonify({"message": "Event added successfully"}), 200
 
 
+@user.route("/batch-events", methods=["POST"])
+@login_required
+def batch_events():
+    """
+    POST a list of add/edit/delete operations applied with one bulk write
+
+    JSON payload: {"ordered": true, "operations": [...]} where each
+    operation is {"op": "add", "amount", "category", "date", "memo"},
+    {"op": "edit", "id", "amount", "category", "date", "memo"} or
+    {"op": "delete", "id"}. An ordered batch stops at the first failing
+    operation; an unordered one applies every valid operation. Returns one
+    result per operation, in order. Like edit-event and delete-event, an
+    id may name a recurring occurrence ("<rule id>:<date>").
+    """
+    data = request.get_json(silent=True) or {}
+    raw_operations = data.get("operations")
+    ordered = bool(data.get("ordered", True))
+    if not isinstance(raw_operations, list) or not raw_operations:
+        return jsonify({"error": "operations must be a non-empty list"}), 400
+    if len(raw_operations) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"at most {MAX_BATCH_SIZE} operations per batch"}), 400
+
+    # validate everything first; invalid operations never reach the database,
+    # and in an ordered batch nothing after the first invalid one is applied
+    results = [{"id": _operation_id(raw), "status": "skipped"} for raw in raw_operations]
+    operations = []
+    positions = []
+    for index, raw in enumerate(raw_operations):
+        try:
+            operations.append(_batch_operation(raw))
+            positions.append(index)
+        except ValueError as e:
+            results[index].update(status="invalid", error=str(e))
+            if ordered:
+                break
+
+    applied = current_user.apply_batch(db, operations, ordered)
+    for index, result in zip(positions, applied):
+        results[index] = result
+
+    return jsonify({"results": results}), 200
+
+
+def _date_arg(name):
+    """Query parameter `name` as a canonical YYYY-MM-DD date, None if absent."""
+    value = request.args.get(name)
+    return event_store.day_key(value) if value else None
+
+
+def _operation_id(raw):
+    return raw.get("id") if isinstance(raw, dict) else None
+
+
+def _batch_operation(raw):
+    """Validate one /batch-events operation, raising ValueError if it is malformed."""
+    if not isinstance(raw, dict):
+        raise ValueError("operation must be an object")
+    op = raw.get("op")
+    if op not in ("add", "edit", "delete"):
+        raise ValueError("op must be add, edit or delete")
+    if op != "add" and not raw.get("id"):
+        raise ValueError("id is required")
+    operation = {"op": op, "id": raw.get("id")}
+    if op != "delete":
+        operation["fields"] = transfer.validate(raw)
+    return operation
+
+
+@user.route("/import-events", methods=["POST"])
+@login_required
+def import_events():
+    """
+    POST a CSV or JSON Lines file of expenses to add them in bulk
+
+    Send the file as the `file` field of a multipart form, or as the raw
+    request body with a text/csv or application/x-ndjson content type.
+    `format=csv|jsonl` overrides the detected format. Rows are validated
+    and written in batches, and rows already imported are skipped.
+    """
+    upload = request.files.get("file")
+    if upload:
+        stream = upload.stream
+        fmt = transfer.detect_format(upload.filename, upload.mimetype)
+    else:
+        stream = io.BufferedReader(request.stream)
+        fmt = transfer.detect_format(mimetype=request.mimetype)
+    fmt = request.args.get("format", fmt)
+    if fmt not in transfer.FORMATS:
+        return jsonify({"error": "Upload a .csv or .jsonl file"}), 400
+
+    report = transfer.import_events(db, current_user.email, stream, fmt)
+    return jsonify(report), 200
+
+
+@user.route("/export-events", methods=["GET"])
+@login_required
+def export_events():
+    """
+    GET route download the user's events as CSV or JSON Lines
+
+    Query parameters: format (csv by default, or jsonl) and an optional
+    from/to date range. Rows are streamed from the database as they are read.
+    """
+    fmt = request.args.get("format", "csv")
+    if fmt not in transfer.FORMATS:
+        return jsonify({"error": "format must be csv or jsonl"}), 400
+
+    try:
+        start, end = _date_arg("from"), _date_arg("to")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    rows = transfer.export_events(db, current_user.email, fmt, start, end)
+    headers = {"Content-Disposition": f"attachment; filename=expenses.{fmt}"}
+    return Response(rows, mimetype=transfer.MIMETYPES[fmt], headers=headers)
+
+
 @user.route("/delete-event/<event_id>", methods=["DELETE"])
 @login_required
 def delete_event(event_id):
@@ -164,12 +510,15 @@ def delete_event(event_id):
 def edit_event(event_id):
     """PUT request to edit an event by ID"""
     data = request.json
-    updated_event = {
-        "Amount": float(data.get("amount")),
-        "Category": data.get("category"),
-        "Date": data.get("date"),
-        "Memo": data.get("memo"),
-    }
+    try:
+        updated_event = {
+            "Amount": float(data.get("amount")),
+            "Category": data.get("category"),
+            "Date": event_store.day_key(data.get("date")),
+            "Memo": data.get("memo"),
+        }
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
 
     current_user.edit_event(db, event_id, updated_event)
 
@@ -178,100 +527,502 @@ def edit_event(event_id):
 
 @user.route("/get-events", methods=["GET"])
 @login_required
+@conditional
 def get_events():
-    """GET route return all events of user as JSON based on date"""
-    filter_date = request.args.get("date")  # format: YYYY-MM-DD
+    """
+    GET route return events of user as JSON, filtered and paged by the database
+
+    Query parameters:
+    - date: a single day, format YYYY-MM-DD (other common formats are accepted)
+    - from, to: inclusive date range, same formats
+    - fields: comma separated subset of Amount, Category, Date, Memo
+    - order: "asc" (default) or "desc" by date
+    - limit: page size, the next page's cursor is sent in the X-Next-Cursor header
+    - cursor: X-Next-Cursor value of the previous page
+    """
+    descending = request.args.get("order", "asc") == "desc"
+
+    fields = None
+    if request.args.get("fields"):
+        fields = request.args["fields"].split(",")
+        if not set(fields) <= set(event_store.EVENT_FIELDS):
+            return jsonify({"error": "Unknown field requested"}), 400
+        # the cursor needs the sort keys of the last event
+        fields = sorted(set(fields) | {"_id", "Date"})
+
+    try:
+        limit = request.args.get("limit", type=int)
+        if limit is not None and not 0 < limit <= MAX_PAGE_SIZE:
+            raise ValueError(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        after = None
+        if request.args.get("cursor"):
+            after = event_store.decode_cursor(request.args["cursor"])
+        filter_date = _date_arg("date")
+        start, end = _date_arg("from"), _date_arg("to")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    events = current_user.get_events(
+        db,
+        date=filter_date,
+        fields=fields,
+        start=start,
+        end=end,
+        descending=descending,
+        after=after,
+        # one extra row tells us whether another page exists
+        limit=limit + 1 if limit else None,
+    )
+
+    headers = {}
+    if limit and len(events) > limit:
+        events = events[:limit]
+        headers["X-Next-Cursor"] = event_store.encode_cursor(events[-1])
+
+    return jsonify(events), 200, headers
+
+@user.route("/events/changes", methods=["GET"])
+@login_required
+def event_changes():
+    """
+    GET route return the events changed since a data version as JSON
+
+    Query parameters: since, the X-Data-Version of an earlier response or
+    the version of the previous call. The response lists the inserted or
+    updated events and the ids of deleted ones, with the version to send
+    next time. When `reset` is true the client must reload its events.
+    """
+    since = request.args.get("since", type=int)
+    if since is None or since < 0:
+        return jsonify({"error": "since must be a data version"}), 400
+
+    changes = versions.changes_since(
+        db, current_user.email, since, current_user.data_version
+    )
+    return jsonify(changes), 200
+
+
+@user.route("/recurring", methods=["GET"])
+@login_required
+def list_recurring():
+    """GET route return the user's recurring expense rules as JSON"""
+    return jsonify(recurring.list_rules(db, current_user.email)), 200
+
+
+@user.route("/recurring", methods=["POST"])
+@login_required
+def add_recurring():
+    """
+    POST a recurring expense rule, stored once and expanded when read
+
+    JSON payload: amount, category, memo, start (YYYY-MM-DD), optional end,
+    unit (day, week, month (default) or year), every (default 1) and
+    exceptions (dates skipped). Occurrences appear in get-events, the
+    calendar, analytics and search with ids "<rule id>:<date>"; editing or
+    deleting one through edit-event/delete-event only affects that date.
+    """
+    try:
+        rule = recurring.parse_rule(request.get_json(silent=True))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(recurring.create_rule(db, current_user.email, rule)), 201
+
+
+@user.route("/recurring/<rule_id>", methods=["PUT"])
+@login_required
+def edit_recurring(rule_id):
+    """
+    PUT request to replace a recurring rule, keeping its per-date overrides
+
+    Takes the payload of POST /user/recurring or a rule as GET returns it.
+    Dates already skipped are kept unless the payload lists exceptions.
+    """
+    try:
+        rule = recurring.parse_rule(request.get_json(silent=True))
+    except (TypeError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    updated = recurring.update_rule(db, current_user.email, rule_id, rule)
+    if updated is None:
+        return jsonify({"error": "Recurring expense not found"}), 404
+    return jsonify(updated), 200
+
+
+@user.route("/recurring/<rule_id>", methods=["DELETE"])
+@login_required
+def delete_recurring(rule_id):
+    """DELETE request to remove a recurring rule and all its occurrences"""
+    if recurring.delete_rule(db, current_user.email, rule_id) is None:
+        return jsonify({"error": "Recurring expense not found"}), 404
+    return jsonify({"message": "Recurring expense deleted successfully"}), 200
+
+
+@user.route("/month-summary", methods=["GET"])
+@login_required
+@conditional
+def month_summary():
+    """
+    GET route return a month of events grouped by day and category
+
+    Query parameters: year, month (1-12). Replaces fetching all events and
+    then refetching every clicked day on the calendar page.
+    """
+    year = request.args.get("year", type=int)
+    month = request.args.get("month", type=int)
+    if not year or not month or not 1 <= month <= 12:
+        return jsonify({"error": "year and month (1-12) are required"}), 400
+    if not datetime.MINYEAR <= year <= datetime.MAXYEAR:
+        # recurring rules expand to dates, which stop at these years
+        return jsonify({"error": "year must be between 1 and 9999"}), 400
+
+    events = current_user.get_month_events(db, year, month)
+    totals = current_user.get_month_totals(db, year, month)
+    summary = event_store.summarize_month(events, totals)
+    summary.update(year=year, month=month)
+
+    return jsonify(summary), 200
 
-    events = current_user.get_events(db)
-    if filter_date:
-        events = [e for e in events if e["Date"] == filter_date]
-        
-    return jsonify(events), 200
 
 @user.route("/search-events/<word>", methods=["GET"])
 @login_required
 def search_events(word):
-    """GET route return all events of user as JSON based on date"""
+    """
+    GET route render the user's events matching every word of the search
+
+    Query parameters: min, max (amount), from, to (YYYY-MM-DD) and page.
+    Results are ranked by relevance and shown SEARCH_PAGE_SIZE at a time.
+    """
     if(not word):
         word=""
-        
-    events = current_user.get_events(db) or []
-    print()
-    events_category_memo = [e for e in events if (e["Category"] and word.lower() in e["Category"].lower()) or (e["Memo"] and word.lower() in e["Memo"].lower())]
-    
-    return render_template("Search.html",searchVal=word,events=events_category_memo)
-        
+
+    filters = {
+        name: request.args[name]
+        for name in ("min", "max", "from", "to")
+        if request.args.get(name)
+    }
+    page = max(request.args.get("page", 1, type=int), 1)
+
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    # like min and max, a date that cannot be read is ignored
+    events_category_memo, total, capped = current_user.search_events(
+        db,
+        word,
+        offset=offset,
+        limit=SEARCH_PAGE_SIZE,
+        min_amount=request.args.get("min", type=float),
+        max_amount=request.args.get("max", type=float),
+        start=request.args.get("from", type=event_store.day_key),
+        end=request.args.get("to", type=event_store.day_key),
+    )
+
+    return render_template(
+        "Search.html",
+        searchVal=word,
+        events=events_category_memo,
+        filters=filters,
+        page=page,
+        total=total,
+        capped=capped,
+        has_next=offset + SEARCH_PAGE_SIZE < total,
+    )
+
+
+@user.route("/suggest", methods=["GET"])
+@login_required
+@conditional
+def suggest():
+    """
+    GET route return typeahead suggestions for the search box as JSON
+
+    Query parameters:
+    - q: the text typed so far, matched against the start of every word
+    - field: optional, "Category" or "Memo"
+    - limit: suggestions to return, at most 50 (default 10)
+    """
+    field = request.args.get("field") or None
+    if field is not None and field not in suggestions.FIELDS:
+        return jsonify({"error": f"field must be one of {', '.join(suggestions.FIELDS)}"}), 400
+    limit = request.args.get("limit", 10, type=int)
+    if limit is None or not 0 < limit <= suggestions.MAX_LIMIT:
+        return jsonify({"error": f"limit must be between 1 and {suggestions.MAX_LIMIT}"}), 400
+
+    return jsonify(
+        suggestions.suggest(
+            db, current_user.email, request.args.get("q", ""), limit=limit, field=field
+        )
+    ), 200
 
 
 @user.route("/analytics-data", methods=["GET"])
 @login_required
+@conditional
 def analytics_data():
-    """Return aggregated analytics data grouped by month and category."""
-    events = current_user.get_events(db)
+    """
+    Return aggregated analytics data grouped by period and category.
+
+    Query parameters:
+    - granularity: day, week, month (default) or year
+    - from, to: optional inclusive date window, format YYYY-MM-DD
+    """
+    granularity = request.args.get("granularity", "month")
+    if granularity not in event_store.GRANULARITIES:
+        choices = ", ".join(event_store.GRANULARITIES)
+        return jsonify({"error": f"granularity must be one of {choices}"}), 400
+
+    try:
+        start, end = _date_arg("from"), _date_arg("to")
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
-    grouped_data = {}
+    grouped_data = current_user.get_spending(db, granularity, start, end)
 
-    for event in events:
-        # Extract year and month from Date
-        event_date = event["Date"]
-        year_month = "-".join(event_date.split("-")[:2])  # Extract "YYYY-MM"
+    return jsonify(grouped_data), 200
 
-        # Initialize data structure for the month if not present
-        if year_month not in grouped_data:
-            grouped_data[year_month] = {}
 
-        # Aggregate Amount by Category
-        category = event["Category"]
-        if category not in grouped_data[year_month]:
-            grouped_data[year_month][category] = 0
+def _load_expenses(history_days=0):
+    """
+    The current user's expenses in the from/to window of the request.
 
-        grouped_data[year_month][category] += event["Amount"]
+    `history_days` more days before `from` are loaded for statistics that
+    look back. Raises ValueError for a malformed date.
+    """
+    start, end = _date_arg("from"), _date_arg("to")
+    since = start
+    if start and history_days:
+        first = datetime.date.fromisoformat(start)
+        # no further back than the first representable day
+        days = min(history_days, (first - datetime.date.min).days)
+        since = (first - datetime.timedelta(days=days)).isoformat()
+    return analytics.load(db, current_user.email, since, end), start
 
-    # Debug: Print the grouped data
-    print("Grouped Analytics Data:", grouped_data)
 
-    return jsonify(grouped_data), 200
+@user.route("/analytics-rolling", methods=["GET"])
+@login_required
+@conditional
+def analytics_rolling():
+    """
+    Daily spending with its trailing averages.
+
+    Query parameters:
+    - windows: comma separated window lengths in days (default 7,30)
+    - from, to: optional inclusive date window, format YYYY-MM-DD
+    """
+    try:
+        windows = [int(w) for w in request.args.get("windows", "7,30").split(",")]
+    except ValueError:
+        windows = []
+    if not windows or not all(1 <= w <= MAX_ROLLING_WINDOW for w in windows):
+        return jsonify({"error": f"windows must be 1 to {MAX_ROLLING_WINDOW} days"}), 400
+
+    try:
+        expenses, start = _load_expenses(history_days=max(windows) - 1)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(analytics.rolling_averages(expenses, windows, since=start)), 200
+
+
+@user.route("/analytics-percentiles", methods=["GET"])
+@login_required
+@conditional
+def analytics_percentiles():
+    """
+    Count, total, mean and amount percentiles per category.
+
+    Query parameters: from, to (optional inclusive window, YYYY-MM-DD)
+    """
+    try:
+        expenses, _ = _load_expenses()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(analytics.category_percentiles(expenses)), 200
+
+
+@user.route("/analytics-changes", methods=["GET"])
+@login_required
+@conditional
+def analytics_changes():
+    """
+    Monthly totals and their change from the month before, per category too.
+
+    Query parameters: from, to (optional inclusive window, YYYY-MM-DD)
+    """
+    try:
+        expenses, _ = _load_expenses()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(analytics.month_over_month(expenses)), 200
+
+
+@user.route("/analytics-outliers", methods=["GET"])
+@login_required
+@conditional
+def analytics_outliers():
+    """
+    Expenses unusually large for their category, most unusual first.
+
+    Query parameters:
+    - threshold: score above which an expense is flagged (default 3.5)
+    - from, to: optional inclusive date window, format YYYY-MM-DD
+    """
+    threshold = request.args.get("threshold", analytics.OUTLIER_THRESHOLD, type=float)
+    if threshold is None or not threshold > 0:
+        return jsonify({"error": "threshold must be a positive number"}), 400
+
+    try:
+        expenses, _ = _load_expenses()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return jsonify(analytics.outliers(expenses, threshold)), 200
+
+NO_EVENTS_ANALYSIS = "No events found. Add some events to your calendar to get analysis."
+
+
+def _analysis_prompt():
+    """The AI prompt for the current user and its cache key, or (None, None)."""
+    # whole-history monthly totals come from the rollups, so the
+    # prompt is built without reading every event
+    monthly = current_user.get_spending(db, "month")
+    if not monthly:
+        return None, None
+
+    top_events = current_user.get_top_events(db, prompt_builder.TOP_N)
+    prompt, summary = prompt_builder.build_prompt(monthly, top_events)
+    return prompt, ai_cache.cache_key(prompt_builder.PROMPT_VERSION, summary)
+
+
+def _sse(data, event=None):
+    """One Server-Sent Events message carrying `data` as JSON."""
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
+
+
+def _ai_busy():
+    return (
+        jsonify({"error": "AI analysis is busy, please try again shortly"}),
+        503,
+        {"Retry-After": str(BUSY_RETRY_AFTER)},
+    )
+
 
 @user.route("/ai-analysis", methods=["POST"])
 @login_required
 def ai_analysis():
-    """Generate AI insights based on user's events."""
+    """
+    Queue AI insights based on user's events.
+
+    Returns 202 with a job id to poll at /user/ai-analysis/<job_id>, or the
+    job already in flight for this user. Returns 503 when the queue is full.
+    """
 
     try:
-        user_events = current_user.get_events(db)
-        
-        if not user_events:
-            return jsonify({"analysis": "No events found. Add some events to your calendar to get analysis."}), 200
-        
-        # format events into a string for the AI
-        events_summary = "\n".join(
-            [f"- {event['Category']}: ${event['Amount']} on {event['Date']} ({event['Memo']})"
-             for event in user_events]
-        )
+        prompt, key = _analysis_prompt()
 
-        prompt = (
-            f"Make sure to reference the specific event or event(s) by their memo or category when specifying tips.\n"
-            f"Do not return any JSON or markdown. Only return plaintext plain-english responses.\n"
-            f"When providing budget-saving tips, make sure to reference how much money they spent in that specific category or event.\n"
-            f"If provided more than 3 events, focus on giving suggestions to save costs on only the most expensive categories.\n"
-            f"Provide budget-saving tips based on these user events provided in JSON format. Be as concise as possible:\n\n{events_summary}"
-        )
+        if prompt is None:
+            return jsonify({"status": "done", "analysis": NO_EVENTS_ANALYSIS}), 200
 
-        # generate AI response
-        model = genai.GenerativeModel(model_name="gemini-1.5-pro")
-        response = model.generate_content(prompt)
+        cached = ai_cache.get(db, key)
+        if cached is not None:
+            return jsonify({"status": "done", "analysis": cached, "cached": True}), 200
 
-        return jsonify({"analysis": response.text}), 200
+        email = current_user.email
+        job, _ = ai_jobs.submit(
+            db, email, prompt, lambda analysis: ai_cache.put(db, email, key, analysis)
+        )
+    except ai_jobs.QueueFull:
+        return _ai_busy()
     except Exception as e:
         return jsonify({"error": "Unable to analyze data", "details": str(e)}), 500
 
+    location = url_for("user.ai_analysis_status", job_id=job["_id"])
+    return jsonify(ai_jobs.public(job)), 202, {"Location": location}
+
+
+@user.route("/ai-analysis/stream", methods=["GET"])
+@login_required
+def ai_analysis_stream():
+    """
+    Stream AI insights as Server-Sent Events while the model generates them.
+
+    Each message carries {"text": chunk}; the stream ends with a "done"
+    event, or an "error" event if generation fails. When the browser
+    disconnects, the upstream model stream is closed as well.
+
+    A stream is admitted like a queued job: it returns 503 when this
+    process has no slot left, and when the user already has an analysis
+    in flight it sends that job in a "job" event, to poll at
+    /user/ai-analysis/<job_id>, instead of starting another.
+    """
+    prompt, key = _analysis_prompt()
+    email = current_user.email
+    cached = ai_cache.get(db, key) if prompt is not None else None
+
+    job = upstream = None
+    if prompt is not None and cached is None:
+        try:
+            job, upstream = ai_jobs.open_stream(
+                db, email, prompt, lambda analysis: ai_cache.put(db, email, key, analysis)
+            )
+        except ai_jobs.QueueFull:
+            return _ai_busy()
+        location = url_for("user.ai_analysis_status", job_id=job["_id"])
+
+    def events():
+        if job is None:
+            yield _sse({"text": cached if cached is not None else NO_EVENTS_ANALYSIS})
+            yield _sse({"cached": cached is not None}, "done")
+            return
+        if upstream is None:
+            yield _sse(dict(ai_jobs.public(job), location=location), "job")
+            return
+
+        try:
+            for chunk in upstream:
+                yield _sse({"text": chunk})
+        except Exception as e:
+            yield _sse({"error": "Unable to analyze data", "details": str(e)}, "error")
+            return
+        finally:
+            upstream.close()
+        yield _sse({"cached": False}, "done")
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    response = Response(events(), mimetype="text/event-stream", headers=headers)
+    if upstream is not None:
+        # releases the slot even if the body is never iterated
+        response.call_on_close(upstream.close)
+    return response
+
+
+@user.route("/ai-analysis/<job_id>", methods=["GET"])
+@login_required
+def ai_analysis_status(job_id):
+    """GET route poll an AI analysis job of the user"""
+    job = ai_jobs.get_job(db, current_user.email, job_id)
+    if job is None:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(ai_jobs.public(job)), 200
+
+
+def _busy(template):
+    """Shed a password check the hashing pool has no room for."""
+    flash("Too many people are signing in right now. Try again in a moment.", "error")
+    return render_template(template), 503, {"Retry-After": str(BUSY_RETRY_AFTER)}
+
 
 @user.route("/login", methods=["GET", "POST"])
 def login():
     if request.method == "POST":
         email = request.form["email"]
         password = request.form["password"]
-        user = User.validate_login(db, email, password)
+        try:
+            user = User.validate_login(db, email, password)
+        except passwords.Busy:
+            return _busy("Login.html")
         if user:
             login_user(user)
             return redirect(url_for("index"))
@@ -288,11 +1039,18 @@ def signup():
         firstname = request.form["firstname"]
         lastname = request.form["lastname"]
 
-        existing_user = User.find_by_email(db, email)
+        existing_user = User.find_by_email(db, email, {"_id": 1})
         if existing_user:
             flash("An account with that email already exists!", "error")
         else:
-            User.create_user(db, email, password, firstname, lastname)
+            try:
+                User.create_user(db, email, password, firstname, lastname)
+            except passwords.Busy:
+                return _busy("Signup.html")
+            except DuplicateKeyError:
+                # lost a race with a concurrent signup for the same email
+                flash("An account with that email already exists!", "error")
+                return render_template("Signup.html")
             return redirect(url_for("user.login"))
     return render_template("Signup.html")
 
@@ -306,9 +1064,16 @@ def delete_account():
         password = request.form.get("password")
 
         if email == current_user.email:
-            user = db.users.find_one({"email": email})
+            user = User.find_by_email(db, email, {"password": 1})
+
+            try:
+                matches = bool(user) and passwords.verify(user["password"], password)[0]
+            except passwords.Busy:
+                return _busy("delete-acct.html")
 
-            if user and bcrypt.check_password_hash(user["password"], password):
+            if matches:
+                # events first, their listeners still find the user document
+                event_store.delete_user_events(db, email)
                 db.users.delete_one({"email": email})
 
                 logout_user()
@@ -329,3 +1094,98 @@ def logout():
     logout_user()
     session.clear()
     return redirect(url_for("user.login"))
+
+
+# maintenance commands, run with `flask --app app user <command>`
+
+
+@user.cli.command("init-db")
+def init_db_command():
+    """Create the indexes the user routes rely on."""
+    db.users.create_index("email", unique=True, name="email_unique")
+    event_store.ensure_indexes(db)
+    rollups.ensure_indexes(db)
+    ai_jobs.ensure_indexes(db)
+    ai_cache.ensure_indexes(db)
+    versions.ensure_indexes(db)
+    recurring.ensure_indexes(db)
+    suggestions.ensure_indexes(db)
+    click.echo("Indexes created.")
+
+
+@user.cli.command("migrate-events")
+@click.option("--batch-size", default=500, show_default=True)
+def migrate_events_command(batch_size):
+    """Move events embedded in user documents into the events collection."""
+    event_store.ensure_indexes(db)
+    # the listeners fold the moved events into rollups and suggestions
+    rollups.ensure_indexes(db)
+    suggestions.ensure_indexes(db)
+    versions.ensure_indexes(db)
+    users, moved = event_store.migrate_embedded_events(db, batch_size=batch_size)
+    click.echo(f"Migrated {moved} events for {users} users.")
+
+
+@user.cli.command("reindex-search")
+@click.option("--batch-size", default=500, show_default=True)
+def reindex_search_command(batch_size):
+    """Add search trigrams to events stored before search indexing."""
+    event_store.ensure_indexes(db)
+    updated = event_store.backfill_search_grams(db, batch_size=batch_size)
+    click.echo(f"Indexed {updated} events for search.")
+
+
+@user.cli.command("normalize-dates")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--pause", default=0.0, show_default=True, help="Seconds between batches.")
+def normalize_dates_command(batch_size, pause):
+    """Rewrite event dates stored in other formats as YYYY-MM-DD."""
+    updated, unreadable = event_store.normalize_dates(
+        db, batch_size=batch_size, pause=pause
+    )
+    click.echo(f"Normalized {updated} event dates, {unreadable} could not be read.")
+    if updated:
+        # dates in formats the rollups could not read were never counted
+        rollups.rebuild(db)
+        click.echo("Spending rollups rebuilt.")
+
+
+@user.cli.command("rebuild-rollups")
+@click.option("--email", default=None, help="Only check this user.")
+@click.option("--verify", is_flag=True, help="Report drift without fixing it.")
+def rebuild_rollups_command(email, verify):
+    """Recompute spending rollups from raw events and report any drift."""
+    drift = rollups.rebuild(db, email=email, fix=not verify)
+    for rollup_id, expected, stored in drift:
+        click.echo(f"{rollup_id}: expected {expected}, stored {stored}")
+    action = "found" if verify else "repaired"
+    click.echo(f"{len(drift)} drifted rollups {action}.")
+
+
+@user.cli.command("rebuild-suggestions")
+@click.option("--email", default=None, help="Only rebuild this user.")
+def rebuild_suggestions_command(email):
+    """Recompute the search typeahead suggestions from raw events."""
+    suggestions.ensure_indexes(db)
+    written = suggestions.rebuild(db, email=email)
+    click.echo(f"Rebuilt {written} suggestions.")
+
+
+@user.cli.command("compact-changes")
+@click.option("--days", default=versions.CHANGE_RETENTION.days, show_default=True)
+def compact_changes_command(days):
+    """Drop event change log entries older than the given number of days."""
+    removed = versions.compact(db, datetime.timedelta(days=days))
+    click.echo(f"Removed {removed} change log entries.")
+
+
+@user.cli.command("ai-cache-stats")
+def ai_cache_stats_command():
+    """Show AI analysis cache hits, misses and size."""
+    stats = ai_cache.stats(db)
+    lookups = stats["hits"] + stats["misses"]
+    rate = stats["hits"] / lookups if lookups else 0
+    click.echo(
+        f"hits {stats['hits']}, misses {stats['misses']} ({rate:.0%} hit rate), "
+        f"{stats['entries']} entries"
+    )
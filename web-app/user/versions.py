@@ -0,0 +1,202 @@
+"""
+Per-user data versions and change log
+
+Every user document carries a `data_version` counter that is bumped each
+time the user's events change. Read endpoints derive their ETag from it,
+so a client that already holds the current data gets a 304 without any
+event being read. The version is loaded with the user's identity on each
+request, which makes the check free.
+
+Each change is also recorded in the `event_changes` collection so clients
+can catch up on just what changed since the version they hold. The log is
+compact: it keeps one entry per event, the version of the event's latest
+change and whether that change deleted it. Entries older than a retention
+period are dropped by `compact`, which raises the user's `changes_floor`;
+a client whose version is below the floor, or which is too far behind,
+is told to reload everything instead.
+"""
+
+import datetime
+import hashlib
+
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from user import events as event_store
+
+# more changes than this and the client is told to reload instead
+MAX_CHANGES = 1000
+
+# log entries are kept at least this long by `compact`
+CHANGE_RETENTION = datetime.timedelta(days=30)
+
+
+def ensure_indexes(db):
+    """Support reading a user's changes in version order and compaction."""
+    db.event_changes.create_index(
+        [("user", ASCENDING), ("version", ASCENDING)], name="user_version"
+    )
+    db.event_changes.create_index([("at", ASCENDING)], name="at")
+
+
+def _entry_id(email, event_id):
+    return f"{email}|{event_id}"
+
+
+@event_store.after_change
+def record(db, email, changes):
+    """Advance the user's data version and log a batch of event changes."""
+    user_doc = db.users.find_one_and_update(
+        {"email": email},
+        {"$inc": {"data_version": 1}},
+        {"data_version": 1, "changes_floor": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not user_doc:
+        if changes is None:
+            # the account is gone too, its log must not reach a new one
+            db.event_changes.delete_many({"user": email})
+        return 0
+    version = user_doc["data_version"]
+
+    if changes is None:
+        # everything is gone, clients start over from this version
+        return _restart_log(db, email, version)
+    if "changes_floor" not in user_doc:
+        # changes before the first logged one cannot be replayed
+        db.users.update_one(
+            {"email": email, "changes_floor": {"$exists": False}},
+            {"$set": {"changes_floor": version - 1}},
+        )
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    latest = {}
+    for before, after in changes:
+        event = after or before
+        latest[event["_id"]] = after is None
+    operations = [
+        UpdateOne(
+            # a concurrent write may already have logged a newer version
+            {"_id": _entry_id(email, event_id), "version": {"$lt": version}},
+            {
+                "$set": {
+                    "user": email,
+                    "event_id": event_id,
+                    "version": version,
+                    "deleted": deleted,
+                    "at": now,
+                }
+            },
+            upsert=True,
+        )
+        for event_id, deleted in latest.items()
+    ]
+    if operations:
+        try:
+            db.event_changes.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details["writeErrors"]):
+                raise
+    return version
+
+
+def _restart_log(db, email, version):
+    db.event_changes.delete_many({"user": email})
+    db.users.update_one({"email": email}, {"$set": {"changes_floor": version}})
+    return version
+
+
+def reset(db, email):
+    """
+    Advance the user's data version for a change the log cannot describe.
+
+    Used when data derived from more than the stored events changes (a
+    recurring rule); delta-sync clients are told to reload everything.
+    """
+    user_doc = db.users.find_one_and_update(
+        {"email": email},
+        {"$inc": {"data_version": 1}},
+        {"data_version": 1},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not user_doc:
+        return 0
+    return _restart_log(db, email, user_doc["data_version"])
+
+
+def current(db, email):
+    """The user's data version, 0 before their first change."""
+    user_doc = db.users.find_one({"email": email}, {"data_version": 1})
+    return (user_doc or {}).get("data_version", 0)
+
+
+def etag(email, version, day=None):
+    """Entity tag for one user's data at `version`.
+
+    The user is part of the tag so a browser shared between accounts never
+    revalidates one user's cached response for another. `day` is added for
+    a response that also depends on the date it is made (recurring
+    occurrences up to today).
+    """
+    owner = hashlib.sha256(email.encode("utf-8")).hexdigest()[:12]
+    return f"{owner}-{version}-{day}" if day else f"{owner}-{version}"
+
+
+def changes_since(db, email, since, version, limit=MAX_CHANGES):
+    """
+    The user's event changes after version `since`.
+
+    Returns {"version", "reset", "events", "deleted"}: the events inserted
+    or updated since then, in their current state, and the ids of deleted
+    ones. `reset` is True, with no changes listed, when the log cannot
+    bring a client at `since` up to date and it should reload everything.
+    `version` is the version the client holds once it applied the result.
+    """
+    result = {"version": version, "reset": False, "events": [], "deleted": []}
+    user_doc = db.users.find_one({"email": email}, {"changes_floor": 1}) or {}
+    if since > version or since < user_doc.get("changes_floor", version):
+        result["reset"] = True
+        return result
+
+    entries = list(
+        db.event_changes.find(
+            {"user": email, "version": {"$gt": since}},
+            {"event_id": 1, "deleted": 1},
+        )
+        .sort("version", ASCENDING)
+        .limit(limit + 1)
+    )
+    if len(entries) > limit:
+        result["reset"] = True
+        return result
+
+    changed = [entry["event_id"] for entry in entries if not entry["deleted"]]
+    result["deleted"] = [entry["event_id"] for entry in entries if entry["deleted"]]
+    if changed:
+        result["events"] = event_store.find_events(db, email, {"_id": {"$in": changed}})
+    return result
+
+
+def compact(db, retention=CHANGE_RETENTION):
+    """
+    Drop log entries older than `retention`, returning how many went.
+
+    Each affected user's `changes_floor` is raised past the dropped
+    versions, so a client that still needed them reloads instead.
+    """
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - retention
+    floors = db.event_changes.aggregate(
+        [
+            {"$match": {"at": {"$lt": cutoff}}},
+            {"$group": {"_id": "$user", "version": {"$max": "$version"}}},
+        ]
+    )
+    removed = 0
+    for floor in floors:
+        db.users.update_one(
+            {"email": floor["_id"]}, {"$max": {"changes_floor": floor["version"]}}
+        )
+        removed += db.event_changes.delete_many(
+            {"user": floor["_id"], "version": {"$lte": floor["version"]}}
+        ).deleted_count
+    return removed